@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""Benchmark the backup and restore pipeline.
+
+Generates a synthetic dataset, and runs it through the real pipeline
+functions of the backup image: archive, checksum, upload, download,
+and extract. S3 is stood in for by moto, unless you point the
+benchmark at a local MinIO server with --endpoint-url.
+
+Each combination of dataset, size, codec, part size and concurrency
+runs in a fresh process, so that its peak RSS is its own.
+"""
+
+import json
+import os
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from functools import partial
+from itertools import product
+from multiprocessing import get_context
+
+import click
+
+BUILD_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               '..', 'tutorbackup', 'templates', 'backup',
+                               'build', 'backup')
+
+MIB = 1024 * 1024
+
+BUCKET = 'benchmark'
+
+WORDS = ("course block problem video html discussion learner grade cohort "
+         "enrollment certificate module section unit verified audit honor "
+         "staff instructor library asset transcript chapter sequential "
+         "vertical submission score attempt state answer hint").split()
+
+
+def random_text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def generate_mysql(path, size, rng):
+    """Write a mysqldump-like file of about size bytes."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write("-- MySQL dump 10.13\n"
+                "CREATE DATABASE IF NOT EXISTS `openedx`;\n"
+                "USE `openedx`;\n"
+                "CREATE TABLE `courseware_studentmodule` (\n"
+                "  `id` int NOT NULL AUTO_INCREMENT,\n"
+                "  `module_type` varchar(32) NOT NULL,\n"
+                "  `module_id` varchar(255) NOT NULL,\n"
+                "  `student_id` int NOT NULL,\n"
+                "  `state` longtext,\n"
+                "  `grade` double DEFAULT NULL,\n"
+                "  `created` datetime(6) NOT NULL,\n"
+                "  PRIMARY KEY (`id`)\n"
+                ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb3;\n")
+        row_id = 0
+        while f.tell() < size:
+            rows = []
+            for _ in range(1000):
+                row_id += 1
+                rows.append(
+                    f"({row_id},'{rng.choice(WORDS)}',"
+                    f"'block-v1:edX+{rng.choice(WORDS)}+{rng.randrange(99)}',"
+                    f"{rng.randrange(100000)},"
+                    f"'{{\"answer\": \"{random_text(rng, 8)}\"}}',"
+                    f"{rng.random():.4f},"
+                    f"'2024-{rng.randrange(1, 13):02d}-"
+                    f"{rng.randrange(1, 29):02d} 12:00:00.000000')")
+            f.write("INSERT INTO `courseware_studentmodule` VALUES " +
+                    ",".join(rows) + ";\n")
+
+
+def encode_bson(document):
+    """Encode a flat document of str, int, float and bool values."""
+    elements = []
+    for key, value in document.items():
+        name = key.encode() + b'\x00'
+        if isinstance(value, bool):
+            elements.append(b'\x08' + name + bytes([value]))
+        elif isinstance(value, int):
+            elements.append(b'\x12' + name + struct.pack('<q', value))
+        elif isinstance(value, float):
+            elements.append(b'\x01' + name + struct.pack('<d', value))
+        else:
+            data = value.encode() + b'\x00'
+            elements.append(b'\x02' + name +
+                            struct.pack('<i', len(data)) + data)
+    body = b''.join(elements)
+    return struct.pack('<i', len(body) + 5) + body + b'\x00'
+
+
+def generate_bson(path, size, rng):
+    """Write a mongodump-like directory of about size bytes."""
+    collections = ['modulestore.structures', 'modulestore.definitions',
+                   'fs.chunks']
+    database_dir = os.path.join(path, 'openedx')
+    os.makedirs(database_dir, exist_ok=True)
+    for index, collection in enumerate(collections):
+        with open(os.path.join(database_dir, f'{collection}.metadata.json'),
+                  'w') as f:
+            json.dump({'indexes': [], 'uuid': f'{index:032x}'}, f)
+        with open(os.path.join(database_dir, f'{collection}.bson'),
+                  'wb') as f:
+            document_id = 0
+            while f.tell() < size // len(collections):
+                document_id += 1
+                f.write(encode_bson({
+                    '_id': document_id,
+                    'block_type': rng.choice(WORDS),
+                    'display_name': random_text(rng, 4),
+                    'data': random_text(rng, 60),
+                    'graded': rng.random() < 0.3,
+                    'weight': rng.random(),
+                    'blob': rng.randbytes(256).hex(),
+                }))
+
+
+DATASETS = {
+    'mysql': ('mysql_dump.sql', generate_mysql),
+    'bson': ('mongodb_dump', generate_bson),
+}
+
+
+def get_disk_usage(path):
+    total_size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total_size += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total_size
+
+
+class DiskSampler(threading.Thread):
+    """Samples the disk usage of a directory, and keeps its peak."""
+
+    def __init__(self, path, interval=0.2):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, get_disk_usage(self.path))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, get_disk_usage(self.path))
+
+
+def get_peak_rss():
+    """Return the peak RSS of this process and of its largest child, in
+    bytes."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own * 1024, children * 1024
+
+
+def set_environment(case, workdir, endpoint_url):
+    os.environ.update({
+        'S3_REQUEST_CHECKSUM_CALCULATION': 'when_required',
+        'S3_SIGNATURE_VERSION': 's3v4',
+        'S3_ADDRESSING_STYLE': 'path',
+        'S3_REGION_NAME': 'us-east-1',
+        'S3_USE_SSL': 'False',
+        'S3_ACCESS_KEY': os.environ.get('S3_ACCESS_KEY', 'minioadmin'),
+        'S3_SECRET_ACCESS_KEY': os.environ.get('S3_SECRET_ACCESS_KEY',
+                                               'minioadmin'),
+        'S3_BUCKET_NAME': BUCKET,
+        'S3_MULTIPART_CHUNKSIZE': str(case['part_size'] * MIB),
+        'S3_MAX_CONCURRENCY': str(case['concurrency']),
+        'COMPRESSION': case['codec'],
+        'PROGRESS_INTERVAL': '0',
+        'LOG_LEVEL': 'WARNING',
+    })
+    if endpoint_url:
+        os.environ['S3_ENDPOINT_URL'] = endpoint_url
+    sys.path.insert(0, os.path.abspath(BUILD_DIRECTORY))
+    os.chdir(workdir)
+
+
+def create_bucket():
+    from s3_client import S3_CLIENT
+
+    try:
+        S3_CLIENT.create_bucket(Bucket=BUCKET)
+    except S3_CLIENT.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    S3_CLIENT.put_bucket_versioning(
+        Bucket=BUCKET,
+        VersioningConfiguration={'Status': 'Enabled'},
+    )
+
+
+def run_case(case, endpoint_url, keep):
+    """Run one benchmark case, and return its results."""
+    workdir = tempfile.mkdtemp(prefix='tutor-backup-benchmark-',
+                               dir=case['workdir'])
+    set_environment(case, workdir, endpoint_url)
+    if not endpoint_url:
+        from moto import mock_aws
+        mock_aws().start()
+    create_bucket()
+
+    import backup_services
+    import restore_services
+
+    name, generate = DATASETS[case['dataset']]
+    dataset = os.path.join(workdir, 'data', name)
+    generate(dataset, case['size'] * MIB, random.Random(case['seed']))
+    dataset_size = get_disk_usage(os.path.join(workdir, 'data'))
+
+    tarfile = os.path.join(workdir, 'backup', os.path.basename(
+        backup_services.TARFILE))
+    backup_services.TARFILE = tarfile
+    restore_services.DUMP_DIRECTORY = os.path.join(workdir, 'restore')
+
+    sampler = DiskSampler(workdir)
+    sampler.start()
+    try:
+        backup_services.write_tarfile(
+            partial(backup_services.archive, [dataset]))
+        archive_size = os.path.getsize(tarfile)
+        # Leave the checksum to upload_to_s3(), so that it is
+        # calculated from the file on disk.
+        backup_services.upload_to_s3()
+        os.remove(tarfile)
+
+        os.makedirs(restore_services.DUMP_DIRECTORY)
+        os.chdir(restore_services.DUMP_DIRECTORY)
+        restore_services.download_from_s3(tarfile)
+        restore_services.extract(tarfile)
+    finally:
+        sampler.stop()
+        os.chdir(case['workdir'])
+        if not keep:
+            shutil.rmtree(workdir)
+
+    phases = {}
+    for metrics in (backup_services.METRICS, restore_services.METRICS):
+        for phase in metrics.phases.values():
+            phases[f'{metrics.operation}.{phase.name}'] = phase.as_dict()
+    rss, child_rss = get_peak_rss()
+    return dict(case,
+                dataset_bytes=dataset_size,
+                archive_bytes=archive_size,
+                ratio=round(dataset_size / max(archive_size, 1), 2),
+                peak_rss_bytes=rss,
+                peak_child_rss_bytes=child_rss,
+                peak_disk_bytes=sampler.peak,
+                phases=phases)
+
+
+def format_result(result):
+    columns = [
+        f"{result['dataset']:>5}",
+        f"{result['size']:>6} MiB",
+        f"{result['codec']:>4}",
+        f"part {result['part_size']:>3} MiB",
+        f"x{result['concurrency']:<3}",
+        f"ratio {result['ratio']:>5}",
+    ]
+    for name in ('backup.archive', 'backup.checksum', 'backup.upload',
+                 'restore.download', 'restore.extract'):
+        phase = result['phases'].get(name)
+        label = name.split('.')[1]
+        if phase:
+            columns.append(f"{label} {phase['mb_per_second']:>7.1f} MB/s")
+    columns.append(f"rss {result['peak_rss_bytes'] // MIB} MiB "
+                   f"(child {result['peak_child_rss_bytes'] // MIB} MiB)")
+    columns.append(f"disk {result['peak_disk_bytes'] // MIB} MiB")
+    return '  '.join(columns)
+
+
+@click.command(help=__doc__)
+@click.option('--dataset', type=click.Choice(sorted(DATASETS)),
+              multiple=True, default=['mysql'], show_default=True,
+              help="Synthetic dataset to back up")
+@click.option('--size', type=int, multiple=True, default=[64],
+              show_default=True, help="Dataset size in MiB")
+@click.option('--codec', type=click.Choice(['xz', 'zstd', 'gzip', 'none']),
+              multiple=True, default=['zstd'], show_default=True,
+              help="Compression codec")
+@click.option('--part-size', type=int, multiple=True, default=[8],
+              show_default=True, help="S3 part size in MiB")
+@click.option('--concurrency', type=int, multiple=True, default=[10],
+              show_default=True, help="S3 transfer concurrency")
+@click.option('--endpoint-url', default=None,
+              help="S3 endpoint of a local MinIO server, instead of moto")
+@click.option('--workdir', default=tempfile.gettempdir(), show_default=True,
+              help="Directory for the dataset and the archive")
+@click.option('--seed', type=int, default=0, show_default=True,
+              help="Seed of the dataset generator")
+@click.option('--output', type=click.File('a'), default=None,
+              help="Append the results to this file, as JSON lines")
+@click.option('--keep', is_flag=True,
+              help="Keep the dataset and archive of each case")
+def main(dataset, size, codec, part_size, concurrency, endpoint_url,
+         workdir, seed, output, keep):
+    started = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    context = get_context('spawn')
+    for case_dataset, case_size, case_codec, case_part_size, \
+            case_concurrency in product(dataset, size, codec, part_size,
+                                        concurrency):
+        case = {
+            'dataset': case_dataset,
+            'size': case_size,
+            'codec': case_codec,
+            'part_size': case_part_size,
+            'concurrency': case_concurrency,
+            'seed': seed,
+            'workdir': os.path.abspath(workdir),
+        }
+        start = time.monotonic()
+        with context.Pool(1, maxtasksperchild=1) as pool:
+            result = pool.apply(run_case, (case, endpoint_url, keep))
+        result['started'] = started
+        result['wall_seconds'] = round(time.monotonic() - start, 3)
+        click.echo(format_result(result))
+        if output:
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ from datetime import datetime
 from .__about__ import __version__
 from glob import glob
 import os
+import shlex
 # When Tutor drops support for Python 3.8, we'll need to update this to:
 # from importlib import resources as importlib_resources
 # See: https://github.com/overhangio/tutor/issues/966#issuecomment-1938681102
@@ -25,9 +26,14 @@ config = {
         "K8S_CRONJOB_BACKUP_SCHEDULE": "0 0 * * *",
         "K8S_CRONJOB_RESTORE_ENABLE": False,
         "K8S_CRONJOB_RESTORE_SCHEDULE": "30 0 * * *",
+        "K8S_CRONJOB_INCREMENTAL_ENABLE": False,
+        "K8S_CRONJOB_INCREMENTAL_SCHEDULE": "15 * * * *",
+        "K8S_CRONJOB_PRUNE_ENABLE": False,
+        "K8S_CRONJOB_PRUNE_SCHEDULE": "45 0 * * *",
         "K8S_CRONJOB_CONCURRENCYPOLICY": "Forbid",
         "K8S_USE_EPHEMERAL_VOLUMES": False,
-        "K8S_EPHEMERAL_VOLUME_SIZE": "10Gi",
+        "K8S_EPHEMERAL_VOLUME_SIZE": "{{ BACKUP_ESTIMATED_VOLUME_SIZE or '10Gi' }}",  # noqa: E501
+        "ESTIMATED_VOLUME_SIZE": "",
         "S3_HOST": "{{ S3_HOST | default('') }}",
         "S3_PORT": "{{ S3_PORT | default('') }}",
         "S3_REGION_NAME": "{{ S3_REGION | default('') }}",
@@ -44,6 +50,56 @@ config = {
         "MONGORESTORE_ADDITIONAL_OPTIONS": "",
         "MYSQL_SINGLE_TRANSACTION": True,
         "MYSQL_FLUSH_LOGS": True,
+        "STREAM_DUMPS": False,
+        "STREAM_RESTORE": False,
+        "DUMP_CONCURRENCY": 1,
+        "MYSQL_CHUNKED_DUMP": False,
+        "MYSQL_DUMP_CONCURRENCY": 4,
+        "MYSQL_CHUNK_ROWS": 500000,
+        "MYSQL_RESTORE_CONCURRENCY": 4,
+        "MYSQL_FAST_RESTORE": False,
+        "RESTORE_CACHE_SIZE": "",
+        "MYSQL_BINLOG_BACKUP": False,
+        "MONGODUMP_CONCURRENCY": 1,
+        "MONGODUMP_PARALLEL_COLLECTIONS": 0,
+        "MONGODUMP_GZIP": False,
+        "MONGODUMP_ARCHIVE": False,
+        "THROTTLE_MYSQL_THREADS_RUNNING": 0,
+        "THROTTLE_MYSQL_REPLICA_LAG": 0,
+        "THROTTLE_MONGODB_QUEUE": 0,
+        "THROTTLE_INTERVAL": 5,
+        "THROTTLE_MAX_PAUSE": 30,
+        "PREFLIGHT_CHECK": True,
+        "PREFLIGHT_MARGIN": 20,
+        "MONGORESTORE_CONCURRENCY": 1,
+        "MONGORESTORE_PARALLEL_COLLECTIONS": 0,
+        "MONGORESTORE_INSERTION_WORKERS": 0,
+        "MONGORESTORE_CLUSTER_SIZE": 1,
+        "COMPRESSION": "xz",
+        "COMPRESSION_LEVEL": "",
+        "COMPRESSION_THREADS": 0,
+        "S3_PIPELINED_UPLOAD": False,
+        "S3_MULTIPART_CHUNKSIZE": 8388608,
+        "S3_MAX_CONCURRENCY": 10,
+        "S3_CHECKSUM_ALGORITHM": "",
+        "S3_UPLOAD_CHUNKSIZE": 0,
+        "S3_UPLOAD_MAX_CONCURRENCY": 0,
+        "S3_UPLOAD_BANDWIDTH_LIMIT": 0,
+        "S3_DOWNLOAD_CHUNKSIZE": 0,
+        "S3_DOWNLOAD_MAX_CONCURRENCY": 0,
+        "S3_DOWNLOAD_BANDWIDTH_LIMIT": 0,
+        "S3_RETRY_MODE": "adaptive",
+        "S3_MAX_ATTEMPTS": 10,
+        "RETENTION_DAILY": 7,
+        "RETENTION_WEEKLY": 4,
+        "RETENTION_MONTHLY": 12,
+        "PRUNE_GRACE_HOURS": 24,
+        "KEEP_LOCAL_ARCHIVE": True,
+        "REPOSITORY_MODE": False,
+        "METRICS_TEXTFILE": "",
+        "METRICS_PUSHGATEWAY_URL": "",
+        "PROGRESS_INTERVAL": 30,
+        "SEGMENTED_ARCHIVE": False,
     }
 }
 
@@ -63,17 +119,40 @@ hooks.Filters.IMAGES_PUSH.add_item((
 ))
 
 
+def get_selection_options(mysql_databases, mongodb_databases,
+                          mongodb_collections):
+    options = ""
+    for database in mysql_databases:
+        options += f" --mysql-database={shlex.quote(database)}"
+    for database in mongodb_databases:
+        options += f" --mongodb-database={shlex.quote(database)}"
+    for collection in mongodb_collections:
+        options += f" --mongodb-collection={shlex.quote(collection)}"
+    return options
+
+
 @local_command_group.command(help="Backup MySQL, MongoDB, and Caddy")
 @click.pass_obj
-def backup(context):
+@click.option('--incremental', is_flag=True,
+              help="Only back up the MySQL binary logs written since the "
+                   "last full backup")
+@click.option('--estimate', is_flag=True,
+              help="Only predict the size and duration of a backup, and "
+                   "the disk space it needs")
+def backup(context, incremental, estimate):
     config = tutor_config.load(context.root)
 
     command = "python backup_services.py"
-    web_proxy_enabled = config["ENABLE_WEB_PROXY"]
-    https_enabled = config["ENABLE_HTTPS"]
-    caddy_data_directory_exists = web_proxy_enabled and https_enabled
-    if not caddy_data_directory_exists:
-        command += " --exclude=caddy"
+    if estimate:
+        command += " --estimate"
+    if incremental:
+        command += " --incremental"
+    else:
+        web_proxy_enabled = config["ENABLE_WEB_PROXY"]
+        https_enabled = config["ENABLE_HTTPS"]
+        caddy_data_directory_exists = web_proxy_enabled and https_enabled
+        if not caddy_data_directory_exists:
+            command += " --exclude=caddy"
 
     job_runner = context.job_runner(config)
     job_runner.run_task(service="backup", command=command)
@@ -90,9 +169,30 @@ def backup(context):
 @click.option('--date', type=click.DateTime(formats=["%Y-%m-%d"]),
               default=str(datetime.today().date()),
               help="Backup date (YYYY-MM-DD)")
-def restore(context, exclude, date):
+@click.option('--until',
+              type=click.DateTime(formats=["%Y-%m-%d %H:%M:%S",
+                                           "%Y-%m-%dT%H:%M:%S"]),
+              help="Replay the MySQL binary logs up to this point in "
+                   "time (UTC)")
+@click.option('--mysql-database', multiple=True,
+              help="Only restore this MySQL database")
+@click.option('--mongodb-database', multiple=True,
+              help="Only restore this MongoDB database")
+@click.option('--mongodb-collection', multiple=True,
+              help="Only restore this MongoDB collection "
+                   "(<database>.<collection>)")
+def restore(context, exclude, date, until, mysql_database,
+            mongodb_database, mongodb_collection):
     config = tutor_config.load(context.root)
+    date_source = click.get_current_context().get_parameter_source('date')
+    if until and date_source == click.core.ParameterSource.DEFAULT:
+        # Restore the full backup made on the same day.
+        date = until
     command = f"python restore_services.py --date={date.date()}"
+    if until:
+        command += f" --until='{until.isoformat()}'"
+    command += get_selection_options(mysql_database, mongodb_database,
+                                     mongodb_collection)
     if 'caddy' not in exclude:
         web_proxy_enabled = config["ENABLE_WEB_PROXY"]
         https_enabled = config["ENABLE_HTTPS"]
@@ -109,13 +209,24 @@ def restore(context, exclude, date):
 
 @k8s_command_group.command(help="Backup MySQL, MongoDB, and Caddy")
 @click.pass_obj
-def backup(context):  # noqa: F811
+@click.option('--incremental', is_flag=True,
+              help="Only back up the MySQL binary logs written since the "
+                   "last full backup")
+@click.option('--estimate', is_flag=True,
+              help="Only predict the size and duration of a backup, and "
+                   "the disk space it needs")
+def backup(context, incremental, estimate):  # noqa: F811
     config = tutor_config.load(context.root)
 
     command = "python backup_services.py --upload"
-    caddy_data_directory_exists = config["ENABLE_WEB_PROXY"]
-    if not caddy_data_directory_exists:
-        command += " --exclude=caddy"
+    if estimate:
+        command += " --estimate"
+    if incremental:
+        command += " --incremental"
+    else:
+        caddy_data_directory_exists = config["ENABLE_WEB_PROXY"]
+        if not caddy_data_directory_exists:
+            command += " --exclude=caddy"
 
     job_runner = K8sTaskRunner(context.root, config)
     job_runner.run_task(service="backup-restore", command=command)
@@ -136,16 +247,43 @@ def backup(context):  # noqa: F811
 )
 @click.option('--list-versions', is_flag=False, flag_value=20, type=int,
               help="List n latest backup versions (n=20 by default)")
-def restore(context, date, version, exclude, list_versions):  # noqa: F811
+@click.option('--rebuild-catalog', is_flag=True,
+              help="Rebuild the backup catalog from the bucket contents "
+                   "before listing versions")
+@click.option('--until',
+              type=click.DateTime(formats=["%Y-%m-%d %H:%M:%S",
+                                           "%Y-%m-%dT%H:%M:%S"]),
+              help="Replay the MySQL binary logs up to this point in "
+                   "time (UTC)")
+@click.option('--mysql-database', multiple=True,
+              help="Only restore this MySQL database")
+@click.option('--mongodb-database', multiple=True,
+              help="Only restore this MongoDB database")
+@click.option('--mongodb-collection', multiple=True,
+              help="Only restore this MongoDB collection "
+                   "(<database>.<collection>)")
+def restore(context, date, version, exclude, list_versions,  # noqa: F811
+            rebuild_catalog, until, mysql_database, mongodb_database,
+            mongodb_collection):
     config = tutor_config.load(context.root)
 
+    date_source = click.get_current_context().get_parameter_source('date')
+    if until and date_source == click.core.ParameterSource.DEFAULT:
+        # Restore the full backup made on the same day.
+        date = until
     command = f"python restore_services.py --date={date.date()}"
     if list_versions:
         command += f" --list-versions={list_versions}"
+        if rebuild_catalog:
+            command += " --rebuild-catalog"
     else:
         command += " --download"
         if version:
             command += f" --version='{version}'"
+        if until:
+            command += f" --until='{until.isoformat()}'"
+        command += get_selection_options(mysql_database, mongodb_database,
+                                         mongodb_collection)
 
         if 'caddy' not in exclude:
             caddy_data_directory_exists = config["ENABLE_WEB_PROXY"]
@@ -159,6 +297,41 @@ def restore(context, date, version, exclude, list_versions):  # noqa: F811
     job_runner.run_task(service="backup-restore", command=command)
 
 
+@k8s_command_group.command(name="list-backups",
+                           help="List all backups in the S3 bucket")
+@click.pass_obj
+@click.option('--rebuild-catalog', is_flag=True,
+              help="Rebuild the backup catalog from the bucket contents "
+                   "before listing backups")
+def list_backups(context, rebuild_catalog):
+    config = tutor_config.load(context.root)
+
+    command = "python restore_services.py --list-all"
+    if rebuild_catalog:
+        command += " --rebuild-catalog"
+
+    job_runner = K8sTaskRunner(context.root, config)
+    job_runner.run_task(service="backup-restore", command=command)
+
+
+@k8s_command_group.command(name="prune-backups",
+                           help="Delete the backups in the S3 bucket that "
+                                "the retention policy no longer keeps")
+@click.pass_obj
+@click.option('--dry-run', is_flag=True,
+              help="Only report the backups that would be deleted, and "
+                   "the space that would be reclaimed")
+def prune_backups(context, dry_run):
+    config = tutor_config.load(context.root)
+
+    command = "python backup_services.py --prune"
+    if dry_run:
+        command += " --dry-run"
+
+    job_runner = K8sTaskRunner(context.root, config)
+    job_runner.run_task(service="backup-restore", command=command)
+
+
 # Add the "templates" folder as a template root
 hooks.Filters.ENV_TEMPLATE_ROOTS.add_item(
     str(importlib_resources.files("tutorbackup") / "templates")
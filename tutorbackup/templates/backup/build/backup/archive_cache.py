@@ -0,0 +1,110 @@
+import os
+import re
+import shutil
+import tempfile
+from urllib.parse import quote
+
+# Downloaded archives are kept on a persistent volume, so that restoring
+# the same backup again does not download it again. Each archive is
+# kept under a directory named after its checksum and version ID, with
+# its own file name, which tells its codec. The modification time of
+# the archive records when it was last used, and the least recently
+# used archives are evicted to keep the cache under its maximum size.
+SIZE_PATTERN = re.compile(r'^\s*(\d+)\s*([KMGT]i?)?B?\s*$')
+SIZE_UNITS = {
+    None: 1,
+    'K': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3, 'T': 1000 ** 4,
+    'Ki': 1024, 'Mi': 1024 ** 2, 'Gi': 1024 ** 3, 'Ti': 1024 ** 4,
+}
+TEMPORARY_PREFIX = '.tmp-'
+
+
+def parse_size(size):
+    """Return a size in bytes, given as a number of bytes, or as a
+    Kubernetes quantity, such as 20Gi."""
+    match = SIZE_PATTERN.match(str(size))
+    if not match:
+        raise ValueError(f"Invalid size: {size!r}")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+class ArchiveCache:
+    """A size-bounded, least recently used cache of verified archives in
+    directory."""
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def get_path(self, file_name, version_id, checksum):
+        name = f"{checksum}-{quote(version_id, safe='')}"
+        return os.path.join(self.directory, name,
+                            os.path.basename(file_name))
+
+    def get(self, file_name, version_id, checksum, size):
+        """Return the path of the cached archive of version_id of
+        file_name, with checksum and size, or None if it is not cached.
+        """
+        path = self.get_path(file_name, version_id, checksum)
+        try:
+            if os.path.getsize(path) != size:
+                return None
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get_entries(self):
+        """Return the cached archives, as (last used, size, directory)
+        tuples, least recently used first."""
+        entries = []
+        for name in os.listdir(self.directory):
+            directory = os.path.join(self.directory, name)
+            if name.startswith(TEMPORARY_PREFIX):
+                # Left behind by a job that was interrupted while it
+                # added an archive.
+                shutil.rmtree(directory, ignore_errors=True)
+                continue
+            for file_name in os.listdir(directory):
+                stat = os.stat(os.path.join(directory, file_name))
+                entries.append((stat.st_mtime, stat.st_size, directory))
+        return sorted(entries)
+
+    def evict(self, limit):
+        """Remove the least recently used archives until the cache holds
+        at most limit bytes, and return the directories removed."""
+        entries = self.get_entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for _, size, directory in entries:
+            if total <= limit:
+                break
+            shutil.rmtree(directory)
+            total -= size
+            evicted.append(directory)
+        return evicted
+
+    def add(self, file_name, version_id, checksum, report=None):
+        """Move the verified archive file_name into the cache, evicting
+        other archives to make room for it, and return its new path.
+
+        An archive larger than the cache is left where it is, and None
+        is returned.
+        """
+        size = os.path.getsize(file_name)
+        if size > self.max_size:
+            return None
+        for directory in self.evict(self.max_size - size):
+            if report:
+                report(f"Evicted {os.path.basename(directory)} from the "
+                       "archive cache.")
+        path = self.get_path(file_name, version_id, checksum)
+        # The archive only appears under its final name once it is
+        # complete, even if it is copied from another file system.
+        temporary = tempfile.mkdtemp(prefix=TEMPORARY_PREFIX,
+                                     dir=self.directory)
+        shutil.move(file_name, os.path.join(temporary,
+                                            os.path.basename(path)))
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+        os.rename(temporary, os.path.dirname(path))
+        return path
@@ -1,16 +1,34 @@
 #!/usr/bin/env python
 
+import json
 import logging
 import os
+import shlex
 import shutil
 import sys
-import tarfile
-from datetime import datetime
-from subprocess import check_call
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from subprocess import DEVNULL, PIPE, CalledProcessError
 from pathlib import Path
+from urllib.parse import unquote
 
 import click
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
+
+from checkpoint import JobState, get_checksums, is_intact
+from compression import (CODECS, DEFAULT_CODEC, READ_SIZE, create_archive,
+                         get_codec, get_cpu_count)
+from file_manifest import (build_manifest, dump_manifest, get_total_size,
+                           read_manifest, write_manifest)
+from metrics import Metrics, Progress
+from processes import Popen, check_call, check_output, run_concurrently
+from segments import (INDEX_FILE, Segment, add_to_index, is_mixed,
+                      new_index)
+from streaming import (HashingWriter, PartWriter, TeeWriter, add_bytes,
+                       add_process_output)
 
 try:
     from distutils.util import strtobool  # pre-3.12
@@ -19,17 +37,47 @@ except ImportError:
 
 ENV = os.environ
 
+SERVICES = ['mysql', 'mongodb', 'caddy']
+
 DUMP_DIRECTORY = '/data'
 
 MYSQL_DUMPFILE = os.path.join(DUMP_DIRECTORY, 'mysql_dump.sql')
+MYSQL_CHUNKDIR = os.path.join(DUMP_DIRECTORY, 'mysql_chunks')
 MONGODB_DUMPDIR = os.path.join(DUMP_DIRECTORY, 'mongodb_dump')
+MONGODB_ARCHIVEDIR = os.path.join(DUMP_DIRECTORY, 'mongodb_archive')
 CADDY_DUMPDIR = os.path.join(DUMP_DIRECTORY, 'caddy')
+CADDY_MANIFEST = os.path.join(DUMP_DIRECTORY, 'caddy_manifest.json')
+# The manifest of the last backup, whose digests are reused for the
+# files that have not changed since.
+LAST_CADDY_MANIFEST = os.path.join(DUMP_DIRECTORY, 'backup',
+                                   'caddy_manifest.json')
+
+# Shipped MySQL binary logs are kept here, and under BINLOG_PREFIX in
+# the S3 bucket, next to a file recording where the binary log stood
+# when the last full backup was made.
+BINLOG_DIRECTORY = os.path.join(DUMP_DIRECTORY, 'backup', 'binlogs')
+BINLOG_PREFIX = 'binlogs/'
+BINLOG_POSITION_FILE = 'position.json'
+
+STATE_FILE = os.path.join(DUMP_DIRECTORY, 'backup_state.json')
+
+# The settings that the S3 client requires.
+S3_SETTINGS = ('S3_BUCKET_NAME', 'S3_REQUEST_CHECKSUM_CALCULATION',
+               'S3_SIGNATURE_VERSION', 'S3_ADDRESSING_STYLE',
+               'S3_REGION_NAME', 'S3_USE_SSL', 'S3_ACCESS_KEY',
+               'S3_SECRET_ACCESS_KEY')
+
+COMPRESSION = get_codec(ENV.get('COMPRESSION', DEFAULT_CODEC))
 
 date_stamp = datetime.today().strftime("%Y-%m-%d")
-TARFILE = f'/data/backup/backup.{date_stamp}.tar.xz'
+TARFILE = f'/data/backup/backup.{date_stamp}{COMPRESSION.extension}'
 
 logger = logging.getLogger(__name__)
 
+METRICS = Metrics('backup')
+
+STATE = JobState(STATE_FILE, ENV.get('JOB_NAME'))
+
 
 def get_size(dir_path):
     total_size = os.path.getsize(dir_path)
@@ -42,35 +90,113 @@ def get_size(dir_path):
     return total_size
 
 
-def mysqldump():
+def get_progress(phase, total=None):
+    """Return a callback that counts S3 transfers into phase, and logs
+    their progress."""
+    return Progress(phase, logger.info, total=total,
+                    interval=int(ENV.get('PROGRESS_INTERVAL') or 30))
+
+
+def export_metrics():
+    """Print the metrics of this run as a JSON summary line, and export
+    them in the Prometheus format, if configured to."""
+    print(METRICS.to_json(), flush=True)
+    textfile = ENV.get('METRICS_TEXTFILE')
+    pushgateway_url = ENV.get('METRICS_PUSHGATEWAY_URL')
+    try:
+        if textfile:
+            METRICS.write_textfile(textfile)
+        if pushgateway_url:
+            METRICS.push(pushgateway_url)
+    except OSError as e:
+        # A metrics outage must not fail the backup.
+        logger.warning(f"Could not export metrics: {e}")
+
+
+def get_mysqldump_command(options="--add-drop-database --routines --events",
+                          databases=None, source_data=False):
     user = ENV['MYSQL_ROOT_USERNAME']
     password = ENV['MYSQL_ROOT_PASSWORD']
     host = ENV['MYSQL_HOST']
     port = ENV['MYSQL_PORT']
     single_transaction = bool(strtobool(ENV['MYSQL_SINGLE_TRANSACTION']))
-    outfile = MYSQL_DUMPFILE
 
-    mysql_databases = ENV.get('MYSQL_DATABASES')
+    mysql_databases = databases or ENV.get('MYSQL_DATABASES')
     if mysql_databases:
         databases_statement = f"--databases {mysql_databases}"
-        logger.info(f"Dumping MySQL databases {mysql_databases} "
-                    f"on {host}:{port} to {outfile}")
     else:
         databases_statement = "--all-databases"
-        logger.info(f"Dumping all MySQL databases "
-                    f"on {host}:{port} to {outfile}")
 
     cmd = ("mysqldump "
            f"{databases_statement} "
-           "--add-drop-database --routines "
-           "--events "
+           f"{options} "
            "--quick --quote-names --max-allowed-packet=16M "
            f"--host={host} --port={port} "
            f"--user={user} --password={password}")
 
     if single_transaction:
         cmd += " --single-transaction"
+        if source_data:
+            # Record the binary log position of the dump, as a comment.
+            cmd += " --source-data=2"
+
+    return cmd
+
+
+def get_mysql_binlog_backup():
+    return bool(strtobool(ENV.get('MYSQL_BINLOG_BACKUP', 'False')))
+
+
+def get_mysql_command():
+    user = ENV['MYSQL_ROOT_USERNAME']
+    password = ENV['MYSQL_ROOT_PASSWORD']
+    host = ENV['MYSQL_HOST']
+    port = ENV['MYSQL_PORT']
+
+    return ("mysql "
+            f"--host={host} --port={port} "
+            f"--user={user} --password={password}")
+
+
+def query_mysql(statement, stderr=sys.stderr):
+    """Run an SQL statement, and return the rows of its result."""
+    cmd = (f"{get_mysql_command()} --batch --skip-column-names "
+           f"--execute={shlex.quote(statement)}")
+    output = check_output(cmd, shell=True, stderr=stderr)
+    return [line.split('\t') for line in output.decode().splitlines()]
+
+
+def get_binlog_file():
+    """Return the name of the current MySQL binary log file."""
+    try:
+        rows = query_mysql("SHOW BINARY LOG STATUS", stderr=DEVNULL)
+    except CalledProcessError:
+        # Before MySQL 8.2
+        rows = query_mysql("SHOW MASTER STATUS")
+    if not rows:
+        raise RuntimeError("Binary logging is disabled on the MySQL "
+                           "server, so its binary logs cannot be backed "
+                           "up.")
+    return rows[0][0]
+
+
+def log_mysqldump_start(outfile):
+    host = ENV['MYSQL_HOST']
+    port = ENV['MYSQL_PORT']
+    mysql_databases = ENV.get('MYSQL_DATABASES')
+    if mysql_databases:
+        logger.info(f"Dumping MySQL databases {mysql_databases} "
+                    f"on {host}:{port} to {outfile}")
+    else:
+        logger.info(f"Dumping all MySQL databases "
+                    f"on {host}:{port} to {outfile}")
+
+
+def mysqldump():
+    outfile = MYSQL_DUMPFILE
+    log_mysqldump_start(outfile)
 
+    cmd = get_mysqldump_command(source_data=get_mysql_binlog_backup())
     with open(outfile, 'wb') as out:
         check_call(cmd,
                    shell=True,
@@ -81,15 +207,162 @@ def mysqldump():
     logger.info(f"Complete. {outfile} is {size} bytes.")
 
 
-def get_mongodump_command(database=None):
+def stream_mysqldump(tar, lock=None):
+    outfile = MYSQL_DUMPFILE
+    log_mysqldump_start(f"archive member {outfile}")
+
+    cmd = get_mysqldump_command(source_data=get_mysql_binlog_backup())
+    process = Popen(cmd,
+                    shell=True,
+                    stdout=PIPE,
+                    stderr=sys.stderr)
+    size = add_process_output(tar, outfile, process, lock=lock)
+    logger.info(f"Complete. Streamed {size} bytes of MySQL dump.")
+
+
+def get_mysql_chunked_dump():
+    return bool(strtobool(ENV.get('MYSQL_CHUNKED_DUMP', 'False')))
+
+
+def get_mysqldump_chunked_commands():
+    """Return the mysqldump commands for the files of a chunked dump
+    that surround the table data, by file name."""
+    from mysql_chunks import (SCHEMA_FILE, SYSTEM_DATABASE, SYSTEM_FILE,
+                              TRIGGERS_FILE)
+
+    commands = {
+        SCHEMA_FILE: get_mysqldump_command(
+            "--add-drop-database --routines --events "
+            "--no-data --skip-triggers"),
+    }
+    # The grant tables of the mysql system schema go through mysqldump
+    # as a whole, as in a regular dump.
+    mysql_databases = ENV.get('MYSQL_DATABASES', '').split()
+    if not mysql_databases or SYSTEM_DATABASE in mysql_databases:
+        commands[SYSTEM_FILE] = get_mysqldump_command(
+            "--skip-triggers", databases=SYSTEM_DATABASE)
+    # Triggers must only be created once the data has been loaded.
+    commands[TRIGGERS_FILE] = get_mysqldump_command(
+        "--no-data --no-create-info --no-create-db --triggers")
+    return commands
+
+
+def dump_mysql_chunks(open_output):
+    """Dump the MySQL table data in chunks, and return the metadata of
+    the dump, serialized."""
+    from mysql_chunks import dump as dump_chunks
+
+    single_transaction = bool(strtobool(ENV['MYSQL_SINGLE_TRANSACTION']))
+    concurrency = int(ENV.get('MYSQL_DUMP_CONCURRENCY') or 4)
+    chunk_rows = int(ENV.get('MYSQL_CHUNK_ROWS') or 500000)
+
+    logger.info(f"Dumping MySQL table data over {concurrency} "
+                f"connections, in chunks of about {chunk_rows} rows")
+    start = time.monotonic()
+    metadata = dump_chunks(open_output,
+                           databases=ENV.get('MYSQL_DATABASES', '').split(),
+                           concurrency=concurrency,
+                           chunk_rows=chunk_rows,
+                           consistent=single_transaction)
+    tables = metadata['tables']
+    logger.info(f"Dumped {sum(table['rows'] for table in tables)} rows "
+                f"of {len(tables)} tables in "
+                f"{sum(len(table['chunks']) for table in tables)} chunks "
+                f"in {time.monotonic() - start:.1f}s.")
+    return json.dumps(metadata, indent=2).encode()
+
+
+def mysqldump_chunked():
+    from mysql_chunks import METADATA_FILE
+
+    outdir = MYSQL_CHUNKDIR
+    log_mysqldump_start(outdir)
+
+    def open_output(name):
+        path = os.path.join(outdir, name)
+        Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+        return open(path, 'wb')
+
+    for name, cmd in get_mysqldump_chunked_commands().items():
+        with open_output(name) as out:
+            check_call(cmd,
+                       shell=True,
+                       stdout=out,
+                       stderr=sys.stderr)
+    metadata = dump_mysql_chunks(open_output)
+    with open_output(METADATA_FILE) as out:
+        out.write(metadata)
+
+    total_size = get_size(outdir)
+    logger.info(f"Complete. {outdir} total size {total_size} bytes.")
+
+
+def stream_mysqldump_chunked(tar, lock=None):
+    from mysql_chunks import METADATA_FILE
+
+    outdir = MYSQL_CHUNKDIR
+    lock = lock or threading.Lock()
+    log_mysqldump_start(f"archive members in {outdir}")
+
+    for name, cmd in get_mysqldump_chunked_commands().items():
+        process = Popen(cmd,
+                        shell=True,
+                        stdout=PIPE,
+                        stderr=sys.stderr)
+        add_process_output(tar, os.path.join(outdir, name), process,
+                           lock=lock)
+    metadata = dump_mysql_chunks(
+        lambda name: PartWriter(tar, os.path.join(outdir, name), lock=lock))
+    add_bytes(tar, os.path.join(outdir, METADATA_FILE), metadata, lock=lock)
+    logger.info("Complete. Streamed chunked MySQL dump.")
+
+
+def get_mongodb_databases():
+    mongodb_databases = ENV.get('MONGODB_DATABASES')
+    # None stands for all databases.
+    return mongodb_databases.split() if mongodb_databases else [None]
+
+
+def get_mongodump_concurrency():
+    return int(ENV.get('MONGODUMP_CONCURRENCY') or 1)
+
+
+def get_mongodump_parallel_collections():
+    parallel_collections = int(ENV.get('MONGODUMP_PARALLEL_COLLECTIONS') or 0)
+    if parallel_collections > 0:
+        return parallel_collections
+    # Share the CPU cores between the databases dumped concurrently.
+    concurrency = min(get_mongodump_concurrency(),
+                      len(get_mongodb_databases()))
+    return max(get_cpu_count() // concurrency, 1)
+
+
+def get_mongodump_gzip():
+    return bool(strtobool(ENV.get('MONGODUMP_GZIP', 'False')))
+
+
+def get_mongodump_archive():
+    return bool(strtobool(ENV.get('MONGODUMP_ARCHIVE', 'False')))
+
+
+def get_mongodump_command(database=None, archive=False):
     host = ENV['MONGODB_HOST']
     port = ENV['MONGODB_PORT']
     outdir = MONGODB_DUMPDIR
 
+    # With a bare --archive option, mongodump writes a single archive
+    # stream to stdout.
+    output_statement = "--archive" if archive else f"--out={outdir}"
+
     cmd = ("mongodump "
-           f"--out={outdir} "
+           f"{output_statement} "
            f"--host={host} "
-           f"--port={port}")
+           f"--port={port} "
+           "--numParallelCollections="
+           f"{get_mongodump_parallel_collections()}")
+
+    if get_mongodump_gzip():
+        cmd += " --gzip"
 
     if database:
         cmd += f" --db={database}"
@@ -105,44 +378,470 @@ def get_mongodump_command(database=None):
     return cmd
 
 
-def mongodump():
+def log_mongodump_report(report):
+    """Log the size of, and time taken for, each dumped database."""
+    column_width = 24
+    output = (f"{'Database'.ljust(column_width)}  "
+              f"{'Size (bytes)'.rjust(column_width)}  "
+              f"{'Time (s)'.rjust(column_width)}\n")
+    for database, (size, seconds) in sorted(report.items()):
+        output += (f"{database.ljust(column_width)}  "
+                   f"{str(size).rjust(column_width)}  "
+                   f"{seconds:{column_width}.1f}\n")
+    logger.info(f"MongoDB dump report:\n{output}")
+
+
+def dump_mongodb_database(database, report):
     host = ENV['MONGODB_HOST']
     port = ENV['MONGODB_PORT']
     outdir = MONGODB_DUMPDIR
-    mongodb_databases = ENV.get('MONGODB_DATABASES')
 
-    if mongodb_databases:
-        for database in mongodb_databases.split():
-            logger.info(f"Dumping MongoDB database '{database}' "
-                        f"on {host}:{port} to {outdir}.")
-            cmd = get_mongodump_command(database)
-            check_call(cmd,
-                       shell=True,
-                       stdout=sys.stdout,
-                       stderr=sys.stderr)
+    if database:
+        logger.info(f"Dumping MongoDB database '{database}' "
+                    f"on {host}:{port} to {outdir}.")
     else:
         logger.info("Dumping all MongoDB databases "
                     f"on {host}:{port} to {outdir}.")
-        cmd = get_mongodump_command()
-        check_call(cmd,
+
+    start = time.monotonic()
+    cmd = get_mongodump_command(database)
+    check_call(cmd,
+               shell=True,
+               stdout=sys.stdout,
+               stderr=sys.stderr)
+    seconds = time.monotonic() - start
+
+    # mongodump writes each database into a subdirectory of its own.
+    if database:
+        report[database] = (get_size(os.path.join(outdir, database)),
+                            seconds)
+    else:
+        for item in os.listdir(outdir):
+            report[item] = (get_size(os.path.join(outdir, item)), seconds)
+
+
+def mongodump():
+    outdir = MONGODB_DUMPDIR
+
+    report = {}
+    tasks = [partial(dump_mongodb_database, database, report)
+             for database in get_mongodb_databases()]
+    run_concurrently(tasks, get_mongodump_concurrency())
+    log_mongodump_report(report)
+
+    total_size = get_size(outdir)
+    logger.info(f"Complete. {outdir} total size {total_size} bytes.")
+
+
+def get_mongodb_archive(database=None):
+    # Mark gzip-compressed archives, so that the restore knows to pass
+    # --gzip to mongorestore.
+    extension = ".archive.gz" if get_mongodump_gzip() else ".archive"
+    return os.path.join(MONGODB_ARCHIVEDIR,
+                        f"{database or 'all-databases'}{extension}")
+
+
+def dump_mongodb_archive(database, report):
+    host = ENV['MONGODB_HOST']
+    port = ENV['MONGODB_PORT']
+
+    outfile = get_mongodb_archive(database)
+    if database:
+        logger.info(f"Dumping MongoDB database '{database}' "
+                    f"on {host}:{port} to {outfile}.")
+    else:
+        logger.info("Dumping all MongoDB databases "
+                    f"on {host}:{port} to {outfile}.")
+
+    start = time.monotonic()
+    with open(outfile, 'wb') as out:
+        check_call(get_mongodump_command(database, archive=True),
                    shell=True,
-                   stdout=sys.stdout,
+                   stdout=out,
                    stderr=sys.stderr)
+    report[database or 'all databases'] = (os.path.getsize(outfile),
+                                           time.monotonic() - start)
 
-    total_size = get_size(outdir)
+
+def mongodump_archive():
+    """Dump MongoDB into a single archive file per database, rather than
+    a directory tree of BSON and metadata files."""
+    outdir = MONGODB_ARCHIVEDIR
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+
+    report = {}
+    tasks = [partial(dump_mongodb_archive, database, report)
+             for database in get_mongodb_databases()]
+    run_concurrently(tasks, get_mongodump_concurrency())
+    log_mongodump_report(report)
+
+    total_size = sum(size for size, _ in report.values())
     logger.info(f"Complete. {outdir} total size {total_size} bytes.")
 
 
+def stream_mongodb_database(tar, database, report, lock=None):
+    host = ENV['MONGODB_HOST']
+    port = ENV['MONGODB_PORT']
+
+    outfile = get_mongodb_archive(database)
+    if database:
+        logger.info(f"Dumping MongoDB database '{database}' "
+                    f"on {host}:{port} to archive member {outfile}.")
+    else:
+        logger.info("Dumping all MongoDB databases "
+                    f"on {host}:{port} to archive member {outfile}.")
+
+    start = time.monotonic()
+    process = Popen(get_mongodump_command(database, archive=True),
+                    shell=True,
+                    stdout=PIPE,
+                    stderr=sys.stderr)
+    size = add_process_output(tar, outfile, process, lock=lock)
+    report[database or 'all databases'] = (size, time.monotonic() - start)
+
+
+def stream_mongodump(tar, lock=None):
+    lock = lock or threading.Lock()
+    report = {}
+    tasks = [partial(stream_mongodb_database, tar, database, report, lock)
+             for database in get_mongodb_databases()]
+    run_concurrently(tasks, get_mongodump_concurrency())
+    log_mongodump_report(report)
+
+    total_size = sum(size for size, _ in report.values())
+    logger.info(f"Complete. Streamed {total_size} bytes of MongoDB dump.")
+
+
+def get_caddy_manifest():
+    logger.info("Building the manifest of the Caddy data")
+    manifest = build_manifest('caddy', read_manifest(LAST_CADDY_MANIFEST))
+    Path(LAST_CADDY_MANIFEST).parent.mkdir(parents=True, exist_ok=True)
+    write_manifest(manifest, LAST_CADDY_MANIFEST)
+    return manifest
+
+
 def caddydump():
-    outdir = CADDY_DUMPDIR
-    logger.info(f"Copying Caddy data to {outdir}")
-    shutil.copytree('caddy', outdir)
+    """Write the manifest of the Caddy data to disk.
 
-    total_size = get_size(outdir)
-    logger.info(f"Complete. {outdir} total size {total_size} bytes.")
+    The files themselves are archived straight from the Caddy data
+    directory, so there is no need to copy them first.
+    """
+    manifest = get_caddy_manifest()
+    write_manifest(manifest, CADDY_MANIFEST)
+    logger.info(f"Complete. {CADDY_MANIFEST} lists "
+                f"{len(manifest['files'])} files, total size "
+                f"{get_total_size(manifest)} bytes.")
+
+
+def add_caddy_files(tar, manifest, lock=None):
+    """Add the Caddy data files listed in manifest to tar, in the
+    manifest's order."""
+    for name in manifest['files']:
+        try:
+            with lock or nullcontext():
+                tar.add(os.path.join('caddy', name),
+                        arcname=os.path.join(CADDY_DUMPDIR, name))
+        except FileNotFoundError:
+            logger.warning(f"Caddy data file {name} disappeared "
+                           "during the backup.")
+
+
+def open_tarfile(out, codec=COMPRESSION):
+    return create_archive(out,
+                          codec,
+                          level=ENV.get('COMPRESSION_LEVEL'),
+                          threads=ENV.get('COMPRESSION_THREADS'))
+
+
+def archive(paths, out, codec=COMPRESSION):
+    logger.info(f"Creating {codec.name} archive")
+    with open_tarfile(out, codec) as tar:
+        for item in paths:
+            if item == CADDY_DUMPDIR:
+                add_caddy_files(tar, read_manifest(CADDY_MANIFEST))
+            else:
+                tar.add(item)
+
+
+def get_dump_size(paths):
+    total_size = 0
+    for path in paths:
+        if path == CADDY_DUMPDIR:
+            total_size += get_total_size(read_manifest(CADDY_MANIFEST))
+        elif os.path.isdir(path):
+            total_size += get_size(path)
+        elif os.path.exists(path):
+            total_size += os.path.getsize(path)
+    return total_size
+
+
+def get_dump_concurrency():
+    return int(ENV.get('DUMP_CONCURRENCY') or 1)
+
+
+def get_segmented_archive():
+    return bool(strtobool(ENV.get('SEGMENTED_ARCHIVE', 'False')))
+
+
+def add_path(path, tar, lock=None, skip=()):
+    """Add path to tar, leaving out the paths in skip."""
+    def leave_out(tarinfo):
+        return None if '/' + tarinfo.name in skip else tarinfo
+
+    with lock or nullcontext():
+        tar.add(path, filter=leave_out)
+
+
+def add_caddy_dump(tar, lock=None):
+    add_path(CADDY_MANIFEST, tar, lock)
+    add_caddy_files(tar, read_manifest(CADDY_MANIFEST), lock)
+
+
+def get_database_segments(service, path, dump_dir):
+    """Return the segments for a dump directory with one subdirectory
+    per database in dump_dir: one per database, and one for the rest of
+    the dump in path."""
+    databases = []
+    if os.path.isdir(dump_dir):
+        databases = sorted(name for name in os.listdir(dump_dir)
+                           if os.path.isdir(os.path.join(dump_dir, name)))
+    skip = [os.path.join(dump_dir, name) for name in databases]
+    segments = [Segment(service, service, None,
+                        partial(add_path, path, skip=skip))]
+    for name in databases:
+        database = unquote(name)
+        segments.append(Segment(f"{service}/{database}", service, database,
+                                partial(add_path,
+                                        os.path.join(dump_dir, name))))
+    return segments
+
+
+def get_archive_segments(archive_dir):
+    """Return the segments for a directory of MongoDB archive files: one
+    per archive, and so per database, if they were dumped one by one."""
+    segments = [Segment('mongodb', 'mongodb', None,
+                        partial(add_path, archive_dir, skip=[
+                            os.path.join(archive_dir, name)
+                            for name in os.listdir(archive_dir)]))]
+    for name in sorted(os.listdir(archive_dir)):
+        # See get_mongodb_archive().
+        database = name.partition('.archive')[0]
+        segments.append(Segment(f"mongodb/{database}", 'mongodb',
+                                None if database == 'all-databases'
+                                else database,
+                                partial(add_path,
+                                        os.path.join(archive_dir, name))))
+    return segments
+
+
+def get_segments(paths):
+    """Return the segments of an archive of the dumps on disk at paths.
+
+    MongoDB dumps and chunked MySQL dumps get one segment per database.
+    """
+    segments = []
+    for path in paths:
+        if path == MYSQL_CHUNKDIR:
+            segments.extend(get_database_segments(
+                'mysql', path, os.path.join(MYSQL_CHUNKDIR, 'data')))
+        elif path == MYSQL_DUMPFILE:
+            segments.append(Segment('mysql', 'mysql', None,
+                                    partial(add_path, path)))
+        elif path == MONGODB_DUMPDIR:
+            segments.extend(get_database_segments('mongodb', path, path))
+        elif path == MONGODB_ARCHIVEDIR:
+            segments.extend(get_archive_segments(path))
+        elif path == CADDY_DUMPDIR:
+            segments.append(Segment('caddy', 'caddy', None, add_caddy_dump))
+    return segments
+
+
+def get_streamed_segments(exclude):
+    """Return the segments of an archive that the dumps are streamed
+    into, one per service."""
+    segments = []
+    if 'mysql' not in exclude:
+        if get_mysql_chunked_dump():
+            segments.append(Segment('mysql', 'mysql', None,
+                                    stream_mysqldump_chunked))
+        else:
+            segments.append(Segment('mysql', 'mysql', None,
+                                    stream_mysqldump))
+    if 'mongodb' not in exclude:
+        segments.append(Segment('mongodb', 'mongodb', None,
+                                stream_mongodump))
+    if 'caddy' not in exclude:
+        segments.append(Segment('caddy', 'caddy', None, stream_caddy))
+    return segments
+
+
+def get_segment_codec(segment, codec=COMPRESSION):
+    """Return the codec to compress segment with."""
+    if segment.service == 'mongodb' and get_mongodump_gzip():
+        # mongodump has compressed the dump with gzip already.
+        return CODECS['none']
+    return codec
+
+
+def write_segments(segments, out, codec=COMPRESSION):
+    """Write a segmented archive to out, and return the offset of its
+    index segment.
+
+    Each segment is a tar stream compressed on its own, so the segments
+    are written one after the other. Dumps that are streamed into the
+    archive therefore do not run concurrently.
+    """
+    logger.info(f"Creating segmented {codec.name} archive")
+    index = new_index(codec)
+    offset = 0
+    for segment in segments:
+        segment_codec = get_segment_codec(segment, codec)
+        segment_out = HashingWriter(out)
+        with open_tarfile(segment_out, segment_codec) as tar:
+            segment.add(tar)
+        add_to_index(index, segment, offset, segment_out, segment_codec)
+        logger.info(f"Added {segment_codec.name} segment {segment.name} at "
+                    f"offset {offset}, {segment_out.size} bytes.")
+        offset += segment_out.size
+    # The index of an archive that mixes codecs is left uncompressed,
+    # so that the restore job can find it at the end of the file.
+    with open_tarfile(out, CODECS['none'] if is_mixed(index)
+                      else codec) as tar:
+        add_bytes(tar, INDEX_FILE, json.dumps(index).encode())
+    return offset
+
+
+def stream_caddy(tar, lock=None):
+    manifest = get_caddy_manifest()
+    logger.info(f"Adding Caddy data to archive as {CADDY_DUMPDIR}")
+    # The manifest goes first, so that a streamed restore knows which
+    # files it can skip before it reads them.
+    add_bytes(tar, CADDY_MANIFEST, dump_manifest(manifest), lock)
+    add_caddy_files(tar, manifest, lock)
+    logger.info(f"Complete. Caddy data total size "
+                f"{get_total_size(manifest)} bytes.")
+
+
+def stream_archive(exclude, out, codec=COMPRESSION):
+    logger.info(f"Streaming dumps into {codec.name} archive")
+    with open_tarfile(out, codec) as tar:
+        # The dumps may run concurrently, so they take turns in adding
+        # their parts to the archive.
+        lock = threading.Lock()
+        tasks = [partial(segment.add, tar, lock)
+                 for segment in get_streamed_segments(exclude)]
+        run_concurrently(tasks, get_dump_concurrency())
+
+
+def resumable(phase, task, paths):
+    """Return a task that runs task, which dumps a service to paths,
+    unless an earlier attempt of this run already did so."""
+    def run():
+        recorded = STATE.get(phase)
+        if recorded and is_intact(recorded['files'], paths):
+            logger.info(f"Reusing {', '.join(paths)}, written by an earlier "
+                        "attempt of this job.")
+            return
+        task()
+        if STATE.run:
+            STATE.save(phase, files=get_checksums(paths))
+    return run
+
+
+def dump(exclude):
+    """Dump all services to disk, and return the paths to archive."""
+    tasks = []
+    paths = []
+    if 'mysql' not in exclude:
+        if get_mysql_chunked_dump():
+            tasks.append(resumable('dump_mysql', mysqldump_chunked,
+                                   [MYSQL_CHUNKDIR]))
+            paths.append(MYSQL_CHUNKDIR)
+        else:
+            tasks.append(resumable('dump_mysql', mysqldump,
+                                   [MYSQL_DUMPFILE]))
+            paths.append(MYSQL_DUMPFILE)
+    if 'mongodb' not in exclude:
+        if get_mongodump_archive():
+            tasks.append(resumable('dump_mongodb', mongodump_archive,
+                                   [MONGODB_ARCHIVEDIR]))
+            paths.append(MONGODB_ARCHIVEDIR)
+        else:
+            tasks.append(resumable('dump_mongodb', mongodump,
+                                   [MONGODB_DUMPDIR]))
+            paths.append(MONGODB_DUMPDIR)
+    if 'caddy' not in exclude:
+        tasks.append(caddydump)
+        paths.extend([CADDY_MANIFEST, CADDY_DUMPDIR])
+
+    with throttled_dumps(exclude):
+        run_concurrently(tasks, get_dump_concurrency())
+    return paths
 
 
-def archive(paths):
+def get_mongostat_command():
+    host = ENV['MONGODB_HOST']
+    port = ENV['MONGODB_PORT']
+
+    cmd = f"mongostat --json --rowcount=1 --host={host} --port={port}"
+    try:
+        cmd += (f" --username={ENV['MONGODB_USERNAME']} "
+                f"--password={ENV['MONGODB_PASSWORD']} "
+                "--authenticationDatabase="
+                f"{ENV['MONGODB_AUTHENTICATION_DATABASE']}")
+    except KeyError:
+        pass
+    return cmd
+
+
+def get_load_probes(exclude):
+    """Return probes of the load of the servers to dump, for the load
+    thresholds that are set."""
+    from throttle import MongoDBLoad, MySQLLoad
+
+    probes = []
+    threads_running = int(ENV.get('THROTTLE_MYSQL_THREADS_RUNNING') or 0)
+    replica_lag = int(ENV.get('THROTTLE_MYSQL_REPLICA_LAG') or 0)
+    if 'mysql' not in exclude and (threads_running or replica_lag):
+        from mysql_chunks import connect
+
+        probes.append(MySQLLoad(connect, threads_running, replica_lag))
+    queue_length = int(ENV.get('THROTTLE_MONGODB_QUEUE') or 0)
+    if 'mongodb' not in exclude and queue_length:
+        probes.append(MongoDBLoad(get_mongostat_command(), queue_length))
+    return probes
+
+
+@contextmanager
+def throttled_dumps(exclude):
+    """Pause the dumps that run in the context while the servers they
+    read from are overloaded, if any load threshold is set."""
+    from throttle import Throttle
+
+    probes = get_load_probes(exclude)
+    if not probes:
+        yield
+        return
+    throttle = Throttle(probes, logger.info,
+                        interval=int(ENV.get('THROTTLE_INTERVAL') or 5),
+                        max_pause=int(ENV.get('THROTTLE_MAX_PAUSE') or 30))
+    try:
+        with throttle:
+            yield
+    finally:
+        # The time paused is part of the dump phases, and recorded as a
+        # phase of its own, too.
+        METRICS.get('throttle').wall_time += throttle.paused_time
+        logger.info(f"Paused the dumps {throttle.pauses} times, for "
+                    f"{throttle.paused_time:.1f}s in total.")
+
+
+def run_throttled(exclude, write, out):
+    with throttled_dumps(exclude):
+        return write(out)
+
+
+def open_local_tarfile():
     outfile = TARFILE
 
     # Create the subdirectories to the tar file
@@ -150,75 +849,878 @@ def archive(paths):
     if outfile_path:
         Path(outfile_path).mkdir(parents=True, exist_ok=True)
 
-    logger.info(f"Creating archive {outfile}")
-    with tarfile.open(outfile, "w:xz") as tar:
-        for item in paths:
-            tar.add(item)
+    return open(outfile, 'wb')
 
-    size = os.path.getsize(outfile)
-    logger.info(f"Complete. {outfile} is {size} bytes.")
 
+def write_tarfile(write):
+    """Write the archive to TARFILE, and return its MD5 checksum, along
+    with the offset of its index segment if it is segmented.
 
-def upload_to_s3():
-    from s3_client import S3_CLIENT, IntegrityError, calculate_checksum
+    The checksum is calculated while the archive is being written,
+    so that we need not read the archive back from disk.
+    """
+    outfile = TARFILE
+
+    logger.info(f"Writing archive to {outfile}")
+    with METRICS.phase('archive') as phase:
+        with open_local_tarfile() as out:
+            hashing_out = HashingWriter(out)
+            index_offset = write(hashing_out)
+        phase.add(bytes_out=hashing_out.size)
+
+    logger.info(f"Complete. {outfile} is {hashing_out.size} bytes, "
+                f"checksum '{hashing_out.hexdigest()}'.")
+    STATE.save('archive', file=outfile, size=hashing_out.size,
+               checksum=hashing_out.hexdigest(), index_offset=index_offset)
+    return hashing_out.hexdigest(), index_offset
+
+
+def get_written_archive():
+    """Return the checksum and index offset of the archive that an
+    earlier attempt of this run wrote to TARFILE, if it is still there."""
+    archived = STATE.get('archive')
+    if not archived or archived['file'] != TARFILE:
+        return None
+    try:
+        if os.path.getsize(TARFILE) != archived['size']:
+            return None
+    except FileNotFoundError:
+        return None
+    logger.info(f"Reusing {TARFILE}, written by an earlier attempt "
+                "of this job.")
+    return archived['checksum'], archived['index_offset']
+
+
+def get_resumable_upload(key, metadata):
+    """Return the arguments for a MultipartUploadWriter that resumes the
+    upload of key with metadata that an earlier attempt of this run left
+    unfinished.
+
+    Without a job state, uploads are not resumed, and failed uploads are
+    aborted as usual.
+    """
+    if not STATE.run:
+        return {}
+    recorded = STATE.get('upload') or {}
+    if (recorded.get('key'), recorded.get('metadata')) != (key, metadata):
+        recorded = {}
+    return {'upload_id': recorded.get('upload_id'),
+            'chunksize': recorded.get('chunksize'),
+            'abort_on_error': False}
+
+
+def record_upload(uploader):
+    STATE.save('upload', key=uploader.key, metadata=uploader.metadata,
+               upload_id=uploader.upload_id, chunksize=uploader.chunksize)
+    if uploader.uploaded_parts:
+        logger.info(f"Resuming the upload of {uploader.key}, started by "
+                    "an earlier attempt of this job.")
+
+
+def abort_stale_upload():
+    """Abort the multipart upload that an earlier run, which is not
+    resumed, left unfinished."""
+    from s3_client import S3_CLIENT
+
+    stale = STATE.get_stale('upload')
+    if not stale:
+        return
+    try:
+        S3_CLIENT.abort_multipart_upload(
+            Bucket=ENV['S3_BUCKET_NAME'],
+            Key=stale['key'],
+            UploadId=stale['upload_id'],
+        )
+        logger.info(f"Aborted the unfinished upload of {stale['key']} "
+                    "of an earlier run.")
+    except ClientError:
+        # It has been completed, aborted, or expired since.
+        pass
+
+
+def write_and_upload_to_s3(write):
+    from s3_client import (S3_CLIENT, IntegrityError, MultipartUploadWriter,
+                           get_checksum_algorithm)
 
     bucket = ENV['S3_BUCKET_NAME']
     file_name = TARFILE
+    key = os.path.basename(file_name)
+    keep_local_archive = bool(strtobool(ENV.get('KEEP_LOCAL_ARCHIVE',
+                                                'True')))
 
-    logger.info(f"Calculating checksum for {file_name}")
-    calculated_checksum = calculate_checksum(file_name)
-    logger.info(f"Uploading {file_name} to S3 bucket {bucket}")
+    logger.info(f"Uploading archive to S3 bucket {bucket} as {key} "
+                "while it is being written")
     try:
-        S3_CLIENT.upload_file(
-            file_name,
-            bucket,
-            os.path.basename(file_name),
-            ExtraArgs={
-                'Metadata': {'checksum-md5': calculated_checksum},
-            }
-        )
-        logger.info(f"Uploaded {file_name} to {bucket}.")
+        # Writing and uploading run concurrently, so both phases span
+        # the same time.
+        with METRICS.phase('archive') as archive_phase, \
+                METRICS.phase('upload') as upload_phase:
+            metadata = {'compression': COMPRESSION.name}
+            uploader = MultipartUploadWriter(
+                bucket,
+                key,
+                metadata=metadata,
+                checksum_algorithm=get_checksum_algorithm(),
+                callback=get_progress(upload_phase),
+                **get_resumable_upload(key, metadata),
+            )
+            with uploader:
+                record_upload(uploader)
+                if keep_local_archive:
+                    logger.info(f"Writing a local copy of the archive "
+                                f"to {file_name}")
+                    with open_local_tarfile() as out:
+                        index_offset = write(TeeWriter(uploader, out))
+                else:
+                    index_offset = write(uploader)
+            archive_phase.add(bytes_out=uploader.size)
+        logger.info(f"Uploaded {key} to {bucket} "
+                    f"in {len(uploader.part_digests)} parts.")
 
-        logger.info("Checking uploaded file's integrity ...")
-        obj_metadata = S3_CLIENT.head_object(
-            Bucket=bucket,
-            Key=os.path.basename(file_name),
-        )
+        with METRICS.phase('verify'):
+            logger.info("Checking uploaded file's integrity ...")
+            version_id = uploader.response.get('VersionId')
+            obj_metadata = S3_CLIENT.head_object(
+                Bucket=bucket,
+                Key=key,
+                **({'VersionId': version_id} if version_id else {}),
+            )
+            version_id = obj_metadata['VersionId']
+            size = obj_metadata['ContentLength']
+            calculated_checksum = uploader.hexdigest()
 
-        received_checksum = obj_metadata['Metadata']['checksum-md5']
-        version_id = obj_metadata['VersionId']
-        size = obj_metadata['ContentLength']
+            # S3 has verified each part against its Content-MD5 as it was
+            # received. Checking the ETag of the completed upload confirms
+            # that it was assembled from exactly the parts that we sent.
+            etag_correct = (obj_metadata['ETag'] == uploader.expected_etag())
+            size_correct = (size == uploader.size)
+            if etag_correct and size_correct:
+                # The checksum of the whole file only became known once
+                # the upload was complete, so record it as an object tag,
+                # as well as the offset of the index segment.
+                tags = [{'Key': 'checksum-md5', 'Value': calculated_checksum}]
+                if index_offset is not None:
+                    tags.append({'Key': 'index-offset',
+                                 'Value': str(index_offset)})
+                S3_CLIENT.put_object_tagging(
+                    Bucket=bucket,
+                    Key=key,
+                    VersionId=version_id,
+                    Tagging={'TagSet': tags},
+                )
+                logger.info("File integrity verified.\n"
+                            f"Version ID: '{version_id}'\n"
+                            f"Size: {size} bytes\n"
+                            f"Checksum: '{calculated_checksum}'")
+                return {'key': key, 'version_id': version_id,
+                        'size': size, 'checksum': calculated_checksum}
+            else:
+                S3_CLIENT.delete_object(
+                    Bucket=bucket,
+                    Key=key,
+                    VersionId=version_id,
+                )
+                raise IntegrityError(
+                    "File integrity could not be verified. "
+                    "Deleted the uploaded version "
+                    f"(VersionId: {version_id})."
+                )
 
-        if received_checksum == calculated_checksum:
-            logger.info("File integrity verified.\n"
-                        f"Version ID: '{version_id}'\n"
-                        f"Size: {size} bytes\n"
-                        f"Checksum: '{received_checksum}'")
-        else:
-            S3_CLIENT.delete_object(
+    except (ClientError, IntegrityError) as e:
+        logger.exception(e, exc_info=True)
+        raise e
+
+
+def upload_to_s3(calculated_checksum=None, index_offset=None):
+    from s3_client import (S3_CLIENT, UPLOAD, IntegrityError,
+                           calculate_checksum, get_checksum_algorithm,
+                           get_transfer_config)
+
+    bucket = ENV['S3_BUCKET_NAME']
+    file_name = TARFILE
+
+    if not calculated_checksum:
+        logger.info(f"Calculating checksum for {file_name}")
+        with METRICS.phase('checksum') as phase:
+            calculated_checksum = calculate_checksum(file_name)
+            phase.add(bytes_in=os.path.getsize(file_name))
+
+    extra_args = {
+        'Metadata': {
+            'checksum-md5': calculated_checksum,
+            'compression': COMPRESSION.name,
+        },
+    }
+    if index_offset is not None:
+        extra_args['Metadata']['index-offset'] = str(index_offset)
+    checksum_algorithm = get_checksum_algorithm()
+    if checksum_algorithm:
+        extra_args['ChecksumAlgorithm'] = checksum_algorithm
+
+    logger.info(f"Uploading {file_name} to S3 bucket {bucket}")
+    try:
+        with METRICS.phase('upload') as phase:
+            callback = get_progress(phase, os.path.getsize(file_name))
+            if STATE.run:
+                upload_file_in_parts(file_name, extra_args, callback)
+            else:
+                S3_CLIENT.upload_file(
+                    file_name,
+                    bucket,
+                    os.path.basename(file_name),
+                    ExtraArgs=extra_args,
+                    Config=get_transfer_config(UPLOAD),
+                    Callback=callback,
+                )
+        logger.info(f"Uploaded {file_name} to {bucket}.")
+
+        with METRICS.phase('verify'):
+            logger.info("Checking uploaded file's integrity ...")
+            obj_metadata = S3_CLIENT.head_object(
                 Bucket=bucket,
                 Key=os.path.basename(file_name),
-                VersionId=version_id,
-            )
-            raise IntegrityError(
-                "File integrity could not be verified. "
-                "Deleted the uploaded version "
-                f"(VersionId: {version_id})."
             )
 
+            received_checksum = obj_metadata['Metadata']['checksum-md5']
+            version_id = obj_metadata['VersionId']
+            size = obj_metadata['ContentLength']
+
+            if received_checksum == calculated_checksum:
+                logger.info("File integrity verified.\n"
+                            f"Version ID: '{version_id}'\n"
+                            f"Size: {size} bytes\n"
+                            f"Checksum: '{received_checksum}'")
+                return {'key': os.path.basename(file_name),
+                        'version_id': version_id,
+                        'size': size, 'checksum': received_checksum}
+            else:
+                S3_CLIENT.delete_object(
+                    Bucket=bucket,
+                    Key=os.path.basename(file_name),
+                    VersionId=version_id,
+                )
+                raise IntegrityError(
+                    "File integrity could not be verified. "
+                    "Deleted the uploaded version "
+                    f"(VersionId: {version_id})."
+                )
+
     except (ClientError, IntegrityError) as e:
         logger.exception(e, exc_info=True)
         raise e
 
 
+def upload_file_in_parts(file_name, extra_args, callback):
+    """Upload file_name like upload_to_s3 does, in parts, so that a
+    retry of this run can resume the upload."""
+    from s3_client import MultipartUploadWriter
+
+    key = os.path.basename(file_name)
+    uploader = MultipartUploadWriter(
+        ENV['S3_BUCKET_NAME'],
+        key,
+        metadata=extra_args['Metadata'],
+        checksum_algorithm=extra_args.get('ChecksumAlgorithm'),
+        callback=callback,
+        **get_resumable_upload(key, extra_args['Metadata']),
+    )
+    with uploader:
+        record_upload(uploader)
+        with open(file_name, 'rb') as f:
+            shutil.copyfileobj(f, uploader, READ_SIZE)
+    if uploader.skipped_size:
+        logger.info(f"Skipped {uploader.skipped_size} bytes uploaded by "
+                    "an earlier attempt of this job.")
+
+
+def update_catalog(uploaded, exclude, source_sizes=None):
+    """Add a verified upload to the backup catalog in S3.
+
+    If the size of the data backed up, source_sizes, was measured by
+    this attempt of the job, the entry records it, along with the
+    duration of the job, for later estimates.
+    """
+    from catalog import add_to_catalog
+
+    entry = dict(
+        uploaded,
+        date=date_stamp,
+        codec=COMPRESSION.name,
+        components=[service for service in SERVICES
+                    if service not in exclude],
+        created=datetime.now(timezone.utc).isoformat(timespec='seconds'),
+    )
+    if source_sizes is not None:
+        entry.update(source_size=sum(source_sizes.values()),
+                     seconds=round(time.time() - METRICS.started, 1))
+    try:
+        add_to_catalog(ENV['S3_BUCKET_NAME'], entry)
+        logger.info(f"Added {entry['key']} to the backup catalog.")
+    except ClientError as e:
+        # The backup itself is safe, and the catalog can be rebuilt.
+        logger.warning(f"Could not update the backup catalog: {e}")
+
+
+def get_repository_mode():
+    return bool(strtobool(ENV.get('REPOSITORY_MODE', 'False')))
+
+
+def write_to_repository(write):
+    """Write an uncompressed archive into the chunk repository in S3.
+
+    Only the chunks that are not in the repository yet are compressed
+    and uploaded. The backup itself is recorded as a manifest.
+    """
+    from repository import (ChunkingWriter, ChunkStore, get_manifest_key,
+                            put_manifest)
+
+    bucket = ENV['S3_BUCKET_NAME']
+    name = os.path.basename(TARFILE)[:-len(COMPRESSION.extension)]
+
+    logger.info(f"Writing archive into the chunk repository "
+                f"in S3 bucket {bucket}")
+    try:
+        # Chunks are uploaded while the archive is being written, so
+        # both phases span the same time.
+        with METRICS.phase('archive') as archive_phase, \
+                METRICS.phase('upload') as upload_phase:
+            with ChunkStore(bucket, COMPRESSION,
+                            level=ENV.get('COMPRESSION_LEVEL'),
+                            callback=get_progress(upload_phase)) as store:
+                writer = ChunkingWriter(store)
+                index_offset = write(writer)
+                writer.close()
+            archive_phase.add(bytes_out=writer.size)
+        logger.info(f"Uploaded {store.new_chunks} new chunks "
+                    f"({store.new_size} bytes, {store.stored_size} bytes "
+                    f"{COMPRESSION.name} compressed). Reused "
+                    f"{store.reused_chunks} chunks "
+                    f"({store.reused_size} bytes).")
+
+        missing = store.find_missing(writer.chunks)
+        if missing:
+            # A retry uploads them again.
+            raise RuntimeError(f"{len(missing)} reused chunks were pruned "
+                               "from the repository while the backup "
+                               "ran.")
+        response = put_manifest(bucket, name, writer,
+                                index_offset=index_offset)
+        logger.info(f"Uploaded manifest for {name}.\n"
+                    f"Version ID: '{response.get('VersionId')}'\n"
+                    f"Size: {writer.size} bytes in "
+                    f"{len(writer.chunks)} chunks\n"
+                    f"Checksum: '{writer.hexdigest()}'")
+        return {'key': get_manifest_key(name),
+                'version_id': response.get('VersionId'),
+                'size': writer.size, 'checksum': writer.hexdigest(),
+                'repository': True}
+    except ClientError as e:
+        logger.exception(e, exc_info=True)
+        raise e
+
+
+def write_binlog_position(binlog_file, upload):
+    """Record the binary log file that the last full backup started
+    in, so that incremental backups ship the binary logs from there."""
+    position_file = os.path.join(BINLOG_DIRECTORY, BINLOG_POSITION_FILE)
+    Path(BINLOG_DIRECTORY).mkdir(parents=True, exist_ok=True)
+    with open(position_file, 'w') as f:
+        json.dump({'file': binlog_file,
+                   'backup': os.path.basename(TARFILE)}, f)
+
+    if upload:
+        from s3_client import S3_CLIENT
+
+        S3_CLIENT.upload_file(position_file,
+                              ENV['S3_BUCKET_NAME'],
+                              BINLOG_PREFIX + BINLOG_POSITION_FILE)
+
+
+def read_binlog_position(upload):
+    position_file = os.path.join(BINLOG_DIRECTORY, BINLOG_POSITION_FILE)
+    if upload:
+        from s3_client import S3_CLIENT
+
+        try:
+            response = S3_CLIENT.get_object(
+                Bucket=ENV['S3_BUCKET_NAME'],
+                Key=BINLOG_PREFIX + BINLOG_POSITION_FILE,
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise e
+        return json.loads(response['Body'].read())
+
+    if not os.path.exists(position_file):
+        return None
+    with open(position_file) as f:
+        return json.load(f)
+
+
+def get_shipped_binlogs(upload):
+    if upload:
+        from s3_client import S3_CLIENT
+
+        shipped = set()
+        paginator = S3_CLIENT.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=ENV['S3_BUCKET_NAME'],
+                                       Prefix=BINLOG_PREFIX):
+            for item in page.get('Contents', []):
+                shipped.add(item['Key'][len(BINLOG_PREFIX):])
+        return shipped
+
+    if not os.path.isdir(BINLOG_DIRECTORY):
+        return set()
+    return set(os.listdir(BINLOG_DIRECTORY))
+
+
+def backup_binlogs(upload):
+    """Make an incremental backup of MySQL, by shipping the binary logs
+    written since the last full backup."""
+    host = ENV['MYSQL_HOST']
+    port = ENV['MYSQL_PORT']
+    user = ENV['MYSQL_ROOT_USERNAME']
+    password = ENV['MYSQL_ROOT_PASSWORD']
+    outdir = BINLOG_DIRECTORY
+
+    # Close the current binary log, so that everything written up to
+    # now is in a complete file that we can ship.
+    logger.info(f"Rotating the MySQL binary log on {host}:{port}")
+    query_mysql("FLUSH BINARY LOGS")
+    binlogs = [row[0] for row in query_mysql("SHOW BINARY LOGS")][:-1]
+
+    position = read_binlog_position(upload)
+    if position:
+        binlogs = [binlog for binlog in binlogs
+                   if binlog >= position['file']]
+    else:
+        logger.warning("No full backup has recorded its binary log "
+                       "position yet. Shipping all binary logs.")
+
+    shipped = get_shipped_binlogs(upload)
+    binlogs = [binlog for binlog in binlogs if binlog not in shipped]
+    if not binlogs:
+        logger.info("No new binary logs to ship.")
+        return
+
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    for binlog in binlogs:
+        logger.info(f"Copying binary log {binlog} to {outdir}")
+        with METRICS.phase('binlog_copy') as phase:
+            check_call("mysqlbinlog --read-from-remote-server --raw "
+                       f"--host={host} --port={port} "
+                       f"--user={user} --password={password} "
+                       f"--result-file={outdir}/ {shlex.quote(binlog)}",
+                       shell=True,
+                       stdout=sys.stdout,
+                       stderr=sys.stderr)
+            phase.add(bytes_out=os.path.getsize(
+                os.path.join(outdir, binlog)))
+
+        if upload:
+            from s3_client import S3_CLIENT, UPLOAD, get_transfer_config
+
+            bucket = ENV['S3_BUCKET_NAME']
+            logger.info(f"Uploading binary log {binlog} to S3 bucket "
+                        f"{bucket}")
+            with METRICS.phase('upload') as phase:
+                S3_CLIENT.upload_file(
+                    os.path.join(outdir, binlog),
+                    bucket,
+                    BINLOG_PREFIX + binlog,
+                    Config=get_transfer_config(UPLOAD),
+                    Callback=get_progress(phase),
+                )
+    logger.info(f"Complete. Shipped {len(binlogs)} binary logs.")
+
+
+def get_retention_policy():
+    from retention import Policy
+
+    return Policy(daily=int(ENV.get('RETENTION_DAILY') or 0),
+                  weekly=int(ENV.get('RETENTION_WEEKLY') or 0),
+                  monthly=int(ENV.get('RETENTION_MONTHLY') or 0))
+
+
+def get_prune_grace_period():
+    return timedelta(hours=int(ENV.get('PRUNE_GRACE_HOURS') or 24))
+
+
+def sweep(bucket, kept, removed, dry_run):
+    """Delete the repository chunks that no remaining manifest
+    references, and the binary logs that no backup in kept needs, or
+    only report them if dry_run is set. Return the errors that S3
+    reported."""
+    from retention import (delete_versions, get_referenced_chunks,
+                           select_expired_binlogs,
+                           select_unreferenced_chunks)
+
+    grace_period = get_prune_grace_period()
+    logger.info("Scanning the manifests in the chunk repository")
+    referenced = get_referenced_chunks(bucket, removed)
+    chunks = select_unreferenced_chunks(
+        bucket, referenced, datetime.now(timezone.utc) - grace_period)
+    binlogs = select_expired_binlogs(
+        bucket, BINLOG_PREFIX, kept, grace_period,
+        skip={BINLOG_PREFIX + BINLOG_POSITION_FILE})
+    errors = []
+    for kind, versions in (('unreferenced chunks', chunks),
+                           ('expired binary logs', binlogs)):
+        size = sum(version.size for version in versions)
+        if dry_run:
+            logger.info(f"Dry run: would delete {len(versions)} {kind}, "
+                        f"reclaiming {size} bytes.")
+            continue
+        kind_errors = delete_versions(bucket, versions)
+        failed = {(error['Key'], error['VersionId'])
+                  for error in kind_errors}
+        reclaimed_size = sum(version.size for version in versions
+                             if (version.key, version.version_id)
+                             not in failed)
+        logger.info(f"Deleted {len(versions) - len(failed)} {kind}, "
+                    f"reclaiming {reclaimed_size} bytes.")
+        errors.extend(kind_errors)
+    return errors
+
+
+def prune(dry_run):
+    """Delete the backup versions in S3 that the retention policy no
+    longer keeps, or only report them if dry_run is set."""
+    from catalog import remove_from_catalog
+    from retention import delete_versions, scan_versions, select_expired
+
+    bucket = ENV['S3_BUCKET_NAME']
+    policy = get_retention_policy()
+    if not any(policy):
+        raise RuntimeError("The retention policy keeps no backups. Set "
+                           "RETENTION_DAILY, RETENTION_WEEKLY, or "
+                           "RETENTION_MONTHLY.")
+
+    logger.info(f"Scanning the backup versions in S3 bucket {bucket}, to "
+                f"keep {policy.daily} daily, {policy.weekly} weekly, and "
+                f"{policy.monthly} monthly backups")
+    kept, expired = select_expired(scan_versions(bucket), policy)
+    expired_size = sum(version.size for version in expired)
+    for version in expired:
+        logger.info(f"{'Would delete' if dry_run else 'Deleting'} "
+                    f"{version.key} (VersionId: {version.version_id}, "
+                    f"{version.size} bytes)")
+    if dry_run:
+        logger.info(f"Dry run: would delete {len(expired)} backup versions, "
+                    f"reclaiming {expired_size} bytes, and keep "
+                    f"{len(kept)}.")
+        sweep(bucket, kept, {(version.key, version.version_id)
+                             for version in expired}, dry_run)
+        return
+
+    errors = delete_versions(bucket, expired)
+    failed = {(error['Key'], error['VersionId']) for error in errors}
+    removed = {(version.key, version.version_id) for version in expired
+               if (version.key, version.version_id) not in failed}
+    reclaimed_size = sum(version.size for version in expired
+                         if (version.key, version.version_id) in removed)
+    if removed:
+        try:
+            remove_from_catalog(bucket, removed)
+        except ClientError as e:
+            # The catalog can be rebuilt.
+            logger.warning(f"Could not update the backup catalog: {e}")
+    logger.info(f"Deleted {len(removed)} backup versions, reclaiming "
+                f"{reclaimed_size} bytes, and kept {len(kept)}.")
+    # The manifests that could not be deleted keep their chunks.
+    errors += sweep(bucket, kept, removed, dry_run)
+    if errors:
+        for error in errors:
+            logger.error(f"Could not delete {error['Key']} (VersionId: "
+                         f"{error['VersionId']}): {error['Message']}")
+        raise RuntimeError(f"Could not delete {len(errors)} object "
+                           "versions.")
+
+
+def get_mysql_source_size():
+    """Return the size of the MySQL table data to back up, in bytes."""
+    from mysql_chunks import SYSTEM_SCHEMAS, connect
+
+    statement = ("SELECT SUM(data_length) FROM information_schema.tables "
+                 "WHERE table_schema NOT IN %s")
+    args = [SYSTEM_SCHEMAS]
+    databases = ENV.get('MYSQL_DATABASES', '').split()
+    if databases:
+        statement += " AND table_schema IN %s"
+        args.append(tuple(databases))
+    connection = connect()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(statement, args)
+            size = cursor.fetchone()[0]
+    finally:
+        connection.close()
+    return int(float(size or 0))
+
+
+def get_mongodb_source_size():
+    """Return the size of the MongoDB documents to back up, in bytes."""
+    from pymongo import MongoClient
+
+    options = {}
+    if ENV.get('MONGODB_USERNAME'):
+        options = dict(username=ENV['MONGODB_USERNAME'],
+                       password=ENV['MONGODB_PASSWORD'],
+                       authSource=ENV['MONGODB_AUTHENTICATION_DATABASE'])
+    client = MongoClient(host=ENV['MONGODB_HOST'],
+                         port=int(ENV['MONGODB_PORT']),
+                         serverSelectionTimeoutMS=10000, **options)
+    try:
+        databases = [database for database in get_mongodb_databases()
+                     if database] or [
+            database for database in client.list_database_names()
+            if database != 'local']
+        return sum(int(client[database].command('dbStats')['dataSize'])
+                   for database in databases)
+    finally:
+        client.close()
+
+
+def get_caddy_source_size():
+    """Return the size of the Caddy data to back up, in bytes.
+
+    The size is taken from the manifest of the last backup, so that the
+    Caddy data directory is only walked if there is none.
+    """
+    for manifest_file in (LAST_CADDY_MANIFEST, CADDY_MANIFEST):
+        manifest = read_manifest(manifest_file)
+        if manifest:
+            return get_total_size(manifest)
+    return get_size('caddy') if os.path.isdir('caddy') else 0
+
+
+def get_source_sizes(exclude):
+    sizes = {}
+    if 'mysql' not in exclude:
+        sizes['mysql'] = get_mysql_source_size()
+    if 'mongodb' not in exclude:
+        sizes['mongodb'] = get_mongodb_source_size()
+    if 'caddy' not in exclude:
+        sizes['caddy'] = get_caddy_source_size()
+    return sizes
+
+
+def measure_source_sizes(exclude):
+    """Return get_source_sizes(exclude), or None if the servers could
+    not be measured, which must not fail the backup."""
+    from pymongo.errors import PyMongoError
+    from pymysql.err import MySQLError
+
+    try:
+        return get_source_sizes(exclude)
+    except (MySQLError, PyMongoError, OSError) as e:
+        logger.warning(f"Could not measure the data to back up: {e}")
+        return None
+
+
+def get_preflight_check():
+    return bool(strtobool(ENV.get('PREFLIGHT_CHECK', 'True')))
+
+
+def get_preflight_margin():
+    return int(ENV.get('PREFLIGHT_MARGIN') or 20) / 100
+
+
+def is_s3_configured():
+    return all(name in ENV for name in S3_SETTINGS)
+
+
+def get_catalog_entries(upload):
+    """Return the entries of the backup catalog, newest first.
+
+    The catalog is only read for backups that are uploaded to S3, since
+    only those are recorded in it, and the S3 settings may be missing
+    otherwise.
+    """
+    if not (upload and is_s3_configured()):
+        return []
+    from catalog import read_catalog, sort_entries
+
+    try:
+        catalog = read_catalog(ENV['S3_BUCKET_NAME'])
+    except (ClientError, BotoCoreError) as e:
+        logger.warning(f"Could not read the backup catalog: {e}")
+        return []
+    return sort_entries(catalog['backups']) if catalog else []
+
+
+def estimate_backup(exclude, upload, source_sizes):
+    """Predict the size and duration of a backup of source_sizes, by
+    service, from the last backups in the catalog."""
+    from estimate import Estimate, get_history
+
+    ratio, throughput, history = get_history(get_catalog_entries(upload),
+                                             COMPRESSION.name)
+    pipelined_upload = bool(strtobool(ENV.get('S3_PIPELINED_UPLOAD',
+                                              'False')))
+    return Estimate(
+        source_sizes, ratio, throughput, history,
+        dumps_on_disk=not bool(strtobool(ENV.get('STREAM_DUMPS', 'False'))),
+        archive_on_disk=not (upload and (get_repository_mode() or
+                                         pipelined_upload)),
+        margin=get_preflight_margin(),
+    )
+
+
+def log_estimate(estimate):
+    from estimate import format_duration, format_volume_size
+
+    for service, size in estimate.source_sizes.items():
+        logger.info(f"{service}: {size} bytes of data")
+    if estimate.history:
+        logger.info(f"Compression ratio {estimate.ratio:.2f} and "
+                    f"throughput {estimate.throughput / 1e6:.1f} MB/s, "
+                    f"from the last {estimate.history} backups")
+    else:
+        logger.info("No backup in the catalog records its data size and "
+                    "duration, or the catalog is not read, so the archive "
+                    "is assumed to be as large as the data.")
+    logger.info(f"Predicted archive size: {estimate.archive_size} bytes")
+    if estimate.seconds is not None:
+        logger.info("Predicted duration: "
+                    f"{format_duration(estimate.seconds)}")
+    required = estimate.required_space
+    logger.info(f"Required disk space under {DUMP_DIRECTORY}: {required} "
+                "bytes")
+    logger.info("Recommended ephemeral volume size: "
+                f"tutor config save --set BACKUP_ESTIMATED_VOLUME_SIZE="
+                f"{format_volume_size(required)}")
+
+
+def preflight_check(estimate):
+    """Fail before dumping anything if the dump directory does not have
+    the disk space that the backup is predicted to take."""
+    free = shutil.disk_usage(DUMP_DIRECTORY).free
+    required = estimate.required_space
+    if required > free:
+        raise RuntimeError(
+            f"The backup is predicted to take {required} bytes under "
+            f"{DUMP_DIRECTORY}, but only {free} bytes are free. Make "
+            "more space available, for instance with a larger ephemeral "
+            "volume, or set PREFLIGHT_CHECK to False to skip this check.")
+    logger.info(f"Pre-flight check passed: {required} bytes required, "
+                f"{free} bytes free under {DUMP_DIRECTORY}.")
+
+
+def report_estimate(exclude, upload):
+    """Log the prediction of a backup, without backing up."""
+    log_estimate(estimate_backup(exclude, upload, get_source_sizes(exclude)))
+
+
+def backup(exclude, upload, incremental):
+    if incremental:
+        backup_binlogs(upload)
+        return
+
+    if upload:
+        abort_stale_upload()
+
+    binlog_file = None
+    if get_mysql_binlog_backup() and 'mysql' not in exclude:
+        # A retry keeps the binary log file of the first attempt, even
+        # if it dumps MySQL anew. Shipping some binary logs too many is
+        # harmless, while missing some is not.
+        binlog_file = ((STATE.get('binlog') or {}).get('file') or
+                       get_binlog_file())
+        STATE.save('binlog', file=binlog_file)
+
+    stream_dumps = bool(strtobool(ENV.get('STREAM_DUMPS', 'False')))
+    pipelined_upload = bool(strtobool(ENV.get('S3_PIPELINED_UPLOAD',
+                                              'False')))
+
+    # The repository compresses each chunk on its own, so the archive
+    # itself must not be compressed, or no two backups would share
+    # any chunks.
+    repository_mode = upload and get_repository_mode()
+    codec = CODECS['none'] if repository_mode else COMPRESSION
+
+    segmented = get_segmented_archive()
+    uploaded = STATE.get('uploaded')
+    written = None
+    if not (uploaded or repository_mode or (upload and pipelined_upload)):
+        written = get_written_archive()
+    writing = not (uploaded or written)
+    preflight = get_preflight_check()
+    source_sizes = None
+    if writing and preflight:
+        source_sizes = measure_source_sizes(exclude)
+    if source_sizes is not None:
+        prediction = estimate_backup(exclude, upload, source_sizes)
+        log_estimate(prediction)
+        preflight_check(prediction)
+
+    if uploaded or written:
+        write = None
+    elif stream_dumps:
+        # The dumps are written straight into the archive, so their
+        # time is part of the archive phase.
+        if segmented:
+            write = partial(write_segments, get_streamed_segments(exclude),
+                            codec=codec)
+        else:
+            write = partial(stream_archive, exclude, codec=codec)
+        write = partial(run_throttled, exclude, write)
+    else:
+        with METRICS.phase('dump') as phase:
+            paths = dump(exclude)
+            dump_size = get_dump_size(paths)
+            phase.add(bytes_out=dump_size)
+        METRICS.get('archive').add(bytes_in=dump_size)
+        if segmented:
+            write = partial(write_segments, get_segments(paths),
+                            codec=codec)
+        else:
+            write = partial(archive, paths, codec=codec)
+
+    if uploaded:
+        logger.info(f"{uploaded['key']} was uploaded by an earlier attempt "
+                    "of this job.")
+    elif repository_mode:
+        uploaded = write_to_repository(write)
+    elif upload and pipelined_upload:
+        uploaded = write_and_upload_to_s3(write)
+    else:
+        checksum, index_offset = written or write_tarfile(write)
+        if upload:
+            uploaded = upload_to_s3(checksum, index_offset)
+
+    if uploaded:
+        STATE.save('uploaded', **uploaded)
+        if writing and not preflight:
+            # Measured for the catalog only, once the Caddy manifest
+            # of this backup is there to take the size from.
+            source_sizes = measure_source_sizes(exclude)
+        update_catalog(uploaded, exclude, source_sizes)
+
+    if binlog_file:
+        write_binlog_position(binlog_file, upload)
+
+
 @click.command()
 @click.option(
     '--exclude',
-    type=click.Choice(['mysql', 'mongodb', 'caddy']),
+    type=click.Choice(SERVICES),
     multiple=True
 )
 @click.option('--upload', is_flag=True, help="Upload to S3")
-def main(exclude, upload):
+@click.option('--incremental', is_flag=True,
+              help="Only ship the MySQL binary logs written since the "
+                   "last full backup")
+@click.option('--prune', 'prune_backups', is_flag=True,
+              help="Delete the backups in S3 that the retention policy "
+                   "no longer keeps, instead of backing up")
+@click.option('--dry-run', is_flag=True,
+              help="With --prune, only report what would be deleted")
+@click.option('--estimate', is_flag=True,
+              help="Only predict the size and duration of a backup, and "
+                   "the disk space it needs")
+def main(exclude, upload, incremental, prune_backups, dry_run, estimate):
     loglevel = logging.INFO
     try:
         loglevel = getattr(logging, ENV['LOG_LEVEL'].upper())
@@ -231,21 +1733,21 @@ def main(exclude, upload):
     logger.addHandler(handler)
     logger.setLevel(loglevel)
 
-    paths = []
-    if 'mysql' not in exclude:
-        mysqldump()
-        paths.append(MYSQL_DUMPFILE)
-    if 'mongodb' not in exclude:
-        mongodump()
-        paths.append(MONGODB_DUMPDIR)
-    if 'caddy' not in exclude:
-        caddydump()
-        paths.append(CADDY_DUMPDIR)
+    if prune_backups:
+        # Pruning is not a backup, so it does not export backup metrics.
+        prune(dry_run)
+        return
 
-    archive(paths)
+    if estimate:
+        report_estimate(exclude, upload)
+        return
 
-    if upload:
-        upload_to_s3()
+    try:
+        backup(exclude, upload, incremental)
+        STATE.clear()
+        METRICS.succeeded = True
+    finally:
+        export_metrics()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,205 @@
+import json
+import random
+import time
+
+from botocore.exceptions import ClientError
+
+from compression import get_codec_for
+from s3_client import S3_CLIENT, get_recorded_checksum
+
+# The catalog is a single object in the bucket that lists every
+# backup version, so that listing backups takes one GET rather than a
+# scan of all object versions. Each backup job adds its entry once the
+# upload is verified. Since an S3 PUT replaces the whole object at
+# once, readers never see a partial catalog.
+#
+# The backup, incremental, and prune jobs can run at the same time, so
+# the catalog is only replaced if nobody else has replaced it since it
+# was read. Otherwise, the change is made again to the newer catalog.
+CATALOG_KEY = 'catalog.json'
+CATALOG_VERSION = 1
+CATALOG_ATTEMPTS = 5
+# S3 returns PreconditionFailed if the catalog has changed, and
+# ConditionalRequestConflict if it is being changed.
+CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict', '412',
+                  '409')
+
+BACKUP_PREFIX = 'backup.'
+MANIFEST_PREFIX = 'manifests/'
+
+
+def sort_entries(entries):
+    """Sort catalog entries newest first."""
+    return sorted(entries, key=lambda entry: (entry['date'],
+                                              entry['created']),
+                  reverse=True)
+
+
+def read_catalog_and_etag(bucket):
+    """Return the catalog stored in the bucket, and its ETag, or (None,
+    None) if there is no catalog yet."""
+    try:
+        response = S3_CLIENT.get_object(Bucket=bucket, Key=CATALOG_KEY)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None, None
+        raise e
+    return json.loads(response['Body'].read()), response['ETag']
+
+
+def read_catalog(bucket):
+    """Return the catalog stored in the bucket, or None if there is
+    none yet."""
+    return read_catalog_and_etag(bucket)[0]
+
+
+def write_catalog(bucket, catalog, etag=None):
+    """Store catalog, if the stored catalog still has etag, or, if etag
+    is None, if there is no catalog yet."""
+    catalog['backups'] = sort_entries(catalog['backups'])
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    S3_CLIENT.put_object(
+        Bucket=bucket,
+        Key=CATALOG_KEY,
+        Body=json.dumps(catalog, separators=(',', ':')).encode(),
+        ContentType='application/json',
+        **condition,
+    )
+
+
+def modify_catalog(bucket, modify):
+    """Store modify(catalog), where catalog is the catalog stored in the
+    bucket, or None if there is none, and return it.
+
+    If another job stores the catalog in the meantime, modify is applied
+    again to the catalog it stored. If modify returns None, nothing is
+    stored.
+    """
+    for attempt in range(CATALOG_ATTEMPTS):
+        catalog, etag = read_catalog_and_etag(bucket)
+        catalog = modify(catalog)
+        if catalog is None:
+            return None
+        try:
+            write_catalog(bucket, catalog, etag)
+            return catalog
+        except ClientError as e:
+            if (e.response['Error']['Code'] not in CONFLICT_CODES or
+                    attempt == CATALOG_ATTEMPTS - 1):
+                raise e
+        time.sleep(random.uniform(0, 2 ** attempt))
+
+
+def get_scanned_entry(bucket, item):
+    """Return the catalog entry for an object version found by a scan.
+
+    The services the backup contains are not recorded with the object,
+    so they are unknown, as is the codec of the chunks of a backup in
+    the chunk repository.
+    """
+    key = item['Key']
+    entry = {
+        'key': key,
+        'version_id': item['VersionId'],
+        'size': item['Size'],
+        'created': item['LastModified'].isoformat(timespec='seconds'),
+        'components': None,
+    }
+    if key.startswith(MANIFEST_PREFIX):
+        response = S3_CLIENT.get_object(Bucket=bucket, Key=key,
+                                        VersionId=item['VersionId'])
+        manifest = json.loads(response['Body'].read())
+        name = key[len(MANIFEST_PREFIX):]
+        entry.update({
+            'date': name[len(BACKUP_PREFIX):][:10],
+            'size': manifest['size'],
+            'checksum': manifest['checksum-md5'],
+            'codec': None,
+            'repository': True,
+        })
+        return entry
+
+    obj_metadata = S3_CLIENT.head_object(Bucket=bucket, Key=key,
+                                         VersionId=item['VersionId'])
+    entry.update({
+        'date': key[len(BACKUP_PREFIX):][:10],
+        'checksum': get_recorded_checksum(bucket, key, obj_metadata),
+        'codec': get_codec_for(key).name,
+    })
+    return entry
+
+
+def scan_backups(bucket):
+    """Yield the catalog entries of all backup versions in the bucket,
+    from a fully paginated listing of its object versions."""
+    paginator = S3_CLIENT.get_paginator('list_object_versions')
+    for prefix in (BACKUP_PREFIX, MANIFEST_PREFIX):
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get('Versions', []):
+                try:
+                    yield get_scanned_entry(bucket, item)
+                except ValueError:
+                    # Not a backup archive.
+                    continue
+
+
+def build_catalog(bucket, catalog=None):
+    """Return a catalog rebuilt from a scan of the bucket, keeping what
+    catalog knows about the versions that are still in the bucket."""
+    known = {
+        (entry['key'], entry['version_id']): entry
+        for entry in (catalog or {}).get('backups', [])
+    }
+    return {
+        'version': CATALOG_VERSION,
+        'backups': [
+            known.get((entry['key'], entry['version_id']), entry)
+            for entry in scan_backups(bucket)
+        ],
+    }
+
+
+def load_catalog(bucket, rebuild=False):
+    """Return the catalog of the bucket.
+
+    If there is no catalog yet, or if rebuild is set, rebuild it from a
+    scan of the bucket, and store it.
+    """
+    catalog = read_catalog(bucket)
+    if catalog is not None and not rebuild:
+        return catalog
+    return modify_catalog(bucket, lambda catalog: build_catalog(bucket,
+                                                                catalog))
+
+
+def add_to_catalog(bucket, entry):
+    """Add the entry of a verified upload to the catalog."""
+    def add(catalog):
+        if catalog is None:
+            catalog = build_catalog(bucket)
+        # Replace the entry for the same version that a rebuild of the
+        # catalog may have found, since it knows less.
+        catalog['backups'] = [
+            known for known in catalog['backups']
+            if (known['key'], known['version_id']) != (entry['key'],
+                                                       entry['version_id'])
+        ]
+        catalog['backups'].append(entry)
+        return catalog
+
+    return modify_catalog(bucket, add)
+
+
+def remove_from_catalog(bucket, removed):
+    """Remove the entries of the deleted versions, given as (key,
+    version_id) pairs, from the catalog, if there is one."""
+    def remove(catalog):
+        if catalog is None:
+            return None
+        catalog['backups'] = [
+            entry for entry in catalog['backups']
+            if (entry['key'], entry['version_id']) not in removed
+        ]
+        return catalog
+
+    return modify_catalog(bucket, remove)
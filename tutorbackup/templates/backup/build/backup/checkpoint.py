@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+
+from file_manifest import hash_file, walk
+
+# When the pod of a Kubernetes Job fails, the Job restarts it. The
+# retry picks up where the failed attempt left off, from a state file
+# on the /data volume, which records the phases completed so far, with
+# what is needed to trust their output, and the S3 multipart upload in
+# progress.
+#
+# Retries of a run are told apart from other runs by the name of the
+# Kubernetes Job, which the pod template passes as JOB_NAME. Since the
+# pod template of a Job cannot change, every retry runs with the same
+# options. Without a job name, nothing is recorded or resumed.
+STATE_VERSION = 1
+
+
+def get_checksums(paths):
+    """Return the size and SHA-256 digest of every regular file at or
+    below the given paths, keyed by path."""
+    checksums = {}
+    for path in paths:
+        if os.path.isdir(path):
+            files = (file_path for file_path, _ in walk(path))
+        elif os.path.isfile(path):
+            files = [path]
+        else:
+            continue
+        for file_path in files:
+            checksums[file_path] = {'size': os.path.getsize(file_path),
+                                    'sha256': hash_file(file_path)}
+    return checksums
+
+
+def is_intact(checksums, paths):
+    """Return whether the files at or below paths are exactly those
+    recorded in checksums, with the same content."""
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            files.update(file_path for file_path, _ in walk(path))
+        elif os.path.isfile(path):
+            files.add(path)
+    if files != set(checksums):
+        return False
+    # Compare the sizes first, which is cheap.
+    if any(os.path.getsize(path) != checksums[path]['size']
+           for path in files):
+        return False
+    return all(hash_file(path) == checksums[path]['sha256']
+               for path in files)
+
+
+class JobState:
+    """The phases that a run of a job has completed, stored in the JSON
+    file at path.
+
+    run identifies the run. The state that any other run left behind is
+    kept in stale, so that what it left unfinished can be cleaned up,
+    and is replaced on the first save. If run is empty, nothing is
+    resumed or saved.
+    """
+
+    def __init__(self, path, run):
+        self.path = path
+        self.run = run
+        self.phases = {}
+        self.stale = None
+        self.lock = threading.Lock()
+        if not run:
+            return
+        state = self.read()
+        if state is None:
+            return
+        if (state.get('version'), state.get('run')) == (STATE_VERSION, run):
+            self.phases = state['phases']
+        else:
+            self.stale = state
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def get(self, phase):
+        """Return what was recorded about phase, or None if it is not
+        recorded."""
+        return self.phases.get(phase)
+
+    def done(self, phase):
+        return phase in self.phases
+
+    def get_stale(self, phase):
+        """Return what a stale state recorded about phase, or None."""
+        return (self.stale or {}).get('phases', {}).get(phase)
+
+    def save(self, phase, **info):
+        """Record phase, along with info."""
+        if not self.run:
+            return
+        with self.lock:
+            self.phases[phase] = info
+            state = {'version': STATE_VERSION, 'run': self.run,
+                     'phases': self.phases}
+            # Replace the file in one go, so that a crash never leaves a
+            # partial state behind.
+            temp_path = f'{self.path}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            self.stale = None
+
+    def clear(self):
+        """Forget all phases, once the run has completed."""
+        if not self.run:
+            return
+        with self.lock:
+            self.phases = {}
+            self.stale = None
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,254 @@
+import io
+import os
+import shutil
+import tarfile
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from subprocess import PIPE, CalledProcessError, Popen
+
+# The tar stream is compressed and decompressed by external
+# processes, rather than by Python's tarfile module, so that we can
+# make use of the multi-threaded implementations of each codec.
+Codec = namedtuple('Codec', ['name', 'extension', 'default_level'])
+
+CODECS = {
+    'xz': Codec('xz', '.tar.xz', 6),
+    'zstd': Codec('zstd', '.tar.zst', 3),
+    'gzip': Codec('gzip', '.tar.gz', 6),
+    'none': Codec('none', '.tar', None),
+}
+
+DEFAULT_CODEC = 'xz'
+
+# The first bytes of a stream compressed with each codec. A stream that
+# starts with none of these is taken to be an uncompressed tar stream.
+MAGIC_NUMBERS = {
+    'xz': b'\xfd7zXZ\x00',
+    'zstd': b'\x28\xb5\x2f\xfd',
+    'gzip': b'\x1f\x8b',
+}
+
+READ_SIZE = 1024 * 1024
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unsupported compression codec '{name}'. "
+                         f"Choose one of: {', '.join(CODECS)}.")
+
+
+def get_codec_for(file_name):
+    """Return the codec matching the extension of file_name."""
+    for codec in CODECS.values():
+        if codec.extension != '.tar' and file_name.endswith(codec.extension):
+            return codec
+    if file_name.endswith('.tar'):
+        return CODECS['none']
+    raise ValueError(f"Cannot determine the compression codec "
+                     f"of {file_name}.")
+
+
+def detect_codec(data):
+    """Return the codec of the stream that starts with data."""
+    for name, magic in MAGIC_NUMBERS.items():
+        if data.startswith(magic):
+            return CODECS[name]
+    return CODECS['none']
+
+
+def get_cpu_count():
+    """Return the number of CPUs this process may run on.
+
+    Unlike os.cpu_count(), this leaves out the CPUs of the node that a
+    CPU set excludes. A CPU limit of the container is not a CPU set,
+    though, and is not seen here.
+    """
+    try:
+        return len(os.sched_getaffinity(0)) or 1
+    except AttributeError:
+        # sched_getaffinity() is only available on some platforms.
+        return os.cpu_count() or 1
+
+
+def get_threads(threads, auto=None):
+    """Return the number of threads to use, given as threads.
+
+    0 stands for one thread per CPU, and is replaced with the value of
+    get_cpu_count(), or with auto, for the codecs that pick their own
+    number of threads when given it.
+    """
+    threads = int(threads or 0)
+    if threads > 0:
+        return threads
+    return auto if auto is not None else get_cpu_count()
+
+
+def get_compress_command(codec, level=None, threads=0):
+    if level in (None, ''):
+        level = codec.default_level
+    level = int(level) if level is not None else None
+
+    # xz and zstd size their thread pools themselves with --threads=0.
+    if codec.name == 'xz':
+        return ['xz', '--stdout', f'-{level}',
+                f'--threads={get_threads(threads, auto=0)}']
+    if codec.name == 'zstd':
+        cmd = ['zstd', '--stdout', '--quiet', f'-{level}',
+               f'--threads={get_threads(threads, auto=0)}']
+        if level > 19:
+            cmd.append('--ultra')
+        return cmd
+    if codec.name == 'gzip':
+        if shutil.which('pigz'):
+            return ['pigz', '--stdout', f'-{level}',
+                    '-p', str(get_threads(threads))]
+        return ['gzip', '--stdout', f'-{level}']
+    return None
+
+
+def get_decompress_command(codec, threads=0):
+    threads = get_threads(threads, auto=0)
+
+    if codec.name == 'xz':
+        return ['xz', '--decompress', '--stdout', f'--threads={threads}']
+    if codec.name == 'zstd':
+        return ['zstd', '--decompress', '--stdout', '--quiet']
+    if codec.name == 'gzip':
+        if shutil.which('pigz'):
+            return ['pigz', '--decompress', '--stdout']
+        return ['gzip', '--decompress', '--stdout']
+    return None
+
+
+def get_fileno(fileobj):
+    try:
+        return fileobj.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+
+
+class Pump(threading.Thread):
+    """Copy everything read from source into the file object target.
+
+    Once done, or if copying fails, the pipe end given as closing is
+    closed, so that the process on its other end sees the end of its
+    input, or a broken pipe, rather than blocking.
+    """
+
+    def __init__(self, source, target, closing):
+        super().__init__(daemon=True)
+        self.source = source
+        self.target = target
+        self.closing = closing
+        self.error = None
+
+    def run(self):
+        try:
+            shutil.copyfileobj(self.source, self.target, READ_SIZE)
+        except BrokenPipeError:
+            # The process on the other end went away. Its exit status
+            # tells why.
+            pass
+        except BaseException as e:
+            self.error = e
+        finally:
+            try:
+                self.closing.close()
+            except BrokenPipeError:
+                pass
+
+
+@contextmanager
+def create_archive(out, codec, level=None, threads=0):
+    """Open a tar stream for writing, compressed with codec into out.
+
+    out is a writable binary file object. If it is backed by a file
+    descriptor, the compressor writes to it directly.
+    """
+    cmd = get_compress_command(codec, level, threads)
+    if not cmd:
+        with tarfile.open(fileobj=out, mode='w|', bufsize=READ_SIZE) as tar:
+            yield tar
+        return
+
+    fileno = get_fileno(out)
+    process = Popen(cmd, stdin=PIPE,
+                    stdout=fileno if fileno is not None else PIPE)
+    pump = None
+    if fileno is None:
+        pump = Pump(process.stdout, out, closing=process.stdout)
+        pump.start()
+    try:
+        with tarfile.open(fileobj=process.stdin, mode='w|',
+                          bufsize=READ_SIZE) as tar:
+            yield tar
+    except BrokenPipeError:
+        # Report why the compressor went away, if we know.
+        if not (pump and pump.error):
+            raise
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = process.wait()
+        if pump:
+            pump.join()
+    if pump and pump.error:
+        raise pump.error
+    if returncode:
+        raise CalledProcessError(returncode, cmd)
+
+
+@contextmanager
+def open_archive(source, codec=None, threads=0):
+    """Open a tar stream for reading.
+
+    source is either a file name, or a readable binary file object.
+    Unless codec is given, it is determined from the file name.
+
+    The end-of-archive markers between the tar streams of a segmented
+    archive are skipped, so that all of its segments are read.
+    """
+    if isinstance(source, str):
+        codec = codec or get_codec_for(source)
+        with open(source, 'rb') as f:
+            with open_archive(f, codec, threads) as tar:
+                yield tar
+        return
+
+    cmd = get_decompress_command(codec, threads)
+    if not cmd:
+        with tarfile.open(fileobj=source, mode='r|', bufsize=READ_SIZE,
+                          ignore_zeros=True) as tar:
+            yield tar
+        return
+
+    fileno = get_fileno(source)
+    process = Popen(cmd,
+                    stdin=fileno if fileno is not None else PIPE,
+                    stdout=PIPE)
+    pump = None
+    if fileno is None:
+        pump = Pump(source, process.stdin, closing=process.stdin)
+        pump.start()
+    try:
+        with tarfile.open(fileobj=process.stdout, mode='r|',
+                          bufsize=READ_SIZE, ignore_zeros=True) as tar:
+            yield tar
+        # Drain any padding after the end-of-archive marker, so
+        # that the decompressor does not die of a broken pipe.
+        while process.stdout.read(READ_SIZE):
+            pass
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+        if pump:
+            pump.join()
+    if pump and pump.error:
+        raise pump.error
+    if returncode:
+        raise CalledProcessError(returncode, cmd)
@@ -0,0 +1,101 @@
+import math
+import statistics
+
+# A backup is estimated from the size of the data in the servers, and
+# from the catalog entries of the last backups, which record the size
+# of the data they were made from, and how long they took. Their
+# compression ratio, and their throughput, apply to the data to back
+# up now.
+#
+# How many of the last backups to take the ratio and throughput from.
+HISTORY_SIZE = 5
+# Without any backups to learn from, the archive is assumed to be as
+# large as the data.
+DEFAULT_RATIO = 1.0
+
+GIB = 1024 * 1024 * 1024
+
+
+def get_history(entries, codec, count=HISTORY_SIZE):
+    """Return the median compression ratio and throughput, in bytes per
+    second, of the newest count catalog entries made with codec, along
+    with the number of entries they were taken from.
+
+    Entries that do not record the size of their data, or their
+    duration, such as those of backups made before these were recorded,
+    are left out.
+    """
+    history = [entry for entry in entries
+               if entry.get('codec') == codec and
+               entry.get('source_size') and entry.get('seconds')][:count]
+    if not history:
+        return DEFAULT_RATIO, None, 0
+    ratio = statistics.median(entry['size'] / entry['source_size']
+                              for entry in history)
+    throughput = statistics.median(entry['source_size'] / entry['seconds']
+                                   for entry in history)
+    return ratio, throughput, len(history)
+
+
+class Estimate:
+    """The predicted size and duration of a backup, and the disk space
+    it needs under the dump directory.
+
+    The dumps are as large as the data in the servers, and only take
+    disk space when they are not streamed into the archive. The archive
+    only takes disk space when it is not uploaded as it is written.
+    margin is the fraction of space added on top, for the data that is
+    written while the backup runs, and for the error of the estimate.
+    """
+
+    def __init__(self, source_sizes, ratio, throughput=None, history=0,
+                 dumps_on_disk=True, archive_on_disk=True, margin=0.2):
+        self.source_sizes = source_sizes
+        self.ratio = ratio
+        self.throughput = throughput
+        self.history = history
+        self.dumps_on_disk = dumps_on_disk
+        self.archive_on_disk = archive_on_disk
+        self.margin = margin
+
+    @property
+    def source_size(self):
+        return sum(self.source_sizes.values())
+
+    @property
+    def archive_size(self):
+        return int(self.source_size * self.ratio)
+
+    @property
+    def seconds(self):
+        """The predicted duration of the job, or None if no backup has
+        recorded its throughput yet."""
+        if not self.throughput:
+            return None
+        return self.source_size / self.throughput
+
+    @property
+    def dump_size(self):
+        # The Caddy data is archived from where it is, and never dumped.
+        return sum(size for service, size in self.source_sizes.items()
+                   if service != 'caddy')
+
+    @property
+    def required_space(self):
+        required = 0
+        if self.dumps_on_disk:
+            required += self.dump_size
+        if self.archive_on_disk:
+            required += self.archive_size
+        return int(required * (1 + self.margin))
+
+
+def format_volume_size(size, minimum=1):
+    """Return size, in bytes, as a Kubernetes quantity in whole GiB."""
+    return f"{max(math.ceil(size / GIB), minimum)}Gi"
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s"
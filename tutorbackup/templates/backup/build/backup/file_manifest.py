@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import stat
+
+# A file manifest records the size, modification time, mode and
+# SHA-256 digest of every regular file below a directory, keyed by
+# its path relative to that directory. It lets a restore skip the
+# files that already have the right content, and tells the size of
+# the data without walking the directory again.
+MANIFEST_VERSION = 1
+
+READ_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(READ_SIZE):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def walk(directory):
+    """Yield the path and stat result of each regular file below
+    directory, in a stable order."""
+    with os.scandir(directory) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            yield entry.path, entry.stat(follow_symlinks=False)
+
+
+def build_manifest(directory, previous=None):
+    """Return the manifest of directory.
+
+    Files whose size and modification time match those recorded in the
+    previous manifest are not hashed again.
+    """
+    previous_files = (previous or {}).get('files', {})
+    files = {}
+    for path, st in walk(directory):
+        name = os.path.relpath(path, directory)
+        entry = {
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'mode': stat.S_IMODE(st.st_mode),
+        }
+        known = previous_files.get(name, {})
+        unchanged = (known.get('size'), known.get('mtime')) == (
+            entry['size'], entry['mtime'])
+        if unchanged:
+            entry['sha256'] = known['sha256']
+        else:
+            entry['sha256'] = hash_file(path)
+        files[name] = entry
+    return {'version': MANIFEST_VERSION, 'files': files}
+
+
+def get_total_size(manifest):
+    return sum(entry['size'] for entry in manifest['files'].values())
+
+
+def read_manifest(path):
+    """Return the manifest stored at path, or None if there is none."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def dump_manifest(manifest):
+    return json.dumps(manifest, sort_keys=True).encode()
+
+
+def write_manifest(manifest, path):
+    with open(path, 'wb') as f:
+        f.write(dump_manifest(manifest))
+
+
+def has_content(path, entry):
+    """Return whether the file at path has the content recorded in the
+    manifest entry."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    if not stat.S_ISREG(st.st_mode) or st.st_size != entry['size']:
+        return False
+    return hash_file(path) == entry['sha256']
@@ -0,0 +1,196 @@
+import json
+import os
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+# Each phase of a backup or restore job records its wall time, the CPU
+# time spent by the job and its child processes, and the number of
+# bytes read and written. CPU time is measured for the whole job, so
+# phases that run concurrently each count the CPU time of the others.
+METRIC_PREFIX = 'tutor_backup'
+
+MB = 1000 * 1000
+
+
+class Phase:
+
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+
+    def add(self, bytes_in=0, bytes_out=0):
+        with self.lock:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def throughput(self):
+        """Return the throughput of the phase in bytes per second.
+
+        This is based on the bytes written, or read if the phase wrote
+        nothing.
+        """
+        if not self.wall_time:
+            return 0.0
+        return (self.bytes_out or self.bytes_in) / self.wall_time
+
+    def as_dict(self):
+        return {
+            'phase': self.name,
+            'wall_seconds': round(self.wall_time, 3),
+            'cpu_seconds': round(self.cpu_time, 3),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'mb_per_second': round(self.throughput() / MB, 3),
+        }
+
+
+def get_cpu_time():
+    times = os.times()
+    return (times.user + times.system +
+            times.children_user + times.children_system)
+
+
+class Metrics:
+    """Collects the phases of a job, in the order they started."""
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.phases = {}
+        self.started = time.time()
+        self.succeeded = False
+
+    def get(self, name):
+        if name not in self.phases:
+            self.phases[name] = Phase(name)
+        return self.phases[name]
+
+    @contextmanager
+    def phase(self, name):
+        """Time the phase name for the duration of the context, and
+        yield it to count the bytes in and out."""
+        phase = self.get(name)
+        wall_start = time.monotonic()
+        cpu_start = get_cpu_time()
+        try:
+            yield phase
+        finally:
+            phase.wall_time += time.monotonic() - wall_start
+            phase.cpu_time += get_cpu_time() - cpu_start
+
+    def to_json(self):
+        return json.dumps({
+            'operation': self.operation,
+            'started': self.started,
+            'wall_seconds': round(time.time() - self.started, 3),
+            'succeeded': self.succeeded,
+            'phases': [phase.as_dict() for phase in self.phases.values()],
+        })
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        labels = f'operation="{self.operation}"'
+        lines = []
+
+        def add(name, kind, help_text, samples):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+            for sample_labels, value in samples:
+                lines.append(f"{METRIC_PREFIX}_{name}{{{sample_labels}}} "
+                             f"{value}")
+
+        def per_phase(attribute):
+            return [(f'{labels},phase="{phase.name}"', attribute(phase))
+                    for phase in self.phases.values()]
+
+        add('phase_duration_seconds', 'gauge',
+            "Wall time of the phase.",
+            per_phase(lambda phase: phase.wall_time))
+        add('phase_cpu_seconds', 'gauge',
+            "CPU time of the job and its child processes during the phase.",
+            per_phase(lambda phase: phase.cpu_time))
+        add('phase_bytes_in', 'gauge',
+            "Bytes read during the phase.",
+            per_phase(lambda phase: phase.bytes_in))
+        add('phase_bytes_out', 'gauge',
+            "Bytes written during the phase.",
+            per_phase(lambda phase: phase.bytes_out))
+        add('phase_throughput_bytes_per_second', 'gauge',
+            "Throughput of the phase.",
+            per_phase(lambda phase: phase.throughput()))
+        add('last_run_timestamp_seconds', 'gauge',
+            "Start time of the last run.",
+            [(labels, self.started)])
+        add('last_run_duration_seconds', 'gauge',
+            "Wall time of the last run.",
+            [(labels, time.time() - self.started)])
+        add('last_run_success', 'gauge',
+            "Whether the last run succeeded.",
+            [(labels, int(self.succeeded))])
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """Write the metrics to path, for the node exporter's textfile
+        collector. The file is replaced atomically."""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def push(self, url, timeout=30):
+        """Push the metrics to a Prometheus Pushgateway at url."""
+        request = urllib.request.Request(
+            f"{url.rstrip('/')}/metrics/job/{METRIC_PREFIX}"
+            f"/operation/{self.operation}",
+            data=self.to_prometheus().encode(),
+            method='PUT',
+            headers={'Content-Type': 'text/plain; version=0.0.4'},
+        )
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+
+
+class Progress:
+    """A callable for the Callback argument of boto3 transfers.
+
+    It counts the transferred bytes into phase, and every interval
+    seconds passes a progress message to report.
+    """
+
+    def __init__(self, phase, report, total=None, interval=30,
+                 direction='out'):
+        self.phase = phase
+        self.report = report
+        self.total = total
+        self.interval = interval
+        self.direction = direction
+        self.transferred = 0
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.lock = threading.Lock()
+
+    def __call__(self, bytes_amount):
+        if self.direction == 'out':
+            self.phase.add(bytes_out=bytes_amount)
+        else:
+            self.phase.add(bytes_in=bytes_amount)
+        with self.lock:
+            self.transferred += bytes_amount
+            now = time.monotonic()
+            if not self.interval or now - self.last_report < self.interval:
+                return
+            self.last_report = now
+            transferred = self.transferred
+        rate = transferred / max(now - self.started, 1e-9) / MB
+        if self.total:
+            percentage = 100 * transferred / self.total
+            self.report(f"{self.phase.name}: {transferred} of {self.total} "
+                        f"bytes ({percentage:.1f}%), {rate:.1f} MB/s")
+        else:
+            self.report(f"{self.phase.name}: {transferred} bytes, "
+                        f"{rate:.1f} MB/s")
@@ -0,0 +1,86 @@
+import re
+import sys
+import threading
+import time
+from subprocess import PIPE
+
+from streaming import ProcessInput
+
+# mongorestore logs, on stderr, when it starts and finishes restoring
+# each collection, along with the number of documents restored. The
+# time between the two gives the rate of each collection.
+STARTED_PATTERN = re.compile(
+    r'\trestoring (?:to )?(?:existing collection )?(\S+) (?:from|without) ')
+FINISHED_PATTERN = re.compile(
+    r'\tfinished restoring (\S+) \((\d+) documents?, (\d+) failures?\)')
+
+
+class RestoreReport:
+    """The documents restored, and the time taken, by collection, as
+    scanned from the logs of one or more mongorestore processes."""
+
+    def __init__(self):
+        self.started = {}
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    def add_line(self, line):
+        now = time.monotonic()
+        with self.lock:
+            if match := STARTED_PATTERN.search(line):
+                self.started.setdefault(match.group(1), now)
+            elif match := FINISHED_PATTERN.search(line):
+                collection = match.group(1)
+                start = self.started.pop(collection, now)
+                self.collections[collection] = (int(match.group(2)),
+                                                now - start)
+
+    def follow(self, stream):
+        """Pass the lines of stream on to stderr, and scan them, in a
+        thread of its own, which is returned."""
+        def run():
+            for line in iter(stream.readline, b''):
+                sys.stderr.buffer.write(line)
+                sys.stderr.flush()
+                self.add_line(line.decode(errors='replace'))
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def format(self):
+        column_width = 24
+        output = (f"{'Collection'.ljust(column_width)}  "
+                  f"{'Documents'.rjust(column_width)}  "
+                  f"{'Time (s)'.rjust(column_width)}  "
+                  f"{'Documents/s'.rjust(column_width)}\n")
+        for collection, (documents, seconds) in sorted(
+                self.collections.items()):
+            rate = documents / seconds if seconds else 0
+            output += (f"{collection.ljust(column_width)}  "
+                       f"{str(documents).rjust(column_width)}  "
+                       f"{seconds:{column_width}.1f}  "
+                       f"{rate:{column_width}.0f}\n")
+        return output
+
+
+class MongorestoreInput(ProcessInput):
+    """A ProcessInput for mongorestore, whose log is scanned into
+    report.
+
+    Closing it without writing anything suits a mongorestore that
+    reads a dump directory, rather than an archive on stdin.
+    """
+
+    def __init__(self, cmd, report):
+        super().__init__(cmd, stderr=PIPE)
+        self.follower = report.follow(self.process.stderr)
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.follower.join()
+
+    def abort(self):
+        super().abort()
+        self.follower.join()
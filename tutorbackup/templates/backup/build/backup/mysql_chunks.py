@@ -0,0 +1,434 @@
+import math
+import os
+import queue
+import re
+import threading
+from functools import partial
+from urllib.parse import quote
+
+import pymysql
+from pymysql.converters import conversions
+
+from processes import run_concurrently, wait_while_paused
+
+# A chunked MySQL dump is a directory holding:
+#
+#   metadata.json         the tables, their chunks and deferred indexes
+#   schema.sql            mysqldump --no-data output, without triggers
+#   system.sql            the data of the mysql system schema, if dumped
+#   data/<db>/<table>.<n>.sql
+#                         the rows of one primary key range of a table
+#   triggers.sql          the triggers, to create once the data is in
+#
+# Each data file can be loaded independently of the others, so the
+# restore can load them over several connections at once.
+METADATA_FILE = 'metadata.json'
+SCHEMA_FILE = 'schema.sql'
+SYSTEM_FILE = 'system.sql'
+TRIGGERS_FILE = 'triggers.sql'
+
+# Sent as the program_name connection attribute, which tells the
+# connections of the backup apart from those of other clients.
+PROGRAM_NAME = 'tutor-backup'
+
+SYSTEM_SCHEMAS = ('information_schema', 'performance_schema', 'sys')
+SYSTEM_DATABASE = 'mysql'
+
+INTEGER_TYPES = {'tinyint', 'smallint', 'mediumint', 'int', 'bigint'}
+NUMERIC_TYPES = INTEGER_TYPES | {'decimal', 'float', 'double', 'year'}
+BINARY_TYPES = {
+    'binary', 'varbinary', 'tinyblob', 'blob', 'mediumblob', 'longblob',
+    'bit', 'geometry', 'point', 'linestring', 'polygon', 'multipoint',
+    'multilinestring', 'multipolygon', 'geometrycollection',
+    'geomcollection',
+}
+
+# The size above which an INSERT statement is cut, well below the
+# --max-allowed-packet of the mysql client.
+STATEMENT_SIZE = 1024 * 1024
+FETCH_SIZE = 1000
+
+DATA_FILE_HEADER = (b"SET NAMES utf8mb4;\n"
+                    b"SET time_zone = '+00:00';\n"
+                    b"SET sql_mode = 'NO_AUTO_VALUE_ON_ZERO';\n"
+                    b"SET foreign_key_checks = 0;\n"
+                    b"SET unique_checks = 0;\n"
+                    b"SET autocommit = 0;\n")
+DATA_FILE_FOOTER = b"COMMIT;\n"
+
+# Encoders only: without decoders, PyMySQL returns every value as it
+# was sent by the server, which is what we write back.
+ENCODERS = {key: value for key, value in conversions.items()
+            if not isinstance(key, int)}
+
+
+def quote_identifier(name):
+    return '`' + name.replace('`', '``') + '`'
+
+
+def quote_table(database, table):
+    return f"{quote_identifier(database)}.{quote_identifier(table)}"
+
+
+def escape_bytes(value):
+    return (value.replace(b'\\', b'\\\\')
+                 .replace(b"'", b"\\'")
+                 .replace(b'\0', b'\\0')
+                 .replace(b'\n', b'\\n')
+                 .replace(b'\r', b'\\r')
+                 .replace(b'\x1a', b'\\Z'))
+
+
+def get_data_file(database, table, index):
+    return (f"data/{quote(database, safe='')}/"
+            f"{quote(table, safe='')}.{index:05d}.sql")
+
+
+def connect(use_unicode=True):
+    return pymysql.connect(
+        host=os.environ['MYSQL_HOST'],
+        port=int(os.environ['MYSQL_PORT']),
+        user=os.environ['MYSQL_ROOT_USERNAME'],
+        password=os.environ['MYSQL_ROOT_PASSWORD'],
+        charset='utf8mb4',
+        use_unicode=use_unicode,
+        conv=ENCODERS,
+        autocommit=True,
+        program_name=PROGRAM_NAME,
+    )
+
+
+def start_snapshot(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SET SESSION time_zone = '+00:00'")
+        cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL "
+                       "REPEATABLE READ")
+        cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+
+
+def get_binlog_position(connection):
+    """Return the current binary log file and position, or None if
+    binary logging is disabled."""
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute("SHOW BINARY LOG STATUS")
+        except pymysql.err.MySQLError:
+            # Before MySQL 8.2
+            cursor.execute("SHOW MASTER STATUS")
+        row = cursor.fetchone()
+    return {'file': row[0], 'position': int(row[1])} if row else None
+
+
+def get_tables(connection, databases=None):
+    """Return (database, table, estimated rows) for each base table,
+    largest first.
+
+    The mysql system schema is left out: it is small, and is dumped by
+    mysqldump into SYSTEM_FILE instead.
+    """
+    query = ("SELECT TABLE_SCHEMA, TABLE_NAME, TABLE_ROWS "
+             "FROM information_schema.TABLES "
+             "WHERE TABLE_TYPE = 'BASE TABLE' "
+             "AND TABLE_SCHEMA NOT IN %s")
+    args = [(*SYSTEM_SCHEMAS, SYSTEM_DATABASE)]
+    if databases:
+        query += " AND TABLE_SCHEMA IN %s"
+        args.append(tuple(databases))
+    with connection.cursor() as cursor:
+        cursor.execute(query, args)
+        tables = [(database, table, int(rows or 0))
+                  for database, table, rows in cursor.fetchall()]
+    return sorted(tables, key=lambda table: -table[2])
+
+
+def get_columns(connection, database, table):
+    """Return the (name, data type) of the columns to dump.
+
+    Generated columns are left out, since their values cannot be
+    inserted.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT COLUMN_NAME, DATA_TYPE, EXTRA "
+                       "FROM information_schema.COLUMNS "
+                       "WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s "
+                       "ORDER BY ORDINAL_POSITION",
+                       (database, table))
+        return [(name, data_type.lower())
+                for name, data_type, extra in cursor.fetchall()
+                if not re.search(r'\b(VIRTUAL|STORED) GENERATED\b',
+                                 extra or '', re.IGNORECASE)]
+
+
+def get_primary_key(connection, database, table):
+    """Return the (name, data type) of the first primary key column,
+    or None if the table has no primary key."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT s.COLUMN_NAME, c.DATA_TYPE "
+                       "FROM information_schema.STATISTICS s "
+                       "JOIN information_schema.COLUMNS c "
+                       "ON c.TABLE_SCHEMA = s.TABLE_SCHEMA "
+                       "AND c.TABLE_NAME = s.TABLE_NAME "
+                       "AND c.COLUMN_NAME = s.COLUMN_NAME "
+                       "WHERE s.TABLE_SCHEMA = %s AND s.TABLE_NAME = %s "
+                       "AND s.INDEX_NAME = 'PRIMARY' "
+                       "AND s.SEQ_IN_INDEX = 1",
+                       (database, table))
+        row = cursor.fetchone()
+    return (row[0], row[1].lower()) if row else None
+
+
+def get_foreign_key_columns(connection, databases=None):
+    """Return the column lists used on either side of a foreign key,
+    by (database, table)."""
+    query = ("SELECT CONSTRAINT_SCHEMA, CONSTRAINT_NAME, TABLE_SCHEMA, "
+             "TABLE_NAME, COLUMN_NAME, REFERENCED_TABLE_SCHEMA, "
+             "REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME "
+             "FROM information_schema.KEY_COLUMN_USAGE "
+             "WHERE REFERENCED_TABLE_NAME IS NOT NULL")
+    args = []
+    if databases:
+        query += " AND (TABLE_SCHEMA IN %s OR REFERENCED_TABLE_SCHEMA IN %s)"
+        args = [tuple(databases), tuple(databases)]
+    query += " ORDER BY ORDINAL_POSITION"
+
+    constraints = {}
+    with connection.cursor() as cursor:
+        cursor.execute(query, args)
+        for (constraint_schema, constraint_name, database, table, column,
+             referenced_database, referenced_table,
+             referenced_column) in cursor.fetchall():
+            constraint = constraints.setdefault(
+                (constraint_schema, constraint_name, database, table),
+                ((database, table), [], (referenced_database,
+                                         referenced_table), []))
+            constraint[1].append(column)
+            constraint[3].append(referenced_column)
+
+    columns = {}
+    for child, child_columns, parent, parent_columns in constraints.values():
+        columns.setdefault(child, []).append(child_columns)
+        columns.setdefault(parent, []).append(parent_columns)
+    return columns
+
+
+def get_auto_increment_column(connection, database, table):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+                       "WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s "
+                       "AND EXTRA LIKE '%%auto_increment%%'",
+                       (database, table))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def get_deferred_indexes(create_table, required_columns):
+    """Return the secondary indexes of a table that can be built after
+    its data has been loaded, as (name, definition) tuples.
+
+    create_table is the output of SHOW CREATE TABLE. Indexes that a
+    foreign key or an AUTO_INCREMENT column depend on must exist all
+    along, and so are never deferred. Neither are FULLTEXT and SPATIAL
+    indexes, since InnoDB can only add these one at a time.
+    """
+    indexes = []
+    for line in create_table.splitlines():
+        definition = line.strip().rstrip(',')
+        match = re.match(r'(UNIQUE )?KEY `((?:[^`]|``)+)` \((.*)\)',
+                         definition)
+        if not match:
+            continue
+        columns = [column.replace('``', '`') for column in
+                   re.findall(r'`((?:[^`]|``)+)`', match.group(3))]
+        if any(columns[:len(required)] == required
+               for required in required_columns):
+            continue
+        indexes.append((match.group(2).replace('``', '`'), definition))
+    return indexes
+
+
+def plan_chunks(connection, database, table, rows, chunk_rows):
+    """Split a table into primary key ranges of about chunk_rows rows.
+
+    Returns a list of WHERE conditions, or [None] for a single chunk
+    holding the whole table. Only tables with an integer primary key
+    are split.
+    """
+    primary_key = get_primary_key(connection, database, table)
+    if not primary_key or primary_key[1] not in INTEGER_TYPES:
+        return [None]
+    if rows <= chunk_rows:
+        return [None]
+
+    column = quote_identifier(primary_key[0])
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT MIN({column}), MAX({column}) "
+                       f"FROM {quote_table(database, table)}")
+        low, high = cursor.fetchone()
+    if low is None:
+        return [None]
+    low, high = int(low), int(high)
+
+    count = min(math.ceil(rows / chunk_rows), high - low + 1)
+    step = math.ceil((high - low + 1) / count)
+    bounds = [low + step * i for i in range(1, count)]
+    if not bounds:
+        return [None]
+
+    conditions = [f"{column} < {bounds[0]}"]
+    for start, end in zip(bounds, bounds[1:]):
+        conditions.append(f"{column} >= {start} AND {column} < {end}")
+    conditions.append(f"{column} >= {bounds[-1]}")
+    return conditions
+
+
+def dump_chunk(connection, chunk, out):
+    """Write the rows of one chunk to out as INSERT statements.
+
+    Returns the number of rows written.
+    """
+    database, table = chunk['database'], chunk['table']
+    columns = chunk['columns']
+    select = (f"SELECT {', '.join(quote_identifier(c) for c, _ in columns)} "
+              f"FROM {quote_table(database, table)}")
+    if chunk['where']:
+        select += f" WHERE {chunk['where']}"
+    if chunk['order_by']:
+        select += f" ORDER BY {quote_identifier(chunk['order_by'])}"
+
+    insert = (f"INSERT INTO {quote_table(database, table)} "
+              f"({', '.join(quote_identifier(c) for c, _ in columns)}) "
+              "VALUES\n").encode()
+    kinds = ['number' if data_type in NUMERIC_TYPES
+             else 'binary' if data_type in BINARY_TYPES
+             else 'string'
+             for _, data_type in columns]
+
+    out.write(DATA_FILE_HEADER)
+    row_count = 0
+    statement = []
+    statement_size = 0
+    with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+        cursor.execute(select)
+        while rows := cursor.fetchmany(FETCH_SIZE):
+            wait_while_paused()
+            for row in rows:
+                values = []
+                for value, kind in zip(row, kinds):
+                    if value is None:
+                        values.append(b'NULL')
+                    elif kind == 'number':
+                        values.append(value)
+                    elif kind == 'binary':
+                        values.append(b"_binary'%s'" % escape_bytes(value))
+                    else:
+                        values.append(b"'%s'" % escape_bytes(value))
+                values = b'(' + b','.join(values) + b')'
+
+                full = statement_size + len(values) > STATEMENT_SIZE
+                if statement and full:
+                    out.write(insert + b',\n'.join(statement) + b';\n')
+                    statement = []
+                    statement_size = 0
+                statement.append(values)
+                statement_size += len(values)
+                row_count += 1
+    if statement:
+        out.write(insert + b',\n'.join(statement) + b';\n')
+    out.write(DATA_FILE_FOOTER)
+    return row_count
+
+
+def dump_chunks(connection, chunks, open_output, stop):
+    """Dump chunks from the queue until it is empty."""
+    try:
+        while not stop.is_set():
+            try:
+                chunk = chunks.get_nowait()
+            except queue.Empty:
+                return
+            with open_output(chunk['file']) as out:
+                chunk['rows'] = dump_chunk(connection, chunk, out)
+    except BaseException:
+        stop.set()
+        raise
+
+
+def dump(open_output, databases=None, concurrency=4, chunk_rows=500000,
+         consistent=True):
+    """Dump the data of all tables in databases in chunks.
+
+    open_output(name) must return a writable binary file object for
+    the data file called name, usable as a context manager. All
+    connections read from the same snapshot, which is taken while
+    holding a global read lock if consistent is true. The binary log
+    position of the snapshot is then recorded in the metadata too.
+
+    Returns the metadata of the dump, without writing it.
+    """
+    concurrency = max(int(concurrency), 1)
+    binlog_position = None
+    coordinator = connect()
+    connections = [connect(use_unicode=False) for _ in range(concurrency)]
+    try:
+        with coordinator.cursor() as cursor:
+            if consistent:
+                cursor.execute("FLUSH TABLES WITH READ LOCK")
+                binlog_position = get_binlog_position(coordinator)
+            for connection in [coordinator, *connections]:
+                start_snapshot(connection)
+            if consistent:
+                cursor.execute("UNLOCK TABLES")
+
+        foreign_key_columns = get_foreign_key_columns(coordinator,
+                                                      databases)
+        tables = []
+        chunks = queue.SimpleQueue()
+        for database, table, rows in get_tables(coordinator, databases):
+            with coordinator.cursor() as cursor:
+                cursor.execute(
+                    f"SHOW CREATE TABLE {quote_table(database, table)}")
+                create_table = cursor.fetchone()[1]
+            required_columns = list(
+                foreign_key_columns.get((database, table), []))
+            auto_increment = get_auto_increment_column(coordinator,
+                                                       database, table)
+            if auto_increment:
+                required_columns.append([auto_increment])
+
+            primary_key = get_primary_key(coordinator, database, table)
+            columns = get_columns(coordinator, database, table)
+            table_chunks = []
+            conditions = plan_chunks(coordinator, database, table, rows,
+                                     chunk_rows)
+            for index, where in enumerate(conditions):
+                chunk = {
+                    'database': database,
+                    'table': table,
+                    'file': get_data_file(database, table, index),
+                    'columns': columns,
+                    'where': where,
+                    'order_by': primary_key[0] if primary_key else None,
+                }
+                table_chunks.append(chunk)
+                chunks.put(chunk)
+            tables.append({
+                'database': database,
+                'table': table,
+                'chunks': table_chunks,
+                'deferred_indexes': get_deferred_indexes(create_table,
+                                                         required_columns),
+            })
+
+        stop = threading.Event()
+        run_concurrently([partial(dump_chunks, connection, chunks,
+                                  open_output, stop)
+                          for connection in connections],
+                         concurrency)
+    finally:
+        for connection in [coordinator, *connections]:
+            connection.close()
+
+    for table in tables:
+        table['rows'] = sum(chunk['rows'] for chunk in table['chunks'])
+        table['chunks'] = [chunk['file'] for chunk in table['chunks']]
+    return {'binlog': binlog_position, 'tables': tables}
@@ -0,0 +1,212 @@
+import re
+import time
+
+from mysql_chunks import get_deferred_indexes, quote_table
+
+# A fast load replays mysqldump output with the session settings of a
+# bulk load into a fresh instance: foreign key and unique checks are
+# disabled, nothing is written to the binary log, and the rows are
+# inserted in transactions of about TRANSACTION_SIZE bytes, instead of
+# one transaction per INSERT statement.
+#
+# When the whole dump can be read before it is loaded, the secondary
+# indexes that no foreign key depends on are also left out of the
+# CREATE TABLE statements, and built once all the data is in.
+SESSION_SETTINGS = ("SET SESSION foreign_key_checks = 0, unique_checks = 0, "
+                    "sql_log_bin = 0")
+TRANSACTION_SIZE = 64 * 1024 * 1024
+
+# mysqldump writes every row of a table in extended INSERT statements,
+# each on a line of its own. Routines and triggers are written with
+# another delimiter, and a transaction is never committed among them.
+INSERT_PREFIX = b'INSERT INTO '
+DELIMITER_PREFIX = b'DELIMITER '
+ROW_SEPARATOR = b'),('
+USE_PATTERN = re.compile(rb'USE `((?:[^`]|``)+)`;')
+CREATE_TABLE_PATTERN = re.compile(rb'CREATE TABLE `((?:[^`]|``)+)` \(')
+FOREIGN_KEY_PATTERN = re.compile(
+    r'FOREIGN KEY \((.*?)\) REFERENCES '
+    r'(?:`((?:[^`]|``)+)`\.)?`((?:[^`]|``)+)` \((.*?)\)')
+COLUMN_PATTERN = re.compile(r'`((?:[^`]|``)+)`')
+AUTO_INCREMENT_PATTERN = re.compile(r'\s*`((?:[^`]|``)+)` .* AUTO_INCREMENT')
+
+
+def unquote_identifier(name):
+    return name.replace('``', '`')
+
+
+def get_columns(column_list):
+    return [unquote_identifier(column)
+            for column in COLUMN_PATTERN.findall(column_list)]
+
+
+class DumpLines:
+    """A writable file object that splits mysqldump output into lines,
+    and keeps track of the database they belong to.
+
+    Subclasses handle each line in handle(), and each complete CREATE
+    TABLE statement in handle_create_table().
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.database = None
+        self.create_table = None
+
+    def write(self, data):
+        self.buffer += data
+        start = 0
+        while (end := self.buffer.find(b'\n', start)) >= 0:
+            self.split_line(bytes(self.buffer[start:end + 1]))
+            start = end + 1
+        del self.buffer[:start]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self.split_line(bytes(self.buffer))
+            self.buffer.clear()
+        if self.create_table is not None:
+            # The output ends in the middle of a CREATE TABLE statement,
+            # which the server reports.
+            lines, self.create_table = self.create_table, None
+            for line in lines:
+                self.handle(line)
+
+    def split_line(self, line):
+        if self.create_table is not None:
+            self.create_table.append(line)
+            if line.startswith(b')'):
+                lines, self.create_table = self.create_table, None
+                self.handle_create_table(lines)
+            return
+        if line.startswith(b'CREATE TABLE `'):
+            self.create_table = [line]
+            return
+        if line.startswith(b'USE `'):
+            match = USE_PATTERN.match(line)
+            if match:
+                self.database = unquote_identifier(match.group(1).decode())
+        self.handle(line)
+
+    def handle(self, line):
+        pass
+
+    def handle_create_table(self, lines):
+        for line in lines:
+            self.handle(line)
+
+
+def get_table_name(lines):
+    match = CREATE_TABLE_PATTERN.match(lines[0])
+    return unquote_identifier(match.group(1).decode()) if match else None
+
+
+class ForeignKeyScanner(DumpLines):
+    """Collect the column lists used on either side of the foreign keys
+    of a mysqldump output file, by (database, table)."""
+
+    def __init__(self):
+        super().__init__()
+        self.columns = {}
+
+    def handle_create_table(self, lines):
+        table = get_table_name(lines)
+        for line in lines:
+            match = FOREIGN_KEY_PATTERN.search(line.decode(errors='replace'))
+            if not match:
+                continue
+            parent_database = match.group(2)
+            parent_database = (unquote_identifier(parent_database)
+                               if parent_database else self.database)
+            parent = (parent_database, unquote_identifier(match.group(3)))
+            self.columns.setdefault((self.database, table), []).append(
+                get_columns(match.group(1)))
+            self.columns.setdefault(parent, []).append(
+                get_columns(match.group(4)))
+
+
+class FastLoader(DumpLines):
+    """A writable file object that passes mysqldump output on to target,
+    a mysql client, for a fast load.
+
+    The statements are wrapped in transactions of about TRANSACTION_SIZE
+    bytes. If foreign_key_columns, as collected by ForeignKeyScanner, is
+    given, the secondary indexes that can be built later are left out
+    of each CREATE TABLE statement, and kept in deferred_indexes, by
+    table. Closing the loader commits the last transaction; building the
+    deferred indexes is up to the caller.
+    """
+
+    def __init__(self, target, foreign_key_columns=None):
+        super().__init__()
+        self.target = target
+        self.foreign_key_columns = foreign_key_columns
+        self.deferred_indexes = {}
+        self.rows = 0
+        self.bytes = 0
+        self.pending = 0
+        self.delimiter = b';'
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.target.write(b"SET autocommit = 0;\n")
+
+    def handle(self, line):
+        if line.startswith(DELIMITER_PREFIX):
+            self.delimiter = line[len(DELIMITER_PREFIX):].strip()
+        elif line.startswith(INSERT_PREFIX) and self.delimiter == b';':
+            if self.pending >= TRANSACTION_SIZE:
+                self.target.write(b"COMMIT;\n")
+                self.pending = 0
+            self.pending += len(line)
+            # Values that contain the separator are counted too, and so
+            # the count is an estimate.
+            self.rows += line.count(ROW_SEPARATOR) + 1
+        self.bytes += len(line)
+        self.target.write(line)
+
+    def get_deferred_indexes(self, table, create_table):
+        if self.foreign_key_columns is None or self.database is None:
+            return []
+        required_columns = list(self.foreign_key_columns.get(
+            (self.database, table), []))
+        for line in create_table.splitlines():
+            match = AUTO_INCREMENT_PATTERN.match(line)
+            if match:
+                required_columns.append([unquote_identifier(match.group(1))])
+        return get_deferred_indexes(create_table, required_columns)
+
+    def handle_create_table(self, lines):
+        table = get_table_name(lines)
+        create_table = b''.join(lines).decode(errors='surrogateescape')
+        indexes = self.get_deferred_indexes(table, create_table)
+        if not indexes:
+            super().handle_create_table(lines)
+            return
+        self.deferred_indexes[quote_table(self.database, table)] = indexes
+        deferred = {definition for _, definition in indexes}
+        definitions = [line.rstrip(b'\n').rstrip(b',')
+                       for line in lines[1:-1]
+                       if line.decode(errors='surrogateescape')
+                       .strip().rstrip(',') not in deferred]
+        for line in lines[:1]:
+            self.handle(line)
+        for index, line in enumerate(definitions):
+            separator = b',\n' if index < len(definitions) - 1 else b'\n'
+            self.handle(line + separator)
+        self.handle(lines[-1])
+
+    def elapsed(self):
+        return (self.end_time or time.monotonic()) - self.start_time
+
+    def close(self):
+        super().close()
+        self.target.write(b"COMMIT;\n")
+        self.target.close()
+        self.end_time = time.monotonic()
+
+    def abort(self):
+        self.target.abort()
@@ -0,0 +1,179 @@
+import concurrent.futures
+import os
+import signal
+import subprocess
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor
+from subprocess import DEVNULL, PIPE, CalledProcessError
+
+# Every process started through this module is tracked here, so that
+# we can stop all of them when one of several concurrent tasks fails,
+# instead of leaving orphaned dump processes behind.
+_processes = set()
+_lock = threading.Lock()
+_cancelled = threading.Event()
+
+# While the processes are paused, they are stopped with SIGSTOP, and
+# the work done in this process waits in wait_while_paused().
+_running = threading.Event()
+_running.set()
+_low_priority = False
+
+# How long to give a process to exit after SIGTERM, before SIGKILL.
+TERMINATE_TIMEOUT = 10
+
+# The niceness and best-effort I/O priority of processes after
+# lower_priority().
+LOW_NICENESS = 19
+LOW_IO_PRIORITY = 7
+
+
+class Cancelled(Exception):
+    pass
+
+
+def Popen(cmd, **kwargs):
+    """Start a process like subprocess.Popen, and keep track of it.
+
+    Each process gets its own process group, so that cancelling it
+    also stops any children of the shell it runs in.
+    """
+    with _lock:
+        if _cancelled.is_set():
+            raise Cancelled(f"Not starting '{cmd}', since the run "
+                            "has been cancelled.")
+        process = subprocess.Popen(cmd, start_new_session=True, **kwargs)
+        _processes.add(process)
+        if not _running.is_set():
+            os.killpg(process.pid, signal.SIGSTOP)
+        low_priority = _low_priority
+    if low_priority:
+        _lower_priority(process)
+    return process
+
+
+def wait(process):
+    returncode = process.wait()
+    with _lock:
+        _processes.discard(process)
+    return returncode
+
+
+def check_call(cmd, **kwargs):
+    """Run a command like subprocess.check_call, and keep track of it."""
+    process = Popen(cmd, **kwargs)
+    returncode = wait(process)
+    if returncode:
+        raise CalledProcessError(returncode, cmd)
+
+
+def check_output(cmd, **kwargs):
+    """Run a command like subprocess.check_output, and keep track of it."""
+    process = Popen(cmd, stdout=PIPE, **kwargs)
+    output, _ = process.communicate()
+    returncode = wait(process)
+    if returncode:
+        raise CalledProcessError(returncode, cmd, output)
+    return output
+
+
+def kill(process):
+    """Kill a process started through this module, and its children."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    wait(process)
+
+
+def _signal_all(signum):
+    with _lock:
+        processes = list(_processes)
+    for process in processes:
+        try:
+            os.killpg(process.pid, signum)
+        except ProcessLookupError:
+            continue
+
+
+def pause():
+    """Stop all running processes, and those started from now on, until
+    resume() is called."""
+    _running.clear()
+    _signal_all(signal.SIGSTOP)
+
+
+def resume():
+    _running.set()
+    _signal_all(signal.SIGCONT)
+
+
+def wait_while_paused():
+    """Wait for as long as the processes are paused."""
+    _running.wait()
+
+
+def _lower_priority(process):
+    try:
+        os.setpriority(os.PRIO_PGRP, process.pid, LOW_NICENESS)
+    except OSError:
+        pass
+    try:
+        subprocess.run(['ionice', '-c', '2', '-n', str(LOW_IO_PRIORITY),
+                        '-P', str(process.pid)],
+                       stdout=DEVNULL, stderr=DEVNULL)
+    except OSError:
+        pass
+
+
+def lower_priority():
+    """Lower the CPU and I/O priority of all running processes, and of
+    those started from now on."""
+    global _low_priority
+    with _lock:
+        _low_priority = True
+        processes = list(_processes)
+    for process in processes:
+        _lower_priority(process)
+
+
+def cancel():
+    """Stop all running processes, and refuse to start new ones."""
+    with _lock:
+        _cancelled.set()
+        processes = list(_processes)
+    for process in processes:
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            # A paused process only handles SIGTERM once it continues.
+            os.killpg(process.pid, signal.SIGCONT)
+        except ProcessLookupError:
+            continue
+    _running.set()
+    for process in processes:
+        try:
+            process.wait(TERMINATE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+
+
+def run_concurrently(tasks, max_workers=1):
+    """Run the given callables in up to max_workers threads.
+
+    If any of them fails, cancel all running processes and tasks that
+    have not yet started, and re-raise the first exception.
+    """
+    with ThreadPoolExecutor(max_workers=max(int(max_workers), 1)) as pool:
+        futures = [pool.submit(task) for task in tasks]
+        try:
+            done, _ = concurrent.futures.wait(futures,
+                                              return_when=FIRST_EXCEPTION)
+            for future in futures:
+                if future in done:
+                    future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            cancel()
+            raise
@@ -0,0 +1,359 @@
+import base64
+import gzip
+import hashlib
+import json
+import lzma
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import zstandard
+from fastcdc import fastcdc
+
+from s3_client import (DOWNLOAD, S3_CLIENT, UPLOAD, IntegrityError,
+                       get_max_concurrency, get_rate_limiter, read_body,
+                       throttle_body)
+
+# In repository mode, the uncompressed backup tar stream is cut into
+# content-defined chunks, which are stored under CHUNK_PREFIX in the
+# bucket, keyed by their SHA-256 digest. Unchanged content yields the
+# same chunks from one backup to the next, and so is only uploaded
+# once. Each backup is a manifest under MANIFEST_PREFIX, which lists
+# its chunks in order.
+CHUNK_PREFIX = 'chunks/'
+MANIFEST_PREFIX = 'manifests/'
+
+MIN_CHUNK_SIZE = 512 * 1024
+AVG_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+
+# How much of the stream is buffered before it is cut into chunks.
+WINDOW_SIZE = 64 * 1024 * 1024
+
+MANIFEST_VERSION = 1
+
+
+def get_chunk_key(digest):
+    return f"{CHUNK_PREFIX}{digest[:2]}/{digest}"
+
+
+def get_manifest_key(name):
+    return f"{MANIFEST_PREFIX}{name}.json"
+
+
+def compress(codec, data, level=None):
+    """Compress a single chunk with codec, in-process."""
+    if level in (None, ''):
+        level = codec.default_level
+    if codec.name == 'xz':
+        return lzma.compress(data, preset=int(level))
+    if codec.name == 'zstd':
+        return zstandard.ZstdCompressor(level=int(level)).compress(data)
+    if codec.name == 'gzip':
+        return gzip.compress(data, compresslevel=int(level))
+    return data
+
+
+def decompress(codec_name, data):
+    if codec_name == 'xz':
+        return lzma.decompress(data)
+    if codec_name == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec_name == 'gzip':
+        return gzip.decompress(data)
+    return data
+
+
+def list_chunks(bucket):
+    """Return the digests of all chunks stored in the bucket."""
+    digests = set()
+    paginator = S3_CLIENT.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=CHUNK_PREFIX):
+        for item in page.get('Contents', []):
+            digests.add(item['Key'].rpartition('/')[2])
+    return digests
+
+
+class ChunkStore:
+    """Uploads chunks that are not yet in the bucket.
+
+    Chunks are compressed and uploaded by up to max_concurrency
+    threads. At most twice that number of chunks are held in memory.
+
+    Use it as a context manager: leaving the context waits for all
+    uploads to finish. If given, callback is called with the compressed
+    size of each chunk once it has been uploaded. Chunks are sent no
+    faster than the upload bandwidth limit.
+    """
+
+    def __init__(self, bucket, codec, level=None, max_concurrency=None,
+                 callback=None):
+        self.bucket = bucket
+        self.codec = codec
+        self.level = level
+        self.callback = callback
+        max_concurrency = max_concurrency or get_max_concurrency(UPLOAD)
+        self.limiter = get_rate_limiter(UPLOAD)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.slots = threading.BoundedSemaphore(max_concurrency * 2)
+        self.lock = threading.Lock()
+        self.known = list_chunks(bucket)
+        self.uploading = set()
+        self.futures = []
+        self.new_chunks = 0
+        self.new_size = 0
+        self.stored_size = 0
+        self.reused_chunks = 0
+        self.reused_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            for future in self.futures:
+                future.cancel()
+        self.executor.shutdown()
+        if exc_type is None:
+            for future in self.futures:
+                future.result()
+
+    def add(self, digest, data):
+        with self.lock:
+            # A chunk that is being uploaded is reused too. If its upload
+            # fails, so does the backup, since its future is checked.
+            reused = digest in self.known or digest in self.uploading
+            if not reused:
+                self.uploading.add(digest)
+        if reused:
+            self.reused_chunks += 1
+            self.reused_size += len(data)
+            return
+        self.new_chunks += 1
+        self.new_size += len(data)
+
+        # Fail early if an upload has failed, and only forget the
+        # uploads that have succeeded.
+        pending = []
+        for future in self.futures:
+            if not future.done():
+                pending.append(future)
+            elif future.exception():
+                raise future.exception()
+        self.futures = pending
+
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self.upload, digest, data)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        self.futures.append(future)
+
+    def find_missing(self, chunks):
+        """Return the digests of chunks, as collected by a
+        ChunkingWriter, that are not in the bucket.
+
+        Chunks that were known when the store was opened, and reused,
+        may have been swept by a prune since.
+        """
+        if not self.reused_chunks:
+            return set()
+        return {digest for digest, _ in chunks} - list_chunks(self.bucket)
+
+    def upload(self, digest, data):
+        try:
+            body = compress(self.codec, data, self.level)
+            content_md5 = base64.b64encode(
+                hashlib.md5(body).digest()).decode()
+            S3_CLIENT.put_object(
+                Bucket=self.bucket,
+                Key=get_chunk_key(digest),
+                Body=throttle_body(body, self.limiter),
+                ContentMD5=content_md5,
+                Metadata={'compression': self.codec.name},
+            )
+        except BaseException:
+            # A later copy of the chunk is uploaded again.
+            with self.lock:
+                self.uploading.discard(digest)
+            raise
+        # Only a chunk that is stored is known.
+        with self.lock:
+            self.uploading.discard(digest)
+            self.known.add(digest)
+            self.stored_size += len(body)
+        if self.callback:
+            self.callback(len(body))
+
+
+class ChunkingWriter:
+    """A writable file object that cuts everything written into
+    content-defined chunks, and adds them to store.
+
+    The digests and sizes of the chunks, in order, are collected in
+    chunks. Closing it adds the last chunk.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.buffer = bytearray()
+        self.chunks = []
+        self.file_hash = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.file_hash.update(data)
+        self.size += len(data)
+        if len(self.buffer) >= WINDOW_SIZE:
+            self.cut(final=False)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.cut(final=True)
+
+    def cut(self, final):
+        data = bytes(self.buffer)
+        end = 0
+        for chunk in fastcdc(data, MIN_CHUNK_SIZE, AVG_CHUNK_SIZE,
+                             MAX_CHUNK_SIZE):
+            # Unless the stream has ended, the last chunk in the buffer
+            # may continue beyond it, so leave it for the next round.
+            if not final and chunk.offset + chunk.length == len(data):
+                break
+            chunk_data = data[chunk.offset:chunk.offset + chunk.length]
+            digest = hashlib.sha256(chunk_data).hexdigest()
+            self.store.add(digest, chunk_data)
+            self.chunks.append([digest, chunk.length])
+            end = chunk.offset + chunk.length
+        del self.buffer[:end]
+
+    def hexdigest(self):
+        return self.file_hash.hexdigest()
+
+
+def put_manifest(bucket, name, writer, metadata=None, index_offset=None):
+    """Store the manifest of a backup, and return the response.
+
+    For a segmented archive, index_offset is the offset of its index
+    segment.
+    """
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'size': writer.size,
+        'checksum-md5': writer.hexdigest(),
+        'chunks': writer.chunks,
+    }
+    if index_offset is not None:
+        manifest['index-offset'] = index_offset
+    return S3_CLIENT.put_object(
+        Bucket=bucket,
+        Key=get_manifest_key(name),
+        Body=json.dumps(manifest).encode(),
+        Metadata=metadata or {},
+    )
+
+
+def get_manifest(bucket, name, version_id=None):
+    kwargs = {'VersionId': version_id} if version_id else {}
+    response = S3_CLIENT.get_object(
+        Bucket=bucket,
+        Key=get_manifest_key(name),
+        **kwargs,
+    )
+    manifest = json.loads(response['Body'].read())
+    manifest['version-id'] = response.get('VersionId')
+    return manifest
+
+
+class ChunkReader:
+    """A readable file object that reassembles a backup from the chunks
+    listed in its manifest.
+
+    Chunks are fetched by up to max_concurrency threads, and returned
+    in order. Each chunk is checked against its digest. If given,
+    callback is called with the stored size of each chunk once it has
+    been fetched. Chunks are read no faster than the download bandwidth
+    limit.
+
+    To read only part of the backup, pass the offset of its first byte
+    as start, and the offset just past its last byte as end. Only the
+    chunks that overlap that range are fetched.
+    """
+
+    def __init__(self, bucket, manifest, max_concurrency=None,
+                 callback=None, start=0, end=None):
+        self.bucket = bucket
+        self.callback = callback
+        self.max_concurrency = (max_concurrency or
+                                get_max_concurrency(DOWNLOAD))
+        self.limiter = get_rate_limiter(DOWNLOAD)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        self.remaining = deque()
+        chunk_end = 0
+        for digest, size in manifest['chunks']:
+            chunk_start, chunk_end = chunk_end, chunk_end + size
+            if chunk_end <= start:
+                continue
+            if end is not None and chunk_start >= end:
+                break
+            # The part of the chunk within the range.
+            first = max(start - chunk_start, 0)
+            last = size if end is None else min(end - chunk_start, size)
+            self.remaining.append((digest, size, first, last))
+        self.pending = deque()
+        self.buffer = memoryview(b'')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown()
+
+    def get_chunk(self, digest, size, first, last):
+        response = S3_CLIENT.get_object(
+            Bucket=self.bucket,
+            Key=get_chunk_key(digest),
+        )
+        body = read_body(response['Body'], self.limiter)
+        if self.callback:
+            self.callback(len(body))
+        data = decompress(response['Metadata'].get('compression'), body)
+        if len(data) != size or hashlib.sha256(data).hexdigest() != digest:
+            raise IntegrityError(f"Chunk {digest} is corrupted.")
+        return data[first:last]
+
+    def schedule(self):
+        while self.remaining and len(self.pending) < self.max_concurrency * 2:
+            self.pending.append(
+                self.executor.submit(self.get_chunk,
+                                     *self.remaining.popleft()))
+
+    def read(self, size=-1):
+        chunks = []
+        remaining = size
+        while remaining:
+            if not self.buffer:
+                self.schedule()
+                if not self.pending:
+                    break
+                self.buffer = memoryview(self.pending.popleft().result())
+                self.schedule()
+            if remaining < 0:
+                take = len(self.buffer)
+            else:
+                take = min(remaining, len(self.buffer))
+                remaining -= take
+            chunks.append(self.buffer[:take])
+            self.buffer = self.buffer[take:]
+        return b''.join(chunks)
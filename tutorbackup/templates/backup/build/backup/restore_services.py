@@ -1,17 +1,38 @@
 #!/usr/bin/env python
 
+import io
+import json
 import logging
 import os
+import re
+import shlex
 import shutil
 import sys
-import tarfile
-from datetime import datetime
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import partial
+from glob import glob, iglob
 from pathlib import Path
-from subprocess import check_call
+from subprocess import PIPE, CalledProcessError
+from urllib.parse import unquote
 
 import click
 from botocore.exceptions import ClientError
 
+from checkpoint import JobState
+from compression import (CODECS, DEFAULT_CODEC, READ_SIZE, detect_codec,
+                         get_codec_for, get_cpu_count, open_archive)
+from file_manifest import get_total_size, has_content, read_manifest
+from metrics import MB, Metrics, Progress
+from mongodb_restore import MongorestoreInput, RestoreReport
+from processes import Popen, check_call, run_concurrently, wait
+from selection import (MySQLDatabaseFilter, Selection, get_databases,
+                       get_mongodb_namespaces, get_unselected_services,
+                       is_selected)
+from streaming import (HashingReader, HashingWriter, ProcessInput, find_parts,
+                       is_part_of, write_parts)
+
 try:
     from distutils.util import strtobool  # pre-3.12
 except ImportError:
@@ -19,14 +40,37 @@ except ImportError:
 
 ENV = os.environ
 
+SERVICES = ['mysql', 'mongodb', 'caddy']
+
 DUMP_DIRECTORY = '/data'
+BACKUP_DIRECTORY = os.path.join(DUMP_DIRECTORY, 'backup')
 
 MYSQL_DUMPFILE = os.path.join(DUMP_DIRECTORY, 'mysql_dump.sql')
+MYSQL_CHUNKDIR = os.path.join(DUMP_DIRECTORY, 'mysql_chunks')
+MYSQL_CHUNK_DATADIR = os.path.join(MYSQL_CHUNKDIR, 'data')
 MONGODB_DUMPDIR = os.path.join(DUMP_DIRECTORY, 'mongodb_dump')
+MONGODB_ARCHIVEDIR = os.path.join(DUMP_DIRECTORY, 'mongodb_archive')
 CADDY_DUMPDIR = os.path.join(DUMP_DIRECTORY, 'caddy')
+CADDY_MANIFEST = os.path.join(DUMP_DIRECTORY, 'caddy_manifest.json')
+
+# The persistent volume of the archive cache, if there is one.
+CACHE_DIRECTORY = '/cache'
+
+BINLOG_DIRECTORY = os.path.join(BACKUP_DIRECTORY, 'binlogs')
+BINLOG_PREFIX = 'binlogs/'
+BINLOG_POSITION_FILE = 'position.json'
+
+# Written by mysqldump --source-data=2 (or --master-data=2)
+BINLOG_POSITION_PATTERN = re.compile(
+    rb"(?:SOURCE|MASTER)_LOG_FILE='([^']+)', (?:SOURCE|MASTER)_LOG_POS=(\d+)")
 
 logger = logging.getLogger(__name__)
 
+METRICS = Metrics('restore')
+
+STATE = JobState(os.path.join(DUMP_DIRECTORY, 'restore_state.json'),
+                 ENV.get('JOB_NAME'))
+
 
 def get_size(dir_path):
     total_size = os.path.getsize(dir_path)
@@ -39,25 +83,77 @@ def get_size(dir_path):
     return total_size
 
 
-def restore_mysql():
+def get_dump_size(path):
+    """Return the size of the dump at path on disk, be it a directory,
+    a file, or the streamed parts of a file."""
+    if os.path.isdir(path):
+        return get_size(path)
+    if os.path.exists(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(part) for part in find_parts(path))
+
+
+def get_progress(phase, total=None):
+    """Return a callback that counts S3 transfers into phase, and logs
+    their progress."""
+    return Progress(phase, logger.info, total=total,
+                    interval=int(ENV.get('PROGRESS_INTERVAL') or 30),
+                    direction='in')
+
+
+def export_metrics():
+    """Print the metrics of this run as a JSON summary line, and export
+    them in the Prometheus format, if configured to."""
+    print(METRICS.to_json(), flush=True)
+    textfile = ENV.get('METRICS_TEXTFILE')
+    pushgateway_url = ENV.get('METRICS_PUSHGATEWAY_URL')
+    try:
+        if textfile:
+            METRICS.write_textfile(textfile)
+        if pushgateway_url:
+            METRICS.push(pushgateway_url)
+    except OSError as e:
+        # A metrics outage must not fail the restore.
+        logger.warning(f"Could not export metrics: {e}")
+
+
+def check_call_with_parts(cmd, parts):
+    """Run cmd, feeding the concatenated streamed parts to its stdin."""
+    process_input = ProcessInput(cmd)
+    try:
+        write_parts(parts, process_input)
+    except BaseException:
+        process_input.abort()
+        raise
+    process_input.close()
+
+
+def get_mysql_command(fast_load=False):
     user = ENV['MYSQL_ROOT_USERNAME']
     password = ENV['MYSQL_ROOT_PASSWORD']
     host = ENV['MYSQL_HOST']
     port = ENV['MYSQL_PORT']
-    flush_logs = bool(strtobool(ENV['MYSQL_FLUSH_LOGS']))
-    dump_file = MYSQL_DUMPFILE
 
-    logger.info(f"Restoring MySQL databases on {host}:{port} from {dump_file}")
-    mysql_cmd = ("mysql "
-                 f"--host={host} --port={port} "
-                 f"--user={user} --password={password}")
-    with open(dump_file, 'rb') as dump:
-        check_call(mysql_cmd,
-                   shell=True,
-                   stdin=dump,
-                   stdout=sys.stdout,
-                   stderr=sys.stderr)
-    logger.info("MySQL restored.")
+    cmd = ("mysql "
+           f"--host={host} --port={port} "
+           f"--user={user} --password={password}")
+    if fast_load:
+        from mysql_load import SESSION_SETTINGS
+
+        cmd += f" --init-command={shlex.quote(SESSION_SETTINGS)}"
+    return cmd
+
+
+def get_mysql_fast_restore():
+    return bool(strtobool(ENV.get('MYSQL_FAST_RESTORE', 'False')))
+
+
+def flush_mysql_logs():
+    user = ENV['MYSQL_ROOT_USERNAME']
+    password = ENV['MYSQL_ROOT_PASSWORD']
+    host = ENV['MYSQL_HOST']
+    port = ENV['MYSQL_PORT']
+    flush_logs = bool(strtobool(ENV['MYSQL_FLUSH_LOGS']))
 
     if flush_logs:
         logger.info(f"Flushing logs on {host}:{port}")
@@ -72,29 +168,589 @@ def restore_mysql():
         logger.info("Logs flushed.")
 
 
-def restore_mongodb():
+def copy_dump(file_name, out):
+    """Write a dump file, or its streamed parts, to the file object
+    out."""
+    if os.path.exists(file_name):
+        with open(file_name, 'rb') as dump:
+            shutil.copyfileobj(dump, out, READ_SIZE)
+    else:
+        write_parts(find_parts(file_name), out)
+
+
+def load_mysql_file_databases(file_name, databases, fast_load=False):
+    """Load only the statements of a mysqldump output file that concern
+    the given databases."""
+    sink = MySQLDatabaseFilter(ProcessInput(get_mysql_command(fast_load)),
+                               databases)
+    try:
+        copy_dump(file_name, sink)
+    except BaseException:
+        sink.abort()
+        raise
+    sink.close()
+    return sink.missing()
+
+
+def load_mysql_file(file_name, databases=(), fast_load=False):
+    """Load a mysqldump output file, or only the statements in it that
+    concern the given databases."""
+    if databases:
+        return load_mysql_file_databases(file_name, databases, fast_load)
+
+    mysql_cmd = get_mysql_command(fast_load)
+    if os.path.exists(file_name):
+        with open(file_name, 'rb') as dump:
+            check_call(mysql_cmd,
+                       shell=True,
+                       stdin=dump,
+                       stdout=sys.stdout,
+                       stderr=sys.stderr)
+    else:
+        # The backup was made with STREAM_DUMPS enabled.
+        check_call_with_parts(mysql_cmd, find_parts(file_name))
+
+
+def fast_load_mysql_file(file_name, databases=()):
+    """Load a mysqldump output file, or only the statements in it that
+    concern the given databases, in fast-load mode.
+
+    The file is read twice: first for the foreign keys of all tables,
+    and then to load it, without the secondary indexes that can be
+    deferred. These are built once all the data is in.
+    """
+    from mysql_load import ForeignKeyScanner
+
+    scanner = ForeignKeyScanner()
+    copy_dump(file_name, scanner)
+    scanner.close()
+
+    sink, loader = get_mysql_sink(databases, True, scanner.columns)
+    try:
+        copy_dump(file_name, sink)
+    except BaseException:
+        sink.abort()
+        raise
+    sink.close()
+    log_fast_load(loader)
+    add_deferred_indexes(loader.deferred_indexes, fast_load=True)
+    return sink.missing() if databases else None
+
+
+def get_mysql_sink(databases=(), fast_load=False, foreign_key_columns=None):
+    """Return a writable file object that loads mysqldump output, or
+    only the statements in it that concern the given databases.
+
+    Returns a (sink, loader) tuple. loader is the FastLoader that sink
+    feeds in fast-load mode, or None.
+    """
+    sink = ProcessInput(get_mysql_command(fast_load))
+    loader = None
+    if fast_load:
+        from mysql_load import FastLoader
+
+        sink = loader = FastLoader(sink, foreign_key_columns)
+    if databases:
+        sink = MySQLDatabaseFilter(sink, databases)
+    return sink, loader
+
+
+def log_fast_load(loader):
+    log_load_rate(loader.rows, loader.bytes, loader.elapsed(),
+                  estimate=True)
+
+
+def log_load_rate(rows, size, elapsed, estimate=False):
+    elapsed = max(elapsed, 0.001)
+    about = "about " if estimate else ""
+    logger.info(f"Loaded {about}{rows} rows, {size} bytes of MySQL data "
+                f"in {elapsed:.1f}s ({rows / elapsed:.0f} rows/s, "
+                f"{size / elapsed / MB:.2f} MB/s)")
+
+
+def run_mysql_statements(statements, fast_load=False):
+    process_input = ProcessInput(get_mysql_command(fast_load))
+    try:
+        process_input.write(statements.encode())
+    except BaseException:
+        process_input.abort()
+        raise
+    process_input.close()
+
+
+def get_mysql_restore_concurrency():
+    return int(ENV.get('MYSQL_RESTORE_CONCURRENCY') or 4)
+
+
+def add_deferred_indexes(deferred_indexes, fast_load=False):
+    """Build the secondary indexes of each table in deferred_indexes, a
+    dict of (name, definition) lists by quoted table name, with one
+    ALTER TABLE per table, over several connections at once."""
+    if not deferred_indexes:
+        return
+    logger.info("Building secondary indexes of "
+                f"{len(deferred_indexes)} tables")
+    start_time = time.monotonic()
+    tasks = []
+    for name, indexes in deferred_indexes.items():
+        adds = ", ".join(f"ADD {definition}" for _, definition in indexes)
+        tasks.append(partial(run_mysql_statements,
+                             "SET foreign_key_checks = 0;\n"
+                             f"ALTER TABLE {name} {adds};\n",
+                             fast_load))
+    run_concurrently(tasks, get_mysql_restore_concurrency())
+    logger.info("Built secondary indexes in "
+                f"{time.monotonic() - start_time:.1f}s")
+
+
+def restore_mysql_chunks(databases=(), fast_load=False):
+    """Restore a chunked MySQL dump, or only the given databases of it.
+
+    The data files are loaded over several connections at once, with
+    foreign key and unique checks disabled. Secondary indexes that
+    can be deferred are dropped from the empty tables first, and built
+    again once all the data is in, one ALTER TABLE per table.
+    """
+    from mysql_chunks import (METADATA_FILE, SCHEMA_FILE, SYSTEM_FILE,
+                              TRIGGERS_FILE, quote_identifier, quote_table)
+
+    dump_dir = MYSQL_CHUNKDIR
+    concurrency = get_mysql_restore_concurrency()
+
+    with open(os.path.join(dump_dir, METADATA_FILE)) as f:
+        tables = json.load(f)['tables']
+    if databases:
+        tables = [table for table in tables
+                  if table['database'] in databases]
+
+    logger.info("Creating MySQL schema")
+    missing = load_mysql_file(os.path.join(dump_dir, SCHEMA_FILE),
+                              databases, fast_load)
+    system_file = os.path.join(dump_dir, SYSTEM_FILE)
+    if os.path.exists(system_file) or find_parts(system_file):
+        load_mysql_file(system_file, databases, fast_load)
+
+    deferred = {quote_table(table['database'], table['table']):
+                table['deferred_indexes']
+                for table in tables if table['deferred_indexes']}
+    if deferred:
+        logger.info(f"Deferring secondary indexes of {len(deferred)} tables")
+        statements = "SET foreign_key_checks = 0;\n"
+        for name, indexes in deferred.items():
+            drops = ", ".join(f"DROP INDEX {quote_identifier(index)}"
+                              for index, _ in indexes)
+            statements += f"ALTER TABLE {name} {drops};\n"
+        run_mysql_statements(statements, fast_load)
+
+    chunks = [os.path.join(dump_dir, chunk)
+              for table in tables for chunk in table['chunks']]
+    logger.info(f"Loading {len(chunks)} chunks of MySQL table data "
+                f"over {concurrency} connections")
+    start_time = time.monotonic()
+    run_concurrently([partial(load_mysql_file, chunk, fast_load=fast_load)
+                      for chunk in chunks],
+                     concurrency)
+    log_load_rate(sum(table.get('rows', 0) for table in tables),
+                  sum(get_dump_size(chunk) for chunk in chunks),
+                  time.monotonic() - start_time)
+
+    add_deferred_indexes(deferred, fast_load)
+
+    load_mysql_file(os.path.join(dump_dir, TRIGGERS_FILE), databases,
+                    fast_load)
+    return missing
+
+
+def log_missing_databases(service, missing, kind='database'):
+    for database in sorted(missing or ()):
+        logger.warning(f"The {service} dump holds no {kind} "
+                       f"'{database}'.")
+
+
+def restore_mysql(selection=Selection()):
+    host = ENV['MYSQL_HOST']
+    port = ENV['MYSQL_PORT']
+    databases = selection.mysql_databases
+    if databases:
+        logger.info(f"Restoring only MySQL databases {', '.join(databases)}")
+    fast_load = get_mysql_fast_restore()
+    if fast_load:
+        logger.info("Restoring MySQL in fast-load mode")
+
+    if os.path.isdir(MYSQL_CHUNKDIR):
+        logger.info(f"Restoring MySQL databases on {host}:{port} "
+                    f"from {MYSQL_CHUNKDIR}")
+        missing = restore_mysql_chunks(databases, fast_load)
+    elif fast_load:
+        logger.info(f"Restoring MySQL databases on {host}:{port} "
+                    f"from {MYSQL_DUMPFILE}")
+        missing = fast_load_mysql_file(MYSQL_DUMPFILE, databases)
+    else:
+        logger.info(f"Restoring MySQL databases on {host}:{port} "
+                    f"from {MYSQL_DUMPFILE}")
+        missing = load_mysql_file(MYSQL_DUMPFILE, databases)
+    log_missing_databases('MySQL', missing)
+    logger.info("MySQL restored.")
+
+    flush_mysql_logs()
+
+
+def get_dump_binlog_position():
+    """Return the binary log file and position at which the MySQL dump
+    on disk was taken, or None if it was not recorded."""
+    from mysql_chunks import METADATA_FILE
+
+    if os.path.isdir(MYSQL_CHUNKDIR):
+        with open(os.path.join(MYSQL_CHUNKDIR, METADATA_FILE)) as f:
+            return json.load(f).get('binlog')
+
+    dump_file = MYSQL_DUMPFILE
+    if not os.path.exists(dump_file):
+        parts = find_parts(dump_file)
+        if not parts:
+            return None
+        dump_file = parts[0]
+    # The position is recorded near the top of the dump.
+    with open(dump_file, 'rb') as f:
+        match = BINLOG_POSITION_PATTERN.search(f.read(READ_SIZE))
+    if not match:
+        return None
+    return {'file': match.group(1).decode(),
+            'position': int(match.group(2))}
+
+
+def download_binlogs(start_file, until):
+    """Download the shipped binary logs from start_file on, up to the
+    first one that was shipped after the point in time until, which
+    holds the last events to replay."""
+    from s3_client import DOWNLOAD, S3_CLIENT, get_transfer_config
+
+    bucket = ENV['S3_BUCKET_NAME']
+    Path(BINLOG_DIRECTORY).mkdir(parents=True, exist_ok=True)
+
+    logger.info(f"Downloading binary logs, starting with {start_file}, "
+                f"up to {until}, from S3 bucket {bucket}")
+    # until is given in UTC.
+    until = until.replace(tzinfo=timezone.utc)
+    paginator = S3_CLIENT.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=BINLOG_PREFIX):
+        for item in page.get('Contents', []):
+            binlog = item['Key'][len(BINLOG_PREFIX):]
+            if binlog == BINLOG_POSITION_FILE or binlog < start_file:
+                continue
+            with METRICS.phase('download') as phase:
+                S3_CLIENT.download_file(
+                    bucket,
+                    item['Key'],
+                    os.path.join(BINLOG_DIRECTORY, binlog),
+                    Config=get_transfer_config(DOWNLOAD),
+                    Callback=get_progress(phase, item['Size']),
+                )
+            if item['LastModified'] > until:
+                # Binary logs are only shipped once they have been
+                # rotated, so the later ones hold no events before
+                # until.
+                return
+
+
+def replay_binlogs(until, download, database=None):
+    """Replay the shipped MySQL binary logs on top of the restored dump,
+    up to the point in time until, only for database if given."""
+    host = ENV['MYSQL_HOST']
+    port = ENV['MYSQL_PORT']
+
+    position = get_dump_binlog_position()
+    if not position:
+        raise RuntimeError(
+            "The MySQL dump does not record its binary log position, so "
+            "binary logs cannot be replayed on top of it. Make sure to "
+            "enable BACKUP_MYSQL_BINLOG_BACKUP and "
+            "BACKUP_MYSQL_SINGLE_TRANSACTION for full backups.")
+
+    if download:
+        download_binlogs(position['file'], until)
+    binlogs = sorted(binlog for binlog in os.listdir(BINLOG_DIRECTORY)
+                     if binlog >= position['file'])
+    if BINLOG_POSITION_FILE in binlogs:
+        binlogs.remove(BINLOG_POSITION_FILE)
+    if not binlogs or binlogs[0] != position['file']:
+        raise RuntimeError(
+            f"Binary log {position['file']}, in which the MySQL dump "
+            "was taken, has not been shipped.")
+
+    logger.info(f"Replaying MySQL binary logs on {host}:{port} from "
+                f"{position['file']}:{position['position']} up to {until}")
+    binlog_files = " ".join(
+        shlex.quote(os.path.join(BINLOG_DIRECTORY, binlog))
+        for binlog in binlogs)
+    mysqlbinlog_cmd = (f"mysqlbinlog --start-position={position['position']} "
+                       f"--stop-datetime='{until:%Y-%m-%d %H:%M:%S}' ")
+    if database:
+        mysqlbinlog_cmd += f"--database={shlex.quote(database)} "
+    mysqlbinlog_cmd += binlog_files
+    mysqlbinlog = Popen(mysqlbinlog_cmd,
+                        shell=True,
+                        stdout=PIPE,
+                        stderr=sys.stderr)
+    try:
+        check_call(get_mysql_command(),
+                   shell=True,
+                   stdin=mysqlbinlog.stdout,
+                   stdout=sys.stdout,
+                   stderr=sys.stderr)
+    finally:
+        mysqlbinlog.stdout.close()
+        returncode = wait(mysqlbinlog)
+    if returncode:
+        raise CalledProcessError(returncode, mysqlbinlog_cmd)
+    logger.info(f"Replayed {len(binlogs)} binary logs.")
+
+
+def get_mongorestore_concurrency():
+    return int(ENV.get('MONGORESTORE_CONCURRENCY') or 1)
+
+
+def get_mongorestore_parallelism(processes=1):
+    """Return the number of collections that each of processes
+    concurrent mongorestore processes restores in parallel, and the
+    number of insertion workers per collection."""
+    parallel_collections = int(
+        ENV.get('MONGORESTORE_PARALLEL_COLLECTIONS') or 0)
+    if parallel_collections <= 0:
+        # Share the CPU cores, which decode the dump, between the
+        # concurrent processes.
+        parallel_collections = max(get_cpu_count() // processes, 1)
+    insertion_workers = int(ENV.get('MONGORESTORE_INSERTION_WORKERS') or 0)
+    if insertion_workers <= 0:
+        # Keep every shard of the target cluster busy with inserts.
+        insertion_workers = max(
+            int(ENV.get('MONGORESTORE_CLUSTER_SIZE') or 1), 1)
+    return parallel_collections, insertion_workers
+
+
+def get_mongorestore_command(source, selection=Selection(), database=None,
+                             processes=1):
+    """Return the mongorestore command that restores the dump at source,
+    or only the given database of it, as one of processes concurrent
+    mongorestore processes."""
     host = ENV['MONGODB_HOST']
     port = ENV['MONGODB_PORT']
-    dump_dir = MONGODB_DUMPDIR
+    parallel_collections, insertion_workers = get_mongorestore_parallelism(
+        processes)
 
-    logger.info(
-        f"Restoring MongoDB databases on {host}:{port} from {dump_dir}")
+    # The additional options come after the tuning options, so that
+    # they take precedence.
     cmd = ("mongorestore "
            "--stopOnError --drop "
            f"--host={host} --port={port} "
+           f"--numParallelCollections={parallel_collections} "
+           f"--numInsertionWorkersPerCollection={insertion_workers} "
            f"{ENV['MONGORESTORE_ADDITIONAL_OPTIONS']} "
-           f"{dump_dir}"
+           f"{source}"
            )
+    namespaces = get_mongodb_namespaces(selection)
+    if database:
+        namespaces = [namespace for namespace in namespaces
+                      if namespace.split('.', 1)[0] == database]
+        namespaces = namespaces or [f"{database}.*"]
+    # mongorestore skips the other namespaces as it reads the dump, and
+    # only drops the collections it restores.
+    for namespace in namespaces:
+        cmd += f" --nsInclude={shlex.quote(namespace)}"
     try:
         cmd += (f" --username={ENV['MONGODB_USERNAME']} "
                 f"--password={ENV['MONGODB_PASSWORD']}")
     except KeyError:
         pass
 
-    check_call(cmd,
-               shell=True,
-               stdout=sys.stdout,
-               stderr=sys.stderr)
+    return cmd
+
+
+def get_mongorestore_archive_source(archive_name):
+    # A bare --archive option makes mongorestore read the archive
+    # stream from stdin.
+    if archive_name.endswith('.gz'):
+        return "--archive --gzip"
+    return "--archive"
+
+
+def is_mongodb_archive(path):
+    """Return whether path is a whole MongoDB archive file, as written
+    with MONGODUMP_ARCHIVE enabled."""
+    return path.endswith(('.archive', '.archive.gz'))
+
+
+def get_mongodb_archives():
+    """Return the names of the MongoDB archives on disk, be they whole
+    files or streamed parts."""
+    archives = set()
+    for path in glob(os.path.join(MONGODB_ARCHIVEDIR, '*.archive*')):
+        archive_name = path.rpartition('.')[0]
+        if is_part_of(path, archive_name):
+            archives.add(archive_name)
+        elif is_mongodb_archive(path):
+            archives.add(path)
+    return sorted(archives)
+
+
+def run_mongorestore(cmd, report, parts=()):
+    """Run mongorestore, feeding the concatenated streamed parts, if any,
+    to its stdin, and scan its log into report."""
+    process_input = MongorestoreInput(cmd, report)
+    try:
+        write_parts(parts, process_input)
+    except BaseException:
+        process_input.abort()
+        raise
+    process_input.close()
+
+
+def get_mongodb_dump_databases(dump_dir, selection=Selection()):
+    """Return the selected databases of a MongoDB dump directory, which
+    mongodump writes into a subdirectory each."""
+    return [database for database in sorted(os.listdir(dump_dir))
+            if os.path.isdir(os.path.join(dump_dir, database)) and
+            is_selected(selection, 'mongodb', database)]
+
+
+def get_mongodb_dump_namespaces(dump_dir):
+    """Return the databases of a MongoDB dump directory, mapped to the
+    collections that it holds of each, which mongodump writes a
+    metadata file for each."""
+    namespaces = {}
+    for database in get_mongodb_dump_databases(dump_dir):
+        namespaces[database] = {
+            unquote(name.rpartition('.metadata.json')[0])
+            for name in os.listdir(os.path.join(dump_dir, database))
+            if name.endswith(('.metadata.json', '.metadata.json.gz'))}
+    return namespaces
+
+
+def get_mongodb_archive_namespaces(archive_names):
+    """Return the databases that the MongoDB archives archive_names
+    hold, mapped to None, since the archives do not tell their
+    collections, or None if an archive holds all databases."""
+    databases = {get_member_database(archive_name)
+                 for archive_name in archive_names}
+    if None in databases:
+        return None
+    return dict.fromkeys(databases)
+
+
+def log_missing_mongodb(selection, namespaces, report):
+    """Warn of the MongoDB databases and collections that selection
+    selects, but which the dump does not hold.
+
+    namespaces maps the databases of the dump to their collections, or
+    to None if these are unknown, and is None if the databases are
+    unknown, too. What is unknown is taken from the collections that
+    mongorestore restored, as scanned into report.
+    """
+    restored = {}
+    for namespace in report.collections:
+        database, _, collection = namespace.partition('.')
+        restored.setdefault(database, set()).add(collection)
+    if namespaces is None:
+        namespaces = restored
+
+    missing_databases = {database
+                         for database in get_databases(selection, 'mongodb')
+                         if database not in namespaces}
+    missing_collections = set()
+    for namespace in selection.mongodb_collections:
+        database, _, collection = namespace.partition('.')
+        if database in missing_databases:
+            continue
+        collections = namespaces[database]
+        if collections is None:
+            collections = restored.get(database, set())
+        if collection not in collections:
+            missing_collections.add(namespace)
+    log_missing_databases('MongoDB', missing_databases)
+    log_missing_databases('MongoDB', missing_collections, 'collection')
+
+
+def restore_mongodb_directory(source, selection, database, report,
+                              processes):
+    host = ENV['MONGODB_HOST']
+    port = ENV['MONGODB_PORT']
+    if database:
+        logger.info(f"Restoring MongoDB database '{database}' "
+                    f"on {host}:{port} from {MONGODB_DUMPDIR}")
+    else:
+        logger.info(f"Restoring MongoDB databases on {host}:{port} "
+                    f"from {MONGODB_DUMPDIR}")
+    run_mongorestore(
+        get_mongorestore_command(source, selection, database, processes),
+        report)
+
+
+def restore_mongodb_archive(archive_name, selection, report, processes):
+    host = ENV['MONGODB_HOST']
+    port = ENV['MONGODB_PORT']
+    logger.info(f"Restoring MongoDB databases on {host}:{port} "
+                f"from {archive_name}")
+    source = get_mongorestore_archive_source(archive_name)
+    if os.path.exists(archive_name):
+        parts = [archive_name]
+    else:
+        parts = find_parts(archive_name)
+    run_mongorestore(
+        get_mongorestore_command(source, selection, processes=processes),
+        report, parts)
+
+
+def log_mongorestore_report(report):
+    """Log the documents restored, the time taken, and the rate of each
+    restored collection."""
+    if report.collections:
+        logger.info(f"MongoDB restore report:\n{report.format()}")
+
+
+def restore_mongodb(selection=Selection()):
+    """Restore MongoDB from a dump directory, or from the streamed
+    archives on disk.
+
+    Up to MONGORESTORE_CONCURRENCY databases are restored at once, by a
+    mongorestore process each.
+    """
+    dump_dir = MONGODB_DUMPDIR
+    namespaces = get_mongodb_namespaces(selection)
+    if namespaces:
+        logger.info(f"Restoring only MongoDB namespaces "
+                    f"{', '.join(namespaces)}")
+
+    concurrency = get_mongorestore_concurrency()
+    report = RestoreReport()
+    if os.path.isdir(dump_dir):
+        source = dump_dir
+        if next(iglob(os.path.join(dump_dir, '**', '*.gz'),
+                      recursive=True), None):
+            source += " --gzip"
+        databases = [None]
+        if concurrency > 1:
+            databases = get_mongodb_dump_databases(dump_dir, selection)
+        processes = max(min(concurrency, len(databases)), 1)
+        tasks = [partial(restore_mongodb_directory, source, selection,
+                         database, report, processes)
+                 for database in databases]
+        namespaces = get_mongodb_dump_namespaces(dump_dir)
+    else:
+        # The backup was made with STREAM_DUMPS or MONGODUMP_ARCHIVE
+        # enabled.
+        all_archive_names = get_mongodb_archives()
+        archive_names = [archive_name
+                         for archive_name in all_archive_names
+                         if is_selected(selection, 'mongodb',
+                                        get_member_database(archive_name))]
+        processes = max(min(concurrency, len(archive_names)), 1)
+        tasks = [partial(restore_mongodb_archive, archive_name, selection,
+                         report, processes)
+                 for archive_name in archive_names]
+        namespaces = get_mongodb_archive_namespaces(all_archive_names)
+    run_concurrently(tasks, concurrency)
+    log_mongorestore_report(report)
+    log_missing_mongodb(selection, namespaces, report)
 
     logger.info("MongoDB restored.")
 
@@ -102,30 +758,204 @@ def restore_mongodb():
 def restore_caddy():
     dump_dir = CADDY_DUMPDIR
     caddy_dir = 'caddy'
-    logger.info(f"Copying Caddy data from {dump_dir}")
-    shutil.copytree(dump_dir, caddy_dir, dirs_exist_ok=True)
+    manifest = read_manifest(CADDY_MANIFEST)
+    if manifest is None:
+        # Backups made before the manifest was introduced.
+        logger.info(f"Copying Caddy data from {dump_dir}")
+        shutil.copytree(dump_dir, caddy_dir, dirs_exist_ok=True)
+        total_size = get_size(caddy_dir)
+        logger.info(f"Complete. {caddy_dir} total size {total_size} bytes.")
+        return
+
+    logger.info(f"Copying changed Caddy data files from {dump_dir}")
+    copied = 0
+    for name, entry in manifest['files'].items():
+        target = os.path.join(caddy_dir, name)
+        if has_content(target, entry):
+            continue
+        Path(target).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(os.path.join(dump_dir, name), target)
+        copied += 1
+    log_caddy_restore(manifest, copied)
+
 
-    total_size = get_size(caddy_dir)
-    logger.info(f"Complete. {caddy_dir} total size {total_size} bytes.")
+def log_caddy_restore(manifest, copied):
+    unchanged = len(manifest['files']) - copied
+    logger.info(f"Complete. Restored {copied} Caddy data files, "
+                f"{unchanged} were unchanged. caddy total size "
+                f"{get_total_size(manifest)} bytes.")
 
 
-def extract(file_name):
+def get_member_database(path):
+    """Return the database whose dump a member of the backup archive is
+    part of, or None if the member is not specific to any database."""
+    if path.startswith(MYSQL_CHUNK_DATADIR + '/'):
+        return unquote(path[len(MYSQL_CHUNK_DATADIR) + 1:].split('/')[0])
+    if path.startswith(MONGODB_DUMPDIR + '/'):
+        return path[len(MONGODB_DUMPDIR) + 1:].split('/')[0]
+    if path.startswith(MONGODB_ARCHIVEDIR + '/'):
+        # See get_mongodb_archive() in backup_services.py.
+        database = os.path.basename(path).partition('.archive')[0]
+        if database != 'all-databases':
+            return database
+    return None
+
+
+def is_member_selected(path, exclude, selection):
+    service, _ = classify_member(path)
+    if service is None:
+        return True
+    return (service not in exclude and
+            is_selected(selection, service, get_member_database(path)))
+
+
+def extract_members(tar, exclude=(), selection=Selection()):
+    """Extract the members of tar that belong to the services not
+    excluded, and to the databases selected of them."""
+    for member in tar:
+        if is_member_selected('/' + member.name, exclude, selection):
+            tar.extract(member)
+
+
+def extract(file_name, exclude=(), selection=Selection()):
     out_dir = DUMP_DIRECTORY
 
     logger.info(f"Extracting archive {file_name} to {out_dir}")
-    try:
-        with tarfile.open(file_name, "r:xz") as tar:
-            tar.extractall()
-    except FileNotFoundError as e:
-        logger.exception(e, exc_info=True)
-        raise e
+    with METRICS.phase('extract') as phase:
+        try:
+            if not restore_segments_from_file(file_name, exclude, False,
+                                              selection):
+                with open_archive(
+                        file_name,
+                        threads=ENV.get('COMPRESSION_THREADS')) as tar:
+                    extract_members(tar, exclude, selection)
+        except FileNotFoundError as e:
+            logger.exception(e, exc_info=True)
+            raise e
 
-    size = get_size(out_dir)
+        size = get_size(out_dir)
+        phase.add(bytes_in=os.path.getsize(file_name), bytes_out=size)
     logger.info(f"Complete. {out_dir} is {size} bytes.")
 
 
+def is_downloaded(file_name, version_id):
+    """Return whether an earlier attempt of this run has downloaded and
+    verified version_id of the backup as file_name."""
+    recorded = STATE.get('download') or {}
+    if not (recorded.get('verified') and
+            (recorded['file'], recorded['version_id']) == (file_name,
+                                                           version_id)):
+        return False
+    try:
+        if os.path.getsize(file_name) != recorded['size']:
+            return False
+    except FileNotFoundError:
+        return False
+    logger.info(f"Reusing {file_name}, downloaded and verified by an "
+                "earlier attempt of this job.")
+    return True
+
+
+@contextmanager
+def open_download(file_name, version_id):
+    """Open file_name to download version_id of the backup into, and
+    yield a HashingWriter over it.
+
+    If an earlier attempt of this run started to download the same
+    version, what it downloaded is kept, and counted as written, so that
+    the download can go on from the size of the HashingWriter.
+    """
+    recorded = STATE.get('download') or {}
+    resume = ((recorded.get('file'), recorded.get('version_id')) ==
+              (file_name, version_id) and os.path.exists(file_name))
+    STATE.save('download', file=file_name, version_id=version_id,
+               verified=False)
+    if not resume:
+        with open(file_name, 'wb') as f:
+            yield HashingWriter(f)
+        return
+
+    with open(file_name, 'rb') as f:
+        downloaded = HashingReader(f)
+        while downloaded.read(READ_SIZE):
+            pass
+    logger.info(f"Resuming the download of {file_name} after "
+                f"{downloaded.size} bytes, downloaded by an earlier "
+                "attempt of this job.")
+    with open(file_name, 'ab') as f:
+        out = HashingWriter(f)
+        out.file_hash, out.size = downloaded.file_hash, downloaded.size
+        yield out
+
+
+def head_backup(bucket, key, version_id=None):
+    from s3_client import S3_CLIENT
+
+    # boto3.client.head_object will break if empty string or None values
+    # are passed as the VersionId argument. So add that function argument
+    # only if a version ID is given.
+    if version_id:
+        return S3_CLIENT.head_object(
+            Bucket=bucket,
+            Key=key,
+            VersionId=version_id,
+        )
+    return S3_CLIENT.head_object(
+        Bucket=bucket,
+        Key=key,
+    )
+
+
+def get_archive_cache():
+    """Return the cache of downloaded archives, or None if there is
+    none."""
+    from archive_cache import ArchiveCache, parse_size
+
+    max_size = parse_size(ENV.get('RESTORE_CACHE_SIZE') or 0)
+    if not max_size:
+        return None
+    if not os.path.isdir(CACHE_DIRECTORY):
+        logger.warning(f"RESTORE_CACHE_SIZE is set, but {CACHE_DIRECTORY} "
+                       "does not exist. Downloaded archives are not "
+                       "cached.")
+        return None
+    return ArchiveCache(CACHE_DIRECTORY, max_size)
+
+
+def get_cached_archive(cache, file_name, obj_metadata, checksum):
+    path = cache.get(file_name, obj_metadata['VersionId'], checksum,
+                     obj_metadata['ContentLength'])
+    if path:
+        logger.info(f"Restoring from {path}, cached by an earlier restore "
+                    f"of VersionId='{obj_metadata['VersionId']}' with "
+                    f"checksum '{checksum}'.")
+    return path
+
+
+def add_to_cache(cache, file_name, version_id, checksum):
+    """Move the verified download file_name into cache, and return where
+    it is now."""
+    try:
+        path = cache.add(file_name, version_id, checksum, logger.info)
+    except OSError as e:
+        # The download can still be restored from where it is.
+        logger.warning(f"Could not add {file_name} to the archive cache: "
+                       f"{e}")
+        return file_name
+    if path is None:
+        logger.info(f"{file_name} is larger than the archive cache, and "
+                    "is not cached.")
+        return file_name
+    logger.info(f"Cached {file_name} as {path}.")
+    return path
+
+
 def download_from_s3(file_name, version_id=None):
-    from s3_client import S3_CLIENT, IntegrityError, calculate_checksum
+    """Download and verify a backup, and return the path of the archive
+    to restore from, which is file_name, unless the archive is cached.
+    """
+    from s3_client import (IntegrityError, ParallelDownloadReader,
+                           get_recorded_checksum)
 
     # Create the subdirectories to the tar file
     outfile_path = os.path.dirname(file_name)
@@ -133,31 +963,16 @@ def download_from_s3(file_name, version_id=None):
         Path(outfile_path).mkdir(parents=True, exist_ok=True)
 
     bucket = ENV['S3_BUCKET_NAME']
+    key = os.path.basename(file_name)
 
-    logger.info(f"Downloading {file_name} from S3 bucket {bucket}")
-    try:
-        S3_CLIENT.download_file(
-            bucket,
-            os.path.basename(file_name),
-            file_name,
-            ExtraArgs={'VersionId': version_id} if version_id else None,
-        )
+    # A retry downloads the version that the first attempt chose, even if
+    # a newer one has been uploaded since.
+    recorded = STATE.get('download') or {}
+    if not version_id and recorded.get('file') == file_name:
+        version_id = recorded['version_id']
 
-        logger.info("Checking downloaded file's integrity ...")
-        # boto3.client.head_object will break if empty string or None values
-        # are passed as the VersionId argument. So add that function argument
-        # only if a version ID is given.
-        if version_id:
-            obj_metadata = S3_CLIENT.head_object(
-                Bucket=bucket,
-                Key=os.path.basename(file_name),
-                VersionId=version_id,
-            )
-        else:
-            obj_metadata = S3_CLIENT.head_object(
-                Bucket=bucket,
-                Key=os.path.basename(file_name),
-            )
+    try:
+        obj_metadata = head_backup(bucket, key, version_id)
 
         received_version_id = obj_metadata['VersionId']
         if version_id:
@@ -165,17 +980,60 @@ def download_from_s3(file_name, version_id=None):
         else:
             version_id_correct = True
 
-        received_checksum = obj_metadata['Metadata']['checksum-md5']
-        calculated_checksum = calculate_checksum(file_name)
+        # Calculate the checksum while the download is being written to
+        # disk, rather than reading the file back afterwards. Pin the
+        # version we just looked at, in case a new backup is uploaded
+        # in the meantime.
+        # A cached archive is known to be verified, and the metadata
+        # fetched above is enough to tell that it is the same version.
+        cache = get_archive_cache()
+        if cache:
+            recorded_checksum = get_recorded_checksum(bucket, key,
+                                                      obj_metadata)
+            cached = get_cached_archive(cache, file_name, obj_metadata,
+                                        recorded_checksum)
+            if cached:
+                return cached
+        if is_downloaded(file_name, received_version_id):
+            if cache:
+                return add_to_cache(cache, file_name, received_version_id,
+                                    recorded_checksum)
+            return file_name
+        logger.info(f"Downloading {file_name} from S3 bucket {bucket}")
+        with METRICS.phase('download') as phase:
+            with open_download(file_name, received_version_id) as out:
+                with ParallelDownloadReader(
+                        bucket,
+                        key,
+                        obj_metadata['ContentLength'],
+                        version_id=received_version_id,
+                        callback=get_progress(
+                            phase, obj_metadata['ContentLength']),
+                        start=out.size) as reader:
+                    shutil.copyfileobj(reader, out, READ_SIZE)
+            phase.add(bytes_out=out.size)
+
+        logger.info("Checking downloaded file's integrity ...")
+        with METRICS.phase('verify'):
+            received_checksum = get_recorded_checksum(
+                bucket, key, obj_metadata)
+        calculated_checksum = out.hexdigest()
         checksum_correct = (received_checksum == calculated_checksum)
 
-        size = os.path.getsize(file_name)
+        size = out.size
 
         if checksum_correct and version_id_correct:
             logger.info("File integrity verified.\n"
                         f"Version ID: '{received_version_id}'\n"
                         f"Size: {size} bytes\n"
                         f"Checksum: '{received_checksum}'")
+            STATE.save('download', file=file_name,
+                       version_id=received_version_id, verified=True,
+                       size=size)
+            if cache:
+                return add_to_cache(cache, file_name, received_version_id,
+                                    received_checksum)
+            return file_name
         else:
             os.remove(file_name)
             raise IntegrityError(
@@ -188,36 +1046,689 @@ def download_from_s3(file_name, version_id=None):
         raise e
 
 
-def get_versions(file_name, number_of_versions=20):
+def get_repository_mode():
+    return bool(strtobool(ENV.get('REPOSITORY_MODE', 'False')))
+
+
+def find_repository_backup(date, version_id=None):
+    """Return the manifest of the backup of date in the chunk repository,
+    or None if there is none."""
+    from repository import get_manifest
+
+    bucket = ENV['S3_BUCKET_NAME']
+    try:
+        return get_manifest(bucket, f"backup.{date}", version_id)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('400', '404', 'NoSuchKey',
+                                           'NoSuchVersion'):
+            return None
+        raise e
+
+
+def check_repository_backup(manifest, source):
+    logger.info("Checking reassembled file's integrity ...")
+    calculated_checksum = source.hexdigest()
+    size_correct = (source.size == manifest['size'])
+    if size_correct and calculated_checksum == manifest['checksum-md5']:
+        logger.info("File integrity verified.\n"
+                    f"Version ID: '{manifest['version-id']}'\n"
+                    f"Size: {source.size} bytes\n"
+                    f"Checksum: '{calculated_checksum}'")
+        return True
+    return False
+
+
+def download_from_repository(file_name, manifest):
+    """Reassemble a backup from the chunk repository into file_name."""
+    from repository import ChunkReader
+    from s3_client import IntegrityError
+
+    outfile_path = os.path.dirname(file_name)
+    if outfile_path:
+        Path(outfile_path).mkdir(parents=True, exist_ok=True)
+
+    bucket = ENV['S3_BUCKET_NAME']
+    version_id = manifest['version-id']
+    if is_downloaded(file_name, version_id):
+        return
+    try:
+        logger.info(f"Reassembling {file_name} from "
+                    f"{len(manifest['chunks'])} chunks "
+                    f"in S3 bucket {bucket}")
+        with METRICS.phase('download') as phase:
+            with open_download(file_name, version_id) as out:
+                with ChunkReader(bucket, manifest,
+                                 callback=get_progress(phase),
+                                 start=out.size) as reader:
+                    shutil.copyfileobj(reader, out, READ_SIZE)
+            phase.add(bytes_out=out.size)
+
+        if check_repository_backup(manifest, out):
+            STATE.save('download', file=file_name, version_id=version_id,
+                       verified=True, size=out.size)
+        else:
+            os.remove(file_name)
+            raise IntegrityError(
+                "File integrity could not be verified. "
+                "Deleted the reassembled file with "
+                f"VersionId='{manifest['version-id']}'.")
+
+    except (ClientError, IntegrityError) as e:
+        logger.exception(e, exc_info=True)
+        raise e
+
+
+def stream_restore_from_repository(manifest, exclude,
+                                   selection=Selection()):
+    from repository import ChunkReader
+    from s3_client import IntegrityError
+
+    bucket = ENV['S3_BUCKET_NAME']
+    try:
+        logger.info(f"Restoring services straight from "
+                    f"{len(manifest['chunks'])} chunks "
+                    f"in S3 bucket {bucket}")
+        # Downloading and restoring run concurrently, so both phases
+        # span the same time.
+        with METRICS.phase('download') as download_phase, \
+                METRICS.phase('stream_restore') as phase:
+            with ChunkReader(bucket, manifest,
+                             callback=get_progress(download_phase)) as reader:
+                source = HashingReader(reader)
+                with open_archive(source, codec=CODECS['none']) as tar:
+                    restore_from_archive(tar, exclude, selection)
+                # Read past the end-of-archive marker, so that the
+                # checksum covers the whole stream.
+                while source.read(READ_SIZE):
+                    pass
+            phase.add(bytes_in=source.size)
+
+        # Each chunk has been checked against its digest already.
+        if not check_repository_backup(manifest, source):
+            raise IntegrityError(
+                "File integrity could not be verified for "
+                f"VersionId='{manifest['version-id']}'. "
+                "The restored data may be incomplete.")
+
+    except (ClientError, IntegrityError) as e:
+        logger.exception(e, exc_info=True)
+        raise e
+
+
+def classify_member(path):
+    """Return the service a member of the backup archive belongs to.
+
+    Returns a (service, stream) tuple. stream is the name of the dump
+    stream that the member is part of, or None if the member must be
+    extracted to disk.
+    """
+    if path == MYSQL_DUMPFILE or is_part_of(path, MYSQL_DUMPFILE):
+        return 'mysql', MYSQL_DUMPFILE
+    if path == MYSQL_CHUNKDIR or path.startswith(MYSQL_CHUNKDIR + '/'):
+        return 'mysql', None
+    if path.startswith(MONGODB_ARCHIVEDIR + '/'):
+        archive_name = path.rpartition('.')[0]
+        if is_part_of(path, archive_name):
+            return 'mongodb', archive_name
+        if is_mongodb_archive(path):
+            return 'mongodb', path
+    if path == MONGODB_DUMPDIR or path.startswith(MONGODB_DUMPDIR + '/'):
+        return 'mongodb', None
+    if path == CADDY_DUMPDIR or path.startswith(CADDY_DUMPDIR + '/'):
+        return 'caddy', None
+    return None, None
+
+
+def restore_from_archive(tar, exclude, selection=Selection()):
+    """Restore services straight from the members of a tar stream.
+
+    MySQL dumps and MongoDB archives are piped into mysql and
+    mongorestore while they are being read. Caddy data is extracted
+    straight to its final location, skipping the files that the Caddy
+    manifest shows to be unchanged. Only a MongoDB dump directory,
+    which mongorestore cannot read from a stream, and a chunked MySQL
+    dump, whose chunks are loaded in parallel, go to disk first.
+
+    If the dumps ran concurrently during the backup, the parts of
+    their streams are interleaved in the archive, and so each stream
+    keeps its own restore process until the end of the archive.
+
+    Members of databases that are not selected are skipped. Single-file
+    MySQL dumps are filtered as they are piped into mysql. In fast-load
+    mode, their secondary indexes are not deferred, since the dump is
+    only read once.
+    """
+    services = set()
+    sinks = {}
+    missing = None
+    mysql_loader = None
+    mongodb_report = RestoreReport()
+    mongodb_archives = set()
+    caddy_manifest = None
+    caddy_copied = 0
+    try:
+        for member in tar:
+            path = '/' + member.name
+            if path == CADDY_MANIFEST and 'caddy' not in exclude:
+                caddy_manifest = json.load(tar.extractfile(member))
+                services.add('caddy')
+                continue
+            service, stream = classify_member(path)
+            if service is None or service in exclude:
+                continue
+            services.add(service)
+            if service == 'mongodb' and stream:
+                mongodb_archives.add(stream)
+            if not is_selected(selection, service, get_member_database(path)):
+                continue
+
+            if stream is None:
+                if service == 'caddy':
+                    member.name = os.path.relpath(path, DUMP_DIRECTORY)
+                    entry = (caddy_manifest or {'files': {}})['files'].get(
+                        os.path.relpath(path, CADDY_DUMPDIR))
+                    if entry and has_content(member.name, entry):
+                        continue
+                    caddy_copied += member.isfile()
+                tar.extract(member)
+                continue
+
+            if stream not in sinks:
+                logger.info(f"Restoring {service} from {stream} "
+                            "while reading the archive")
+                if service == 'mysql':
+                    sinks[stream], mysql_loader = get_mysql_sink(
+                        selection.mysql_databases, get_mysql_fast_restore())
+                else:
+                    source = get_mongorestore_archive_source(stream)
+                    sinks[stream] = MongorestoreInput(
+                        get_mongorestore_command(
+                            source, selection,
+                            processes=get_mongorestore_concurrency()),
+                        mongodb_report)
+            shutil.copyfileobj(tar.extractfile(member), sinks[stream],
+                               READ_SIZE)
+
+        for stream in list(sinks):
+            sink = sinks.pop(stream)
+            sink.close()
+            if isinstance(sink, MySQLDatabaseFilter):
+                missing = sink.missing()
+            logger.info(f"Restored {stream}.")
+    except BaseException:
+        for sink in sinks.values():
+            sink.abort()
+        raise
+
+    if 'mysql' in services:
+        if os.path.isdir(MYSQL_CHUNKDIR):
+            restore_mysql(selection)
+        else:
+            if mysql_loader:
+                log_fast_load(mysql_loader)
+            log_missing_databases('MySQL', missing)
+            logger.info("MySQL restored.")
+            flush_mysql_logs()
+    if 'mongodb' in services:
+        if os.path.isdir(MONGODB_DUMPDIR):
+            restore_mongodb(selection)
+        else:
+            log_mongorestore_report(mongodb_report)
+            log_missing_mongodb(
+                selection, get_mongodb_archive_namespaces(mongodb_archives),
+                mongodb_report)
+            logger.info("MongoDB restored.")
+    if 'caddy' in services and caddy_manifest:
+        log_caddy_restore(caddy_manifest, caddy_copied)
+    elif 'caddy' in services:
+        caddy_dir = 'caddy'
+        total_size = get_size(caddy_dir)
+        logger.info(f"Complete. {caddy_dir} total size {total_size} bytes.")
+
+
+def stream_restore_from_s3(file_name, exclude, version_id=None,
+                           selection=Selection()):
+    from s3_client import (IntegrityError, ParallelDownloadReader,
+                           get_recorded_checksum)
+
+    bucket = ENV['S3_BUCKET_NAME']
+    key = os.path.basename(file_name)
+
+    try:
+        obj_metadata = head_backup(bucket, key, version_id)
+        received_version_id = obj_metadata['VersionId']
+        if version_id and version_id != received_version_id:
+            raise IntegrityError(
+                f"Requested VersionId='{version_id}', "
+                f"but found VersionId='{received_version_id}'.")
+
+        logger.info(f"Restoring services straight from {key} "
+                    f"in S3 bucket {bucket}")
+        # Downloading and restoring run concurrently, so both phases
+        # span the same time.
+        with METRICS.phase('download') as download_phase, \
+                METRICS.phase('stream_restore') as phase:
+            with ParallelDownloadReader(
+                    bucket,
+                    key,
+                    obj_metadata['ContentLength'],
+                    version_id=received_version_id,
+                    callback=get_progress(
+                        download_phase,
+                        obj_metadata['ContentLength'])) as reader:
+                source = HashingReader(reader)
+                with open_archive(
+                        source,
+                        codec=get_codec_for(file_name),
+                        threads=ENV.get('COMPRESSION_THREADS')) as tar:
+                    restore_from_archive(tar, exclude, selection)
+            phase.add(bytes_in=source.size)
+
+        # The data has already been restored at this point. Still, the
+        # codec's own integrity checks would have stopped the restore
+        # on corrupted input, so a mismatch here is unlikely.
+        logger.info("Checking downloaded file's integrity ...")
+        with METRICS.phase('verify'):
+            received_checksum = get_recorded_checksum(
+                bucket, key, obj_metadata)
+        calculated_checksum = source.hexdigest()
+        if received_checksum == calculated_checksum:
+            logger.info("File integrity verified.\n"
+                        f"Version ID: '{received_version_id}'\n"
+                        f"Size: {source.size} bytes\n"
+                        f"Checksum: '{received_checksum}'")
+        else:
+            raise IntegrityError(
+                "File integrity could not be verified for "
+                f"VersionId='{received_version_id}'. "
+                "The restored data may be incomplete.")
+
+    except (ClientError, IntegrityError) as e:
+        logger.exception(e, exc_info=True)
+        raise e
+
+
+def stream_restore_from_file(file_name, exclude, selection=Selection()):
+    logger.info(f"Restoring services straight from archive {file_name}")
+    try:
+        with METRICS.phase('stream_restore') as phase:
+            if not restore_segments_from_file(file_name, exclude, True,
+                                              selection):
+                with open_archive(
+                        file_name,
+                        threads=ENV.get('COMPRESSION_THREADS')) as tar:
+                    restore_from_archive(tar, exclude, selection)
+            phase.add(bytes_in=os.path.getsize(file_name))
+    except FileNotFoundError as e:
+        logger.exception(e, exc_info=True)
+        raise e
+
+
+def read_index_segment(open_range, index_offset, end, callback=None):
+    """Return the index of a segmented archive, read from its index
+    segment, whatever its codec."""
+    from segments import read_index
+
+    with open_range(index_offset, end, callback) as reader:
+        data = b''.join(iter(partial(reader.read, READ_SIZE), b''))
+    with open_archive(io.BytesIO(data), codec=detect_codec(data)) as tar:
+        return read_index(tar)
+
+
+def restore_from_segments(index, segments, open_segment, exclude,
+                          stream_restore, selection=Selection()):
+    """Restore services from the given segments of index, or, unless
+    stream_restore is set, extract them to disk, and return the number
+    of bytes read.
+
+    open_segment(segment) returns a readable file object with the bytes
+    of a segment. Each run of segments that share a codec is
+    decompressed as one stream.
+    """
+    from segments import SegmentReader, group_segments
+
+    size = 0
+    for codec, run in group_segments(index, segments):
+        with SegmentReader(run, open_segment) as reader:
+            with open_archive(reader, codec=codec,
+                              threads=ENV.get('COMPRESSION_THREADS')) as tar:
+                if stream_restore:
+                    restore_from_archive(tar, exclude, selection)
+                else:
+                    extract_members(tar, exclude, selection)
+            # Read to the end of the last segment, so that it is
+            # checked, too.
+            while reader.read(READ_SIZE):
+                pass
+        size += reader.size
+    return size
+
+
+def restore_segments(open_range, index_offset, end, exclude,
+                     stream_restore, selection=Selection()):
+    """Restore services from a segmented archive, reading only its
+    index and the segments that hold the services not excluded, and
+    the databases selected of them.
+
+    open_range(start, end, callback) returns a readable file object
+    with the bytes of the archive from start up to end. Unless
+    stream_restore is set, the segments are extracted to disk for the
+    restore functions to pick up.
+    """
+    from segments import select_segments
+
+    with METRICS.phase('download') as phase:
+        index = read_index_segment(open_range, index_offset, end,
+                                   get_progress(phase))
+    segments = select_segments(index, exclude, selection)
+    total_size = sum(segment['size'] for segment in segments)
+    logger.info(f"Fetching {len(segments)} of {len(index['segments'])} "
+                f"archive segments, {total_size} of {index_offset} bytes: "
+                f"{', '.join(segment['name'] for segment in segments)}")
+
+    def open_segment(segment, callback):
+        return open_range(segment['offset'],
+                          segment['offset'] + segment['size'], callback)
+
+    # Downloading and restoring or extracting run concurrently, so both
+    # phases span the same time.
+    with METRICS.phase('download') as download_phase, \
+            METRICS.phase('stream_restore' if stream_restore
+                          else 'extract') as phase:
+        callback = get_progress(download_phase, total_size)
+        size = restore_from_segments(
+            index, segments, partial(open_segment, callback=callback),
+            exclude, stream_restore, selection)
+        phase.add(bytes_in=size)
+
+
+def restore_segments_from_file(file_name, exclude, stream_restore,
+                               selection=Selection()):
+    """Restore services from the segments of a local archive whose
+    segments do not all have the same codec, and which therefore cannot
+    be decompressed as a whole. Return False if the archive is not one
+    of those."""
+    from segments import FileRangeReader, find_index, select_segments
+
+    if get_codec_for(file_name) == CODECS['none']:
+        # Its segments are all uncompressed.
+        return False
+    index_offset = find_index(file_name)
+    if index_offset is None:
+        return False
+
+    def open_range(start, end, callback=None):
+        return FileRangeReader(file_name, start, end, callback)
+
+    index = read_index_segment(open_range, index_offset,
+                               os.path.getsize(file_name))
+    segments = select_segments(index, exclude, selection)
+    logger.info(f"Reading {len(segments)} of {len(index['segments'])} "
+                f"archive segments: "
+                f"{', '.join(segment['name'] for segment in segments)}")
+    restore_from_segments(
+        index, segments,
+        lambda segment: open_range(segment['offset'],
+                                   segment['offset'] + segment['size']),
+        exclude, stream_restore, selection)
+    return True
+
+
+def restore_segments_from_s3(file_name, exclude, stream_restore,
+                             version_id=None, selection=Selection()):
+    """Restore services from the segments of a segmented archive in S3
+    with ranged requests. Return False if the archive is not segmented.
+    """
+    from s3_client import (IntegrityError, ParallelDownloadReader,
+                           get_recorded_value)
+
+    bucket = ENV['S3_BUCKET_NAME']
+    key = os.path.basename(file_name)
+
+    try:
+        obj_metadata = head_backup(bucket, key, version_id)
+        index_offset = get_recorded_value(bucket, key, obj_metadata,
+                                          'index-offset')
+        if index_offset is None:
+            return False
+
+        def open_range(start, end, callback):
+            return ParallelDownloadReader(
+                bucket,
+                key,
+                end,
+                version_id=obj_metadata['VersionId'],
+                callback=callback,
+                start=start,
+            )
+
+        logger.info(f"Restoring services from the segments of {key} "
+                    f"in S3 bucket {bucket}, "
+                    f"VersionId='{obj_metadata['VersionId']}'")
+        restore_segments(open_range, int(index_offset),
+                         obj_metadata['ContentLength'], exclude,
+                         stream_restore, selection)
+        return True
+
+    except (ClientError, IntegrityError) as e:
+        logger.exception(e, exc_info=True)
+        raise e
+
+
+def restore_segments_from_repository(manifest, exclude, stream_restore,
+                                     selection=Selection()):
+    """Restore services from the segments of a segmented archive in the
+    chunk repository, fetching only the chunks that hold them. Return
+    False if the archive is not segmented."""
+    from repository import ChunkReader
+    from s3_client import IntegrityError
+
+    index_offset = manifest.get('index-offset')
+    if index_offset is None:
+        return False
+
+    bucket = ENV['S3_BUCKET_NAME']
+    try:
+        def open_range(start, end, callback):
+            return ChunkReader(bucket, manifest, callback=callback,
+                               start=start, end=end)
+
+        logger.info(f"Restoring services from the segments of the backup "
+                    f"in the chunk repository in S3 bucket {bucket}, "
+                    f"VersionId='{manifest['version-id']}'")
+        restore_segments(open_range, index_offset, manifest['size'],
+                         exclude, stream_restore, selection)
+        return True
+
+    except (ClientError, IntegrityError) as e:
+        logger.exception(e, exc_info=True)
+        raise e
+
+
+def get_backup_file_names(date):
+    """Return the possible backup file names for date.
+
+    The backup file extension depends on the compression codec that
+    was used to create the backup. The currently configured codec is
+    the most likely one, so it goes first.
+    """
+    configured_codec = ENV.get('COMPRESSION', DEFAULT_CODEC)
+    codecs = sorted(CODECS.values(),
+                    key=lambda codec: codec.name != configured_codec)
+    return [os.path.join(BACKUP_DIRECTORY, f"backup.{date}{codec.extension}")
+            for codec in codecs]
+
+
+def find_local_backup(date):
+    file_names = get_backup_file_names(date)
+    for file_name in file_names:
+        if os.path.exists(file_name):
+            return file_name
+    return file_names[0]
+
+
+def find_remote_backup(date, version_id=None):
     from s3_client import S3_CLIENT
 
+    bucket = ENV['S3_BUCKET_NAME']
+    file_names = get_backup_file_names(date)
+    for file_name in file_names:
+        # boto3.client.head_object will break if empty string or None
+        # values are passed as the VersionId argument.
+        kwargs = {'VersionId': version_id} if version_id else {}
+        try:
+            S3_CLIENT.head_object(
+                Bucket=bucket,
+                Key=os.path.basename(file_name),
+                **kwargs,
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('400', '404'):
+                continue
+            raise e
+        return file_name
+    return file_names[0]
+
+
+def format_catalog(entries):
+    column_width = 32
+    output = (f"{'VersionId'.center(column_width)}  "
+              f"{'Timestamp'.center(25)}  "
+              f"{'Size'.rjust(12)}  {'Codec'.center(5)}  "
+              f"{'Components'.center(20)}  Key\n")
+    for entry in entries:
+        components = ','.join(entry['components'] or ['?'])
+        output += (f"{str(entry['version_id']).ljust(column_width)}  "
+                   f"{entry['created'].ljust(25)}  "
+                   f"{entry['size']:>12}  "
+                   f"{str(entry['codec'] or '?').center(5)}  "
+                   f"{components.center(20)}  {entry['key']}\n")
+    return output
+
+
+def get_versions(date, number_of_versions=20, rebuild=False):
+    from catalog import load_catalog
+
     bucket = ENV['S3_BUCKET_NAME']
 
     logger.info(
-        f"Retrieving available versions for {file_name} from {bucket}")
+        f"Retrieving available versions for backups of {date} "
+        f"from the catalog in {bucket}")
     try:
-        response = S3_CLIENT.list_object_versions(
-            Bucket=bucket,
-            Prefix=os.path.basename(file_name),
-        )
-        column_width = 32
-        output = (f"{'VersionId'.center(column_width)}  "
-                  f"{'Timestamp'.center(column_width)}\n")
-        for item in response['Versions'][:number_of_versions]:
-            output += f"{item['VersionId']}  {item['LastModified']}\n"
-
+        catalog = load_catalog(bucket, rebuild=rebuild)
+        entries = [entry for entry in catalog['backups']
+                   if entry['date'] == str(date)]
         logger.info(f"Last {number_of_versions} backup versions:\n"
-                    f"{output}")
+                    f"{format_catalog(entries[:number_of_versions])}")
 
     except ClientError as e:
         logger.exception(e, exc_info=True)
         raise e
 
 
+def list_backups(rebuild=False):
+    from catalog import load_catalog
+
+    bucket = ENV['S3_BUCKET_NAME']
+
+    logger.info(f"Retrieving all backups from the catalog in {bucket}")
+    try:
+        catalog = load_catalog(bucket, rebuild=rebuild)
+        logger.info(f"{len(catalog['backups'])} backup versions:\n"
+                    f"{format_catalog(catalog['backups'])}")
+
+    except ClientError as e:
+        logger.exception(e, exc_info=True)
+        raise e
+
+
+def is_done(phase):
+    if not STATE.done(phase):
+        return False
+    logger.info(f"Skipping the {phase} phase, which an earlier attempt of "
+                "this job completed.")
+    return True
+
+
+def restore(exclude, date, version, download, until, selection=Selection()):
+    stream_restore = bool(strtobool(ENV.get('STREAM_RESTORE', 'False')))
+    if until:
+        # The binary log position is read from the dump on disk.
+        stream_restore = False
+
+    manifest = None
+    if download and get_repository_mode():
+        manifest = find_repository_backup(date.date(), version_id=version)
+
+    # If only part of the backup is restored, and the backup is a
+    # segmented archive, only the segments of that part are fetched.
+    # A segmented archive in S3 is also streamed segment by segment, as
+    # its segments may not all have the same codec.
+    partial_restore = exclude or any(selection)
+    extracted = False
+    if manifest:
+        file_name = os.path.join(BACKUP_DIRECTORY,
+                                 f"backup.{date.date()}.tar")
+        if partial_restore and restore_segments_from_repository(
+                manifest, exclude, stream_restore, selection):
+            if stream_restore:
+                return
+            extracted = True
+        elif stream_restore:
+            stream_restore_from_repository(manifest, exclude, selection)
+            return
+        else:
+            download_from_repository(file_name, manifest)
+    elif download:
+        file_name = find_remote_backup(date.date(), version_id=version)
+        if (partial_restore or stream_restore) and restore_segments_from_s3(
+                file_name, exclude, stream_restore, version_id=version,
+                selection=selection):
+            if stream_restore:
+                return
+            extracted = True
+        elif stream_restore:
+            stream_restore_from_s3(file_name, exclude, version_id=version,
+                                   selection=selection)
+            return
+        else:
+            file_name = download_from_s3(file_name, version_id=version)
+    else:
+        file_name = find_local_backup(date.date())
+        if stream_restore:
+            stream_restore_from_file(file_name, exclude, selection)
+            return
+
+    if not (extracted or is_done('extract')):
+        extract(file_name, exclude, selection)
+        STATE.save('extract')
+
+    if 'mysql' not in exclude and not is_done('restore_mysql'):
+        with METRICS.phase('restore_mysql') as phase:
+            restore_mysql(selection)
+            phase.add(bytes_in=get_dump_size(MYSQL_CHUNKDIR) or
+                      get_dump_size(MYSQL_DUMPFILE))
+        STATE.save('restore_mysql')
+    if 'mysql' not in exclude and until and not is_done('replay_binlogs'):
+        with METRICS.phase('replay_binlogs'):
+            replay_binlogs(until, download,
+                           next(iter(selection.mysql_databases), None))
+        STATE.save('replay_binlogs')
+    if 'mongodb' not in exclude and not is_done('restore_mongodb'):
+        with METRICS.phase('restore_mongodb') as phase:
+            restore_mongodb(selection)
+            phase.add(bytes_in=get_dump_size(MONGODB_DUMPDIR) or
+                      get_dump_size(MONGODB_ARCHIVEDIR))
+        STATE.save('restore_mongodb')
+    if 'caddy' not in exclude:
+        with METRICS.phase('restore_caddy'):
+            restore_caddy()
+
+
 @click.command()
 @click.option(
     '--exclude',
-    type=click.Choice(['mysql', 'mongodb', 'caddy']),
+    type=click.Choice(SERVICES),
     multiple=True
 )
 @click.option('--date', type=click.DateTime(formats=["%Y-%m-%d"]),
@@ -228,7 +1739,27 @@ def get_versions(file_name, number_of_versions=20):
 @click.option('--download', is_flag=True, help="Download from S3")
 @click.option('--list-versions', is_flag=False, flag_value=20, type=int,
               help="List n latest backup versions (n=20 by default)")
-def main(exclude, date, version, download, list_versions):
+@click.option('--list-all', is_flag=True,
+              help="List all backup versions of all dates")
+@click.option('--rebuild-catalog', is_flag=True,
+              help="Rebuild the backup catalog from the bucket contents "
+                   "before listing backups")
+@click.option('--until',
+              type=click.DateTime(formats=["%Y-%m-%d %H:%M:%S",
+                                           "%Y-%m-%dT%H:%M:%S"]),
+              help="Replay the MySQL binary logs up to this point in "
+                   "time (UTC)")
+@click.option('--mysql-database', multiple=True,
+              help="Only restore this MySQL database")
+@click.option('--mongodb-database', multiple=True,
+              help="Only restore this MongoDB database")
+@click.option('--mongodb-collection', multiple=True,
+              help="Only restore this MongoDB collection "
+                   "(<database>.<collection>)")
+@click.pass_context
+def main(context, exclude, date, version, download, list_versions,
+         list_all, rebuild_catalog, until, mysql_database, mongodb_database,
+         mongodb_collection):
     loglevel = logging.INFO
     try:
         loglevel = getattr(logging, ENV['LOG_LEVEL'].upper())
@@ -241,23 +1772,41 @@ def main(exclude, date, version, download, list_versions):
     logger.addHandler(handler)
     logger.setLevel(loglevel)
 
-    file_name = f'/data/backup/backup.{date.date()}.tar.xz'
-
+    if list_all:
+        list_backups(rebuild=rebuild_catalog)
+        return
     if list_versions:
-        get_versions(file_name, number_of_versions=list_versions)
+        get_versions(date.date(), number_of_versions=list_versions,
+                     rebuild=rebuild_catalog)
         return
 
-    if download:
-        download_from_s3(file_name, version_id=version)
+    if until:
+        # Restore the full backup of the day, unless told otherwise.
+        date_source = context.get_parameter_source('date')
+        if date_source == click.core.ParameterSource.DEFAULT:
+            date = until
 
-    extract(file_name)
+    for collection in mongodb_collection:
+        if '.' not in collection.strip('.'):
+            raise click.BadParameter(
+                f"'{collection}' is not of the form "
+                "<database>.<collection>.",
+                param_hint='--mongodb-collection')
+    if until and len(mysql_database) > 1:
+        raise click.UsageError("--until can only be combined with a "
+                               "single --mysql-database.")
+    selection = Selection(mysql_database, mongodb_database,
+                          mongodb_collection)
+    # Selecting databases or collections restores only the services
+    # that they belong to.
+    exclude = (*exclude, *get_unselected_services(selection, SERVICES))
 
-    if 'mysql' not in exclude:
-        restore_mysql()
-    if 'mongodb' not in exclude:
-        restore_mongodb()
-    if 'caddy' not in exclude:
-        restore_caddy()
+    try:
+        restore(exclude, date, version, download, until, selection)
+        STATE.clear()
+        METRICS.succeeded = True
+    finally:
+        export_metrics()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,164 @@
+import json
+from collections import namedtuple
+from datetime import date, datetime, time, timezone
+
+from catalog import BACKUP_PREFIX, MANIFEST_PREFIX
+from compression import get_codec_for
+from repository import CHUNK_PREFIX
+from s3_client import S3_CLIENT
+
+# Old backup versions are pruned according to a grandfather-father-son
+# policy: the newest backup of each of the last `daily` days, `weekly`
+# ISO weeks and `monthly` months that have backups is kept, and every
+# other version is deleted. A backup may be kept by several rules.
+#
+# Once the expired manifests are deleted, the chunks in the repository
+# that no remaining manifest references are swept. A chunk uploaded
+# within the grace period is kept, since the backup that uploaded it
+# may not have stored its manifest yet. A backup that reuses an older
+# chunk checks that it is still there before it stores its manifest.
+#
+# Shipped MySQL binary logs are deleted once they were shipped, and so
+# closed, more than the grace period before the day of the oldest
+# backup kept: a point-in-time restore never replays them.
+Policy = namedtuple('Policy', ['daily', 'weekly', 'monthly'])
+
+# S3 deletes at most this many object versions per request.
+DELETE_BATCH_SIZE = 1000
+
+# key and version_id identify the version; date is that of the backup.
+BackupVersion = namedtuple(
+    'BackupVersion',
+    ['key', 'version_id', 'size', 'date', 'last_modified'])
+
+
+def get_backup_date(key):
+    """Return the date of the backup stored at key, or None if key does
+    not hold a backup."""
+    if key.startswith(MANIFEST_PREFIX):
+        name = key[len(MANIFEST_PREFIX):]
+        if not name.endswith('.json'):
+            return None
+    else:
+        name = key
+        try:
+            get_codec_for(key)
+        except ValueError:
+            return None
+    if not name.startswith(BACKUP_PREFIX):
+        return None
+    try:
+        return date.fromisoformat(name[len(BACKUP_PREFIX):][:10])
+    except ValueError:
+        return None
+
+
+def scan_versions(bucket):
+    """Yield every backup version in the bucket, page by page, from a
+    paginated listing of its object versions."""
+    paginator = S3_CLIENT.get_paginator('list_object_versions')
+    for prefix in (BACKUP_PREFIX, MANIFEST_PREFIX):
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get('Versions', []):
+                backup_date = get_backup_date(item['Key'])
+                if backup_date is None:
+                    continue
+                yield BackupVersion(item['Key'], item['VersionId'],
+                                    item['Size'], backup_date,
+                                    item['LastModified'])
+
+
+def get_periods(backup_date):
+    """Return the day, ISO week and month of backup_date, in the order
+    of the fields of Policy."""
+    iso_year, iso_week, _ = backup_date.isocalendar()
+    return (backup_date, (iso_year, iso_week),
+            (backup_date.year, backup_date.month))
+
+
+def select_expired(versions, policy):
+    """Split versions into those that policy keeps, and those that have
+    expired, both newest first."""
+    versions = sorted(versions, key=lambda version: (version.date,
+                                                     version.last_modified),
+                      reverse=True)
+    seen = [set() for _ in policy]
+    kept = []
+    expired = []
+    for version in versions:
+        keep = False
+        for count, periods, period in zip(policy, seen,
+                                          get_periods(version.date)):
+            if period not in periods and len(periods) < count:
+                periods.add(period)
+                keep = True
+        (kept if keep else expired).append(version)
+    return kept, expired
+
+
+def delete_versions(bucket, versions):
+    """Delete the given versions, in batches of DELETE_BATCH_SIZE, and
+    return the errors that S3 reported."""
+    errors = []
+    for start in range(0, len(versions), DELETE_BATCH_SIZE):
+        batch = versions[start:start + DELETE_BATCH_SIZE]
+        response = S3_CLIENT.delete_objects(
+            Bucket=bucket,
+            Delete={
+                'Objects': [{'Key': version.key,
+                             'VersionId': version.version_id}
+                            for version in batch],
+                'Quiet': True,
+            },
+        )
+        errors.extend(response.get('Errors', []))
+    return errors
+
+
+def scan_object_versions(bucket, prefix, skip=()):
+    """Yield every object version under prefix in the bucket, except
+    those of the keys in skip, as BackupVersions without a date."""
+    paginator = S3_CLIENT.get_paginator('list_object_versions')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Versions', []):
+            if item['Key'] in skip:
+                continue
+            yield BackupVersion(item['Key'], item['VersionId'],
+                                item['Size'], None, item['LastModified'])
+
+
+def get_referenced_chunks(bucket, excluded=()):
+    """Return the digests of the chunks that the manifest versions in
+    the bucket reference, leaving out the versions in excluded, given
+    as (key, version_id) pairs."""
+    referenced = set()
+    for version in scan_object_versions(bucket, MANIFEST_PREFIX):
+        if (version.key, version.version_id) in excluded:
+            continue
+        response = S3_CLIENT.get_object(Bucket=bucket, Key=version.key,
+                                        VersionId=version.version_id)
+        manifest = json.loads(response['Body'].read())
+        referenced.update(digest for digest, _ in manifest['chunks'])
+    return referenced
+
+
+def select_unreferenced_chunks(bucket, referenced, cutoff):
+    """Return the chunk versions in the bucket that are not referenced,
+    and were uploaded before cutoff."""
+    return [version for version in scan_object_versions(bucket,
+                                                        CHUNK_PREFIX)
+            if version.key.rpartition('/')[2] not in referenced and
+            version.last_modified < cutoff]
+
+
+def select_expired_binlogs(bucket, prefix, kept, grace_period, skip=()):
+    """Return the binary log versions under prefix that were shipped
+    more than grace_period before the day of the oldest backup in kept.
+    """
+    if not kept:
+        return []
+    oldest = min(version.date for version in kept)
+    cutoff = datetime.combine(oldest, time(), timezone.utc) - grace_period
+    return [version for version in scan_object_versions(bucket, prefix,
+                                                        skip)
+            if version.last_modified < cutoff]
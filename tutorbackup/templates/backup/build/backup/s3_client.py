@@ -1,7 +1,16 @@
+import base64
 import hashlib
+import io
 import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
+from botocore.exceptions import ClientError
 
 
 config = Config(
@@ -9,7 +18,14 @@ config = Config(
     signature_version=os.environ['S3_SIGNATURE_VERSION'],
     s3={
         'addressing_style': os.environ['S3_ADDRESSING_STYLE'],
-    }
+    },
+    # In adaptive mode, the client backs off exponentially when S3
+    # throttles requests, and slows down all of its threads until S3
+    # stops doing so.
+    retries={
+        'mode': os.environ.get('S3_RETRY_MODE') or 'adaptive',
+        'total_max_attempts': int(os.environ.get('S3_MAX_ATTEMPTS') or 10),
+    },
 )
 
 S3_CLIENT = boto3.client(
@@ -23,10 +39,481 @@ S3_CLIENT = boto3.client(
 )
 
 
+# S3 rejects multipart uploads with non-final parts smaller than this.
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Transfer directions, which can be tuned separately: the backup job
+# uploads, and the restore job downloads.
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+
+# Bandwidth-limited transfers are read in pieces of this size.
+THROTTLE_SIZE = 256 * 1024
+
+
 class IntegrityError(BaseException):
     pass
 
 
+def get_direction_setting(name, direction):
+    """Return the value of the S3_<DIRECTION>_<name> setting, or 0 if
+    it is not set."""
+    if not direction:
+        return 0
+    return int(os.environ.get(f'S3_{direction.upper()}_{name}') or 0)
+
+
+def get_multipart_chunksize(direction=None):
+    chunksize = (get_direction_setting('CHUNKSIZE', direction) or
+                 int(os.environ.get('S3_MULTIPART_CHUNKSIZE') or 0))
+    return max(chunksize, MIN_PART_SIZE)
+
+
+def get_max_concurrency(direction=None):
+    max_concurrency = (get_direction_setting('MAX_CONCURRENCY', direction) or
+                       int(os.environ.get('S3_MAX_CONCURRENCY') or 0))
+    return max(max_concurrency, 1)
+
+
+def get_bandwidth_limit(direction):
+    """Return the bandwidth limit for direction, in bytes per second,
+    or 0 if there is none."""
+    return max(get_direction_setting('BANDWIDTH_LIMIT', direction), 0)
+
+
+def get_transfer_config(direction=None):
+    return TransferConfig(
+        multipart_chunksize=get_multipart_chunksize(direction),
+        max_concurrency=get_max_concurrency(direction),
+        max_bandwidth=get_bandwidth_limit(direction) or None,
+    )
+
+
+class RateLimiter:
+    """A token bucket that limits transfers to rate bytes per second.
+
+    The bucket holds up to one second's worth of tokens. Each transfer
+    takes as many tokens as it has bytes, and waits until the bucket has
+    refilled enough to cover them, so transfers larger than the bucket
+    just wait longer. It is safe to share between threads.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate,
+                              self.rate)
+            self.updated = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+RATE_LIMITERS = {}
+RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(direction):
+    """Return the rate limiter shared by all transfers in direction, or
+    None if its bandwidth is not limited."""
+    rate = get_bandwidth_limit(direction)
+    if not rate:
+        return None
+    with RATE_LIMITERS_LOCK:
+        limiter = RATE_LIMITERS.get(direction)
+        if limiter is None or limiter.rate != rate:
+            limiter = RATE_LIMITERS[direction] = RateLimiter(rate)
+        return limiter
+
+
+def read_body(body, limiter=None):
+    """Read a response body in full, no faster than limiter allows."""
+    if limiter is None:
+        return body.read()
+    pieces = []
+    while piece := body.read(THROTTLE_SIZE):
+        limiter.consume(len(piece))
+        pieces.append(piece)
+    return b''.join(pieces)
+
+
+class ThrottledBody(io.BytesIO):
+    """A request body, given as bytes, that is read no faster than
+    limiter allows, in pieces of at most THROTTLE_SIZE.
+
+    Every read counts, so reading the body to calculate a checksum
+    before sending it takes as long as sending it.
+    """
+
+    def __init__(self, data, limiter):
+        super().__init__(data)
+        self.limiter = limiter
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            pieces = []
+            while piece := self.read(THROTTLE_SIZE):
+                pieces.append(piece)
+            return b''.join(pieces)
+        data = super().read(min(size, THROTTLE_SIZE))
+        self.limiter.consume(len(data))
+        return data
+
+
+def throttle_body(body, limiter=None):
+    """Return body, given as bytes, to send as a request body no faster
+    than limiter allows."""
+    if limiter is None:
+        return body
+    return ThrottledBody(body, limiter)
+
+
+def get_checksum_algorithm():
+    """Return the S3 additional checksum algorithm to use, if any.
+
+    If set, S3 verifies each uploaded part against a checksum that is
+    calculated as the part is sent, in the thread uploading that part.
+    """
+    return os.environ.get('S3_CHECKSUM_ALGORITHM', '').upper() or None
+
+
+def get_recorded_value(bucket, key, obj_metadata, name):
+    """Return the value of name recorded for an object version.
+
+    Objects uploaded in one piece carry such values in their metadata.
+    For objects uploaded while the archive was being written, values
+    like the checksum are only known after the upload, so they are
+    kept in object tags instead.
+    """
+    value = obj_metadata['Metadata'].get(name)
+    if value:
+        return value
+    response = S3_CLIENT.get_object_tagging(
+        Bucket=bucket,
+        Key=key,
+        VersionId=obj_metadata['VersionId'],
+    )
+    for tag in response['TagSet']:
+        if tag['Key'] == name:
+            return tag['Value']
+    return None
+
+
+def get_recorded_checksum(bucket, key, obj_metadata):
+    """Return the MD5 checksum recorded for an object version."""
+    return get_recorded_value(bucket, key, obj_metadata, 'checksum-md5')
+
+
+class MultipartUploadWriter:
+    """A writable file object that uploads its contents to S3.
+
+    Everything written is cut into parts of chunksize bytes, which are
+    uploaded by up to max_concurrency threads while writing continues.
+    At most twice that number of parts are held in memory at any time.
+    The part size doubles every 1,000 parts.
+
+    Use it as a context manager: the upload is completed when the
+    context exits normally, and aborted when it exits with an exception.
+
+    If given, callback is called with the size of each part once it
+    has been uploaded, like the Callback argument of boto3 transfers.
+
+    Unless given, the part size and concurrency are the upload settings,
+    and parts are sent no faster than the upload bandwidth limit.
+
+    To resume an earlier upload, pass its upload_id, and the same
+    chunksize. Parts that S3 already holds with the same content are
+    not sent again. Unless abort_on_error is set, a failed upload is
+    left in place to be resumed.
+    """
+
+    def __init__(self, bucket, key, chunksize=None, max_concurrency=None,
+                 metadata=None, checksum_algorithm=None, callback=None,
+                 upload_id=None, abort_on_error=True):
+        self.bucket = bucket
+        self.key = key
+        self.chunksize = max(chunksize or get_multipart_chunksize(UPLOAD),
+                             MIN_PART_SIZE)
+        max_concurrency = max_concurrency or get_max_concurrency(UPLOAD)
+        self.limiter = get_rate_limiter(UPLOAD)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.slots = threading.BoundedSemaphore(max_concurrency * 2)
+        self.metadata = metadata or {}
+        self.checksum_algorithm = checksum_algorithm
+        self.callback = callback
+        self.buffer = bytearray()
+        self.futures = []
+        self.part_digests = []
+        self.file_hash = hashlib.md5()
+        self.size = 0
+        self.upload_id = upload_id
+        self.abort_on_error = abort_on_error
+        self.uploaded_parts = {}
+        self.skipped_size = 0
+        self.response = None
+
+    def __enter__(self):
+        if self.upload_id:
+            try:
+                self.uploaded_parts = self.list_uploaded_parts()
+                return self
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchUpload':
+                    raise e
+        response = S3_CLIENT.create_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            Metadata=self.metadata,
+            **self.checksum_args(),
+        )
+        self.upload_id = response['UploadId']
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.fail()
+            return
+        try:
+            self.complete()
+        except BaseException:
+            self.fail()
+            raise
+
+    def list_uploaded_parts(self):
+        parts = {}
+        paginator = S3_CLIENT.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=self.bucket, Key=self.key,
+                                       UploadId=self.upload_id):
+            for part in page.get('Parts', []):
+                parts[part['PartNumber']] = part
+        return parts
+
+    def write(self, data):
+        self.file_hash.update(data)
+        self.size += len(data)
+        self.buffer += data
+        while len(self.buffer) >= self.chunksize:
+            self.submit(bytes(self.buffer[:self.chunksize]))
+            del self.buffer[:self.chunksize]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def submit(self, body):
+        # Fail early if any part has already failed to upload.
+        for future in self.futures:
+            if future.done() and future.exception():
+                raise future.exception()
+
+        part_number = len(self.futures) + 1
+        # S3 allows at most 10,000 parts per upload. Since we do not
+        # know the final size in advance, grow the part size as the
+        # upload goes on.
+        if part_number % 1000 == 0:
+            self.chunksize *= 2
+        digest = hashlib.md5(body).digest()
+        self.part_digests.append(digest)
+
+        part = self.get_uploaded_part(part_number, body, digest)
+        if part:
+            self.skipped_size += len(body)
+            future = Future()
+            future.set_result(part)
+            self.futures.append(future)
+            return
+
+        self.slots.acquire()
+        future = self.executor.submit(self.upload_part, part_number, body,
+                                      digest)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def checksum_args(self):
+        if not self.checksum_algorithm:
+            return {}
+        return {'ChecksumAlgorithm': self.checksum_algorithm}
+
+    def get_uploaded_part(self, part_number, body, digest):
+        """Return the part to complete the upload with, if S3 already
+        holds part_number with the content of body."""
+        uploaded = self.uploaded_parts.get(part_number)
+        if not uploaded or uploaded['Size'] != len(body):
+            return None
+        if uploaded['ETag'] != f'"{digest.hex()}"':
+            return None
+        part = {'PartNumber': part_number, 'ETag': uploaded['ETag']}
+        if self.checksum_algorithm:
+            checksum_key = f'Checksum{self.checksum_algorithm}'
+            if checksum_key not in uploaded:
+                return None
+            part[checksum_key] = uploaded[checksum_key]
+        return part
+
+    def upload_part(self, part_number, body, digest):
+        # With a Content-MD5 header, the client does not read the body
+        # to sign it before sending it, which would count against the
+        # bandwidth limit, too.
+        response = S3_CLIENT.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=throttle_body(body, self.limiter),
+            ContentMD5=base64.b64encode(digest).decode(),
+            **self.checksum_args(),
+        )
+        part = {'PartNumber': part_number, 'ETag': response['ETag']}
+        if self.checksum_algorithm:
+            checksum_key = f'Checksum{self.checksum_algorithm}'
+            part[checksum_key] = response[checksum_key]
+        if self.callback:
+            self.callback(len(body))
+        return part
+
+    def complete(self):
+        if self.buffer or not self.futures:
+            self.submit(bytes(self.buffer))
+            self.buffer.clear()
+        try:
+            parts = [future.result() for future in self.futures]
+        finally:
+            self.executor.shutdown()
+        self.response = S3_CLIENT.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={'Parts': parts},
+        )
+        return self.response
+
+    def fail(self):
+        if self.abort_on_error:
+            self.abort()
+            return
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown()
+
+    def abort(self):
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown()
+        S3_CLIENT.abort_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+        )
+
+    def hexdigest(self):
+        """Return the MD5 checksum of everything written so far."""
+        return self.file_hash.hexdigest()
+
+    def expected_etag(self):
+        """Return the ETag S3 assigns to the completed multipart upload.
+
+        That is the MD5 checksum of the concatenated MD5 digests of all
+        parts, followed by the number of parts.
+        """
+        digest = hashlib.md5(b''.join(self.part_digests)).hexdigest()
+        return f'"{digest}-{len(self.part_digests)}"'
+
+
+class ParallelDownloadReader:
+    """A readable file object with the contents of an S3 object.
+
+    The object is fetched with ranged GET requests of chunksize bytes,
+    up to max_concurrency of which run at the same time, and returned
+    in order. At most twice that number of chunks are held in memory.
+
+    If given, callback is called with the size of each chunk once it
+    has been fetched.
+
+    To read only part of the object, pass the offset of its first byte
+    as start, and the offset just past its last byte as size.
+
+    Unless given, the chunk size and concurrency are the download
+    settings, and chunks are read no faster than the download bandwidth
+    limit.
+    """
+
+    def __init__(self, bucket, key, size, version_id=None, chunksize=None,
+                 max_concurrency=None, callback=None, start=0):
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.version_id = version_id
+        self.callback = callback
+        self.chunksize = chunksize or get_multipart_chunksize(DOWNLOAD)
+        self.max_concurrency = (max_concurrency or
+                                get_max_concurrency(DOWNLOAD))
+        self.limiter = get_rate_limiter(DOWNLOAD)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        self.pending = deque()
+        self.next_offset = start
+        self.buffer = memoryview(b'')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown()
+
+    def get_range(self, start, end):
+        kwargs = {'VersionId': self.version_id} if self.version_id else {}
+        response = S3_CLIENT.get_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Range=f'bytes={start}-{end}',
+            **kwargs,
+        )
+        data = read_body(response['Body'], self.limiter)
+        if self.callback:
+            self.callback(len(data))
+        return data
+
+    def schedule(self):
+        while len(self.pending) < self.max_concurrency * 2:
+            if self.next_offset >= self.size:
+                break
+            start = self.next_offset
+            end = min(start + self.chunksize, self.size) - 1
+            self.pending.append(
+                self.executor.submit(self.get_range, start, end))
+            self.next_offset = end + 1
+
+    def read(self, size=-1):
+        chunks = []
+        remaining = size
+        while remaining:
+            if not self.buffer:
+                self.schedule()
+                if not self.pending:
+                    break
+                self.buffer = memoryview(self.pending.popleft().result())
+                self.schedule()
+            if remaining < 0:
+                take = len(self.buffer)
+            else:
+                take = min(remaining, len(self.buffer))
+                remaining -= take
+            chunks.append(self.buffer[:take])
+            self.buffer = self.buffer[take:]
+        return b''.join(chunks)
+
+
 def calculate_checksum(file_name):
     # To avoid reading in the whole file into memory, break it
     # down into chunks and calculate the checksum by updating
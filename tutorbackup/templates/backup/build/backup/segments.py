@@ -0,0 +1,205 @@
+import json
+import os
+import tarfile
+from collections import deque, namedtuple
+from itertools import groupby
+
+from compression import CODECS
+from selection import Selection, is_selected
+from streaming import HashingReader
+
+# A segmented archive is a sequence of tar streams, each compressed on
+# its own, so that any one of them can be fetched and decompressed
+# without the others. Decompressing the whole file yields the tar
+# streams one after the other, which tarfile reads as one archive
+# when told to skip the end-of-archive markers in between.
+#
+# The last segment holds an index of the others: the service and
+# database each one contains, its codec, and its offset, size, and MD5
+# checksum in the file. The offset of the index segment is recorded
+# with the uploaded backup.
+#
+# Segments that hold data which is compressed already are not
+# compressed again. An archive whose segments do not all have the same
+# codec cannot be decompressed as a whole, so it must be read segment
+# by segment. Its index segment is left uncompressed, so that it can
+# be found at the end of the file without its offset.
+INDEX_FILE = '/data/archive_index.json'
+INDEX_VERSION = 2
+
+# name is unique in the archive; database is None for segments that
+# hold a whole service, or what a service needs besides its databases.
+# add(tar, lock=None) adds the contents of the segment to tar.
+Segment = namedtuple('Segment', ['name', 'service', 'database', 'add'])
+
+
+def new_index(codec):
+    return {'version': INDEX_VERSION, 'codec': codec.name, 'segments': []}
+
+
+def add_to_index(index, segment, offset, out, codec):
+    """Record segment, written to out at offset with codec, in index."""
+    index['segments'].append({
+        'name': segment.name,
+        'service': segment.service,
+        'database': segment.database,
+        'codec': codec.name,
+        'offset': offset,
+        'size': out.size,
+        'checksum-md5': out.hexdigest(),
+    })
+
+
+def is_mixed(index):
+    """Return whether the segments of index do not all have the codec
+    of the archive."""
+    return any(segment['codec'] != index['codec']
+               for segment in index['segments'])
+
+
+def get_segment_codec(index, segment):
+    # Version 1 indexes compress every segment with the codec of the
+    # archive.
+    return CODECS[segment.get('codec', index['codec'])]
+
+
+def group_segments(index, segments):
+    """Return the runs of consecutive segments that share a codec, as
+    (codec, segments) tuples."""
+    return [(codec, list(run)) for codec, run in
+            groupby(segments, key=lambda segment:
+                    get_segment_codec(index, segment))]
+
+
+def find_index(file_name, max_size=64 * 1024 * 1024):
+    """Return the offset of the uncompressed index segment at the end
+    of the archive file_name, or None if it has none, within its last
+    max_size bytes.
+
+    An uncompressed tar stream is padded to a whole number of records,
+    so the index segment starts a whole number of records before the
+    end of the file, with the header of the index file.
+    """
+    size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as f:
+        for offset in range(size - tarfile.RECORDSIZE,
+                            max(size - max_size, 0) - 1,
+                            -tarfile.RECORDSIZE):
+            f.seek(offset)
+            try:
+                tarfile.TarInfo.frombuf(f.read(tarfile.BLOCKSIZE),
+                                        tarfile.ENCODING, 'surrogateescape')
+            except tarfile.HeaderError:
+                continue
+            # The header may be an extended header, which tells nothing
+            # of the member that it precedes.
+            with FileRangeReader(file_name, offset, size) as reader:
+                try:
+                    with tarfile.open(fileobj=reader, mode='r|') as tar:
+                        member = tar.next()
+                except tarfile.TarError:
+                    continue
+            if member and '/' + member.name == INDEX_FILE:
+                return offset
+    return None
+
+
+def read_index(tar):
+    """Return the index from the tar stream of an index segment."""
+    for member in tar:
+        if '/' + member.name == INDEX_FILE:
+            return json.load(tar.extractfile(member))
+    raise ValueError("The archive index segment holds no index.")
+
+
+def select_segments(index, exclude, selection=Selection()):
+    """Return the segments of index that hold the services not
+    excluded, and the databases selected of them, in archive order."""
+    return [segment for segment in index['segments']
+            if segment['service'] not in exclude and
+            is_selected(selection, segment['service'], segment['database'])]
+
+
+class FileRangeReader:
+    """A readable file object with the bytes of file_name from start up
+    to end.
+
+    If given, callback is called with the size of each read.
+    """
+
+    def __init__(self, file_name, start, end, callback=None):
+        self.file = open(file_name, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+        self.callback = callback
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        if self.callback and data:
+            self.callback(len(data))
+        return data
+
+
+class SegmentReader:
+    """A readable file object with the contents of the given segments
+    of an archive, one after the other.
+
+    open_segment(segment) returns a readable file object with the bytes
+    of a segment. Each segment is checked against the size and checksum
+    recorded in the index once it has been read in full.
+    """
+
+    def __init__(self, segments, open_segment):
+        self.remaining = deque(segments)
+        self.open_segment = open_segment
+        self.segment = None
+        self.reader = None
+        self.source = None
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+
+    def check(self):
+        from s3_client import IntegrityError
+
+        size_correct = (self.source.size == self.segment['size'])
+        if not (size_correct and
+                self.source.hexdigest() == self.segment['checksum-md5']):
+            raise IntegrityError(f"Archive segment {self.segment['name']} "
+                                 "is corrupted.")
+
+    def read(self, size=-1):
+        while True:
+            if self.reader is None:
+                if not self.remaining:
+                    return b''
+                self.segment = self.remaining.popleft()
+                self.reader = self.open_segment(self.segment)
+                self.source = HashingReader(self.reader)
+            data = self.source.read(size)
+            if data:
+                self.size += len(data)
+                return data
+            self.close()
+            self.check()
@@ -0,0 +1,112 @@
+from collections import namedtuple
+
+# The parts of a backup to restore. mongodb_collections holds
+# "<database>.<collection>" names. Empty fields select everything.
+Selection = namedtuple(
+    'Selection',
+    ['mysql_databases', 'mongodb_databases', 'mongodb_collections'],
+    defaults=((), (), ()),
+)
+
+# mysqldump starts the statements of each database with this comment,
+# when it dumps more than one, or is given --databases.
+CURRENT_DATABASE_MARKER = b'\n-- Current Database: `'
+
+
+def get_databases(selection, service):
+    """Return the names of the databases of service that selection
+    selects, or an empty set if it does not narrow service down."""
+    if service == 'mysql':
+        return set(selection.mysql_databases)
+    if service == 'mongodb':
+        return (set(selection.mongodb_databases) |
+                {collection.split('.', 1)[0]
+                 for collection in selection.mongodb_collections})
+    return set()
+
+
+def is_selected(selection, service, database):
+    """Return whether the dump of database of service is selected.
+
+    database is None for the parts of a dump that are not specific to
+    any one database, which are always selected.
+    """
+    if database is None:
+        return True
+    databases = get_databases(selection, service)
+    return not databases or database in databases
+
+
+def get_unselected_services(selection, services):
+    """Return the services that nothing is selected of, if anything is
+    selected at all."""
+    if not any(selection):
+        return ()
+    return tuple(service for service in services
+                 if not get_databases(selection, service))
+
+
+def get_mongodb_namespaces(selection):
+    """Return the namespaces to pass to mongorestore --nsInclude."""
+    return ([f"{database}.*" for database in selection.mongodb_databases] +
+            list(selection.mongodb_collections))
+
+
+def parse_database_marker(line):
+    name = line[len(CURRENT_DATABASE_MARKER) - 1:].rstrip(b'\r')
+    return name[:-1].replace(b'``', b'`').decode()
+
+
+class MySQLDatabaseFilter:
+    """A writable file object that passes on the parts of mysqldump
+    output that concern the given databases to target.
+
+    The statements before the first database, which set up the session,
+    are passed on, too. The output is scanned as it is written, so it
+    is never held in memory as a whole.
+    """
+
+    def __init__(self, target, databases):
+        self.target = target
+        self.databases = set(databases)
+        self.found = set()
+        self.passing = True
+        self.buffer = bytearray()
+
+    def send(self, end):
+        if self.passing and end:
+            self.target.write(bytes(self.buffer[:end]))
+        del self.buffer[:end]
+
+    def write(self, data):
+        self.buffer += data
+        while (start := self.buffer.find(CURRENT_DATABASE_MARKER)) >= 0:
+            end = self.buffer.find(b'\n', start + 1)
+            if end < 0:
+                # Wait for the rest of the line to know the database.
+                self.send(start)
+                return len(data)
+            self.send(start + 1)
+            database = parse_database_marker(
+                bytes(self.buffer[:end - start - 1]))
+            self.passing = database in self.databases
+            if self.passing:
+                self.found.add(database)
+        # Hold back what may be the start of the next marker.
+        self.send(max(len(self.buffer) - len(CURRENT_DATABASE_MARKER) + 1,
+                      0))
+        return len(data)
+
+    def flush(self):
+        self.target.flush()
+
+    def missing(self):
+        """Return the selected databases not found so far."""
+        return self.databases - self.found
+
+    def close(self):
+        self.send(len(self.buffer))
+        self.target.close()
+
+    def abort(self):
+        self.target.abort()
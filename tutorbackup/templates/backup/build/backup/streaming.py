@@ -0,0 +1,237 @@
+import hashlib
+import io
+import sys
+import tarfile
+import time
+from contextlib import nullcontext
+from glob import escape, glob
+from subprocess import PIPE, CalledProcessError
+
+from processes import Popen, kill, wait
+
+# Dump output that is streamed into the archive is stored as a
+# sequence of numbered tar members ("<name>.00000", "<name>.00001",
+# ...), since a tar header must carry the size of its member before
+# the member data. Each part is buffered in memory, so this is also
+# the upper bound of the memory used while streaming.
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def part_name(name, index):
+    return f"{name}.{index:05d}"
+
+
+def is_part_of(member_name, name):
+    prefix, _, suffix = member_name.rpartition('.')
+    return prefix == name and len(suffix) == 5 and suffix.isdigit()
+
+
+def add_stream(tar, name, stream, chunk_size=CHUNK_SIZE, lock=None):
+    """Add the contents of stream to tar as numbered members.
+
+    If several streams are added to the same tar concurrently, they
+    must share a lock. Their parts then interleave in the archive.
+
+    Returns the total number of bytes read from the stream.
+    """
+    lock = lock or nullcontext()
+    total_size = 0
+    index = 0
+    while True:
+        # BufferedReader.read() only returns short at end of stream.
+        chunk = stream.read(chunk_size)
+        if not chunk and index:
+            break
+        tarinfo = tarfile.TarInfo(part_name(name.lstrip('/'), index))
+        tarinfo.size = len(chunk)
+        tarinfo.mtime = time.time()
+        with lock:
+            tar.addfile(tarinfo, io.BytesIO(chunk))
+        total_size += len(chunk)
+        index += 1
+        if len(chunk) < chunk_size:
+            break
+    return total_size
+
+
+def add_process_output(tar, name, process, lock=None):
+    """Add the stdout of a running process to tar.
+
+    Raises CalledProcessError if the process exits with a non-zero
+    return code.
+    """
+    try:
+        size = add_stream(tar, name, process.stdout, lock=lock)
+    finally:
+        process.stdout.close()
+        returncode = wait(process)
+    if returncode:
+        raise CalledProcessError(returncode, process.args)
+    return size
+
+
+def add_bytes(tar, name, data, lock=None):
+    """Add data to tar as a single, regular member."""
+    tarinfo = tarfile.TarInfo(name.lstrip('/'))
+    tarinfo.size = len(data)
+    tarinfo.mtime = time.time()
+    with lock or nullcontext():
+        tar.addfile(tarinfo, io.BytesIO(data))
+
+
+class PartWriter:
+    """A writable file object that adds everything written to tar as
+    numbered members, like add_stream does for a readable stream.
+
+    Closing it adds the last part.
+    """
+
+    def __init__(self, tar, name, chunk_size=CHUNK_SIZE, lock=None):
+        self.tar = tar
+        self.name = name.lstrip('/')
+        self.chunk_size = chunk_size
+        self.lock = lock or nullcontext()
+        self.buffer = bytearray()
+        self.index = 0
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.chunk_size:
+            self._add_part(self.chunk_size)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer or not self.index:
+            self._add_part(len(self.buffer))
+
+    def _add_part(self, size):
+        tarinfo = tarfile.TarInfo(part_name(self.name, self.index))
+        tarinfo.size = size
+        tarinfo.mtime = time.time()
+        with self.lock:
+            self.tar.addfile(tarinfo, io.BytesIO(self.buffer[:size]))
+        del self.buffer[:size]
+        self.index += 1
+
+
+class TeeWriter:
+    """A writable file object that writes everything to all targets."""
+
+    def __init__(self, *targets):
+        self.targets = targets
+
+    def write(self, data):
+        for target in self.targets:
+            target.write(data)
+        return len(data)
+
+    def flush(self):
+        for target in self.targets:
+            target.flush()
+
+
+class HashingWriter:
+    """A writable file object that passes everything through to target,
+    and calculates its MD5 checksum and size on the way."""
+
+    def __init__(self, target):
+        self.target = target
+        self.file_hash = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        self.file_hash.update(data)
+        self.size += len(data)
+        return self.target.write(data)
+
+    def flush(self):
+        self.target.flush()
+
+    def hexdigest(self):
+        return self.file_hash.hexdigest()
+
+
+class HashingReader:
+    """A readable file object that reads from source, and calculates
+    the MD5 checksum and size of everything read on the way."""
+
+    def __init__(self, source):
+        self.source = source
+        self.file_hash = hashlib.md5()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.file_hash.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self):
+        return self.file_hash.hexdigest()
+
+
+class ProcessInput:
+    """A writable file object that feeds the stdin of a shell command.
+
+    Closing it waits for the command to finish, and raises
+    CalledProcessError if it fails. Aborting it kills the command.
+    """
+
+    def __init__(self, cmd, stderr=None):
+        self.cmd = cmd
+        self.process = Popen(cmd,
+                             shell=True,
+                             stdin=PIPE,
+                             stdout=sys.stdout,
+                             stderr=stderr or sys.stderr)
+
+    def write(self, data):
+        return self.process.stdin.write(data)
+
+    def flush(self):
+        self.process.stdin.flush()
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = wait(self.process)
+        if returncode:
+            raise CalledProcessError(returncode, self.cmd)
+
+    def abort(self):
+        kill(self.process)
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def find_parts(path):
+    """Return the streamed parts of path on disk, in order."""
+    return sorted(part for part in glob(f"{escape(path)}.*")
+                  if is_part_of(part, path))
+
+
+def write_parts(parts, out):
+    """Concatenate the given part files into the file object out."""
+    total_size = 0
+    for part in parts:
+        with open(part, 'rb') as f:
+            while chunk := f.read(io.DEFAULT_BUFFER_SIZE * 128):
+                out.write(chunk)
+                total_size += len(chunk)
+    return total_size
@@ -0,0 +1,195 @@
+import json
+import subprocess
+import threading
+import time
+from subprocess import DEVNULL
+
+import pymysql
+
+import processes
+from mysql_chunks import PROGRAM_NAME
+
+# The dumps read from the same servers that serve production traffic.
+# While they run, a throttle samples the load of these servers, and
+# pauses the dumps whenever a server is over one of its thresholds.
+#
+# A dump is paused for at most max_pause seconds at a time, and then
+# runs for at least one interval, so that dumps slow down rather than
+# stall. This also keeps their server connections from timing out:
+# MySQL drops a connection that does not read the rows it is sent for
+# net_write_timeout seconds (60 by default).
+#
+# How long to wait for mongostat to take a sample, in seconds.
+SAMPLE_TIMEOUT = 10
+
+# The statements that other clients are running. The connections of
+# the dumps themselves, and of the probe, are told apart by the
+# program_name attribute that mysqldump and the backup send. If the
+# Performance Schema is disabled, the attributes are unknown, and all
+# connections are counted.
+OTHER_THREADS_RUNNING = f"""
+    SELECT COUNT(*) FROM information_schema.processlist
+    WHERE command NOT IN ('Sleep', 'Daemon', 'Binlog Dump',
+                          'Binlog Dump GTID')
+    AND id != CONNECTION_ID()
+    AND id NOT IN (
+        SELECT processlist_id
+        FROM performance_schema.session_connect_attrs
+        WHERE attr_name = 'program_name'
+        AND attr_value IN ('mysqldump', '{PROGRAM_NAME}'))
+"""
+
+
+class MySQLLoad:
+    """A probe of the load of a MySQL server.
+
+    Calling it returns how the server is over its thresholds of
+    statements that other clients are running, and replication lag, in
+    seconds. A threshold of 0 is not checked.
+    """
+
+    def __init__(self, connect, threads_running=0, replica_lag=0):
+        self.connect = connect
+        self.threads_running = threads_running
+        self.replica_lag = replica_lag
+        self.connection = None
+
+    def __call__(self):
+        try:
+            if self.connection is None:
+                self.connection = self.connect()
+            return self.sample()
+        except (pymysql.err.MySQLError, OSError):
+            # A failed sample must not fail the backup.
+            self.close()
+            return []
+
+    def sample(self):
+        overloaded = []
+        with self.connection.cursor() as cursor:
+            if self.threads_running:
+                cursor.execute(OTHER_THREADS_RUNNING)
+                value = int(cursor.fetchone()[0])
+                if value > self.threads_running:
+                    overloaded.append(f"MySQL has {value} threads running "
+                                      "for other clients")
+        if self.replica_lag:
+            with self.connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                try:
+                    cursor.execute("SHOW REPLICA STATUS")
+                except pymysql.err.MySQLError:
+                    # Before MySQL 8.0.22
+                    cursor.execute("SHOW SLAVE STATUS")
+                row = cursor.fetchone() or {}
+            lag = row.get('Seconds_Behind_Source',
+                          row.get('Seconds_Behind_Master'))
+            if lag is not None and int(lag) > self.replica_lag:
+                overloaded.append(f"MySQL replication lags {lag}s behind")
+        return overloaded
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except pymysql.err.Error:
+                pass
+            self.connection = None
+
+
+class MongoDBLoad:
+    """A probe of the load of a MongoDB server.
+
+    Calling it returns whether more operations than queue_length are
+    queued for the global lock, as mongostat reports from serverStatus.
+    """
+
+    def __init__(self, mongostat_cmd, queue_length):
+        self.mongostat_cmd = mongostat_cmd
+        self.queue_length = queue_length
+
+    def __call__(self):
+        # mongostat is not started through the processes module, since
+        # pausing the dumps must not pause the probe.
+        try:
+            output = subprocess.run(self.mongostat_cmd, shell=True,
+                                    stdout=subprocess.PIPE, stderr=DEVNULL,
+                                    timeout=SAMPLE_TIMEOUT,
+                                    check=True).stdout
+            stats = json.loads(output.splitlines()[-1])
+        except (OSError, subprocess.SubprocessError, ValueError,
+                IndexError):
+            return []
+        queued = 0
+        for host_stats in stats.values():
+            # Queued reads and writes, as "<reads>|<writes>".
+            for value in str(host_stats.get('qrw', '')).split('|'):
+                if value.strip().isdigit():
+                    queued += int(value)
+        if queued > self.queue_length:
+            return [f"MongoDB has {queued} operations queued"]
+        return []
+
+    def close(self):
+        pass
+
+
+class Throttle:
+    """A context that pauses the processes started through the processes
+    module, and the dumps that call processes.wait_while_paused(), while
+    any of the probes reports an overloaded server.
+
+    The first time a server is overloaded, the CPU and I/O priority of
+    the processes is lowered, too, for the rest of the run. The time
+    during which the dumps were paused is kept in paused_time.
+    """
+
+    def __init__(self, probes, report, interval=5, max_pause=30):
+        self.probes = probes
+        self.report = report
+        self.interval = interval
+        self.max_pause = max_pause
+        self.paused_time = 0.0
+        self.pauses = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop.set()
+        self.thread.join()
+        for probe in self.probes:
+            probe.close()
+
+    def sample(self):
+        overloaded = []
+        for probe in self.probes:
+            overloaded.extend(probe())
+        return overloaded
+
+    def run(self):
+        pause_start = None
+        try:
+            while not self.stop.wait(self.interval):
+                overloaded = self.sample()
+                now = time.monotonic()
+                if pause_start is not None:
+                    if not overloaded or now - pause_start >= self.max_pause:
+                        processes.resume()
+                        self.paused_time += now - pause_start
+                        pause_start = None
+                elif overloaded:
+                    if not self.pauses:
+                        processes.lower_priority()
+                    self.report(f"Pausing the dumps for up to "
+                                f"{self.max_pause}s: "
+                                f"{', '.join(overloaded)}.")
+                    processes.pause()
+                    self.pauses += 1
+                    pause_start = now
+        finally:
+            if pause_start is not None:
+                processes.resume()
+                self.paused_time += time.monotonic() - pause_start